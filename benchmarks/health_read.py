@@ -0,0 +1,47 @@
+"""Time ``lemon show`` needs to read the health of a mesh, reading node by
+node (``per_node``, one round trip each) against the pipelined reads of
+:py:class:`lemon.health.HealthReader` (``bulk``), which only read the
+versions of healths that did not change since its previous read::
+
+    python benchmarks/health_read.py --nodes 10 100 1000
+"""
+import argparse
+import timeit
+from lemon.ctx import NodeContext
+from lemon.health import HealthReader, health_id, init_health, load_health
+from lemon.system import pid_id
+from lemon.utils import ensure_redis
+
+MESH = '!bench-health'
+
+
+def bench(nodes: "int", repeat: "int"):
+    ctxs = [NodeContext(MESH, f'node{i}', 'node') for i in range(nodes)]
+    for ctx in ctxs:
+        init_health(ctx)
+    reader = HealthReader(ensure_redis(), ctxs)
+
+    per_node = min(timeit.repeat(
+        lambda: [load_health(ctx) for ctx in ctxs], number=1, repeat=repeat))
+    bulk = min(timeit.repeat(reader.read, number=1, repeat=repeat))
+
+    ensure_redis().delete(*(
+        key for ctx in ctxs for key in (health_id(ctx), pid_id(ctx))))
+    return per_node, bulk
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--nodes', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'nodes':>10} {'per_node':>12} {'bulk':>12}")
+    for nodes in args.nodes:
+        per_node, bulk = bench(nodes, args.repeat)
+        print(f'{nodes:>10} {1e3 * per_node:>9.2f} ms {1e3 * bulk:>9.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Throughput of one node publishing to and subscribing to itself through
+the in-process broker of :py:mod:`lemon.testing`. Without a redis server in
+the loop, this measures the cost of Lemon's own hot path (codecs, dispatch
+and health accounting) and is stable enough to catch regressions of it.
+Fails if a payload is handled below ``--min-rate`` messages per second::
+
+    python benchmarks/memory_broker.py --messages 20000 --size 64 65536
+"""
+import argparse
+import asyncio
+import sys
+import time
+from lemon.api import anyone_listening, publish, subscribe
+from lemon.bench import PAYLOADS, init_node, make_payload
+from lemon.utils import set_redis_url
+
+TOPIC = '!bench:memory'
+
+
+async def measure(payload, messages: "int") -> "float":
+    init_node('memory', 'pickle')
+    received = 0
+
+    async def on_message(value):
+        nonlocal received
+        received += 1
+
+    task = asyncio.get_event_loop().create_task(
+        subscribe({TOPIC: on_message}))
+    while not await anyone_listening(TOPIC):
+        await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        await publish(TOPIC, payload)
+        # Hand over to the subscription as a remote publisher would
+        await asyncio.sleep(0)
+    while received < messages:
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+
+    task.cancel()
+    return messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--size', type=int, nargs='+', default=[64, 65536])
+    parser.add_argument('--payload', nargs='+', default=list(PAYLOADS))
+    parser.add_argument('--min-rate', type=float, default=0)
+    args = parser.parse_args()
+    set_redis_url('memory://bench')
+
+    failed = False
+    for kind in args.payload:
+        for size in args.size:
+            rate = asyncio.run(
+                measure(make_payload(kind, size), args.messages))
+            slow = rate < args.min_rate
+            failed = failed or slow
+            print(f'{kind:>6} {size:>7} B: {rate:,.0f} msg/s'
+                  f'{" BELOW MINIMUM" if slow else ""}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
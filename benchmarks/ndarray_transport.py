@@ -0,0 +1,90 @@
+"""Copies per message and MB/s when sending NumPy frames of 1-16 MB with
+the ``pickle`` and ``pickle5-oob`` codecs::
+
+    python benchmarks/ndarray_transport.py --repeat 20
+
+Copies are estimated from the peak of traced allocations relative to the
+frame size. The transport stage packs the PUBLISH command as redis-py does
+and joins it into a single write buffer, as asyncio transports do before
+sending it.
+"""
+import argparse
+import time
+import tracemalloc
+import numpy as np
+from redis.asyncio.connection import Connection
+from lemon.codecs import decode, encode, get_codec
+
+SIZES_MB = (1, 2, 4, 8, 16)
+
+
+def transport(connection, data):
+    return b''.join(connection.pack_command('PUBLISH', '/dvs/image', data))
+
+
+def receive(wire, header_length):
+    # The reply parser hands out the message as a fresh bytes object
+    return wire[header_length:-2]
+
+
+def copies(fn, nbytes):
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak / nbytes
+
+
+def throughput(fn, nbytes, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return nbytes / best / 1e6
+
+
+def bench(codec, frame, repeat):
+    connection = Connection()
+    nbytes = frame.nbytes
+
+    data, encode_copies = copies(lambda: encode(frame, codec), nbytes)
+    wire, transport_copies = copies(
+        lambda: transport(connection, data), nbytes)
+    header_length = len(wire) - len(data) - 2
+    message, receive_copies = copies(
+        lambda: receive(wire, header_length), nbytes)
+    _, decode_copies = copies(lambda: decode(message), nbytes)
+
+    def roundtrip():
+        decode(receive(transport(connection, encode(frame, codec)),
+                       header_length))
+
+    return {
+        'copies': encode_copies + transport_copies
+        + receive_copies + decode_copies,
+        'encode': throughput(lambda: encode(frame, codec), nbytes, repeat),
+        'decode': throughput(lambda: decode(message), nbytes, repeat),
+        'roundtrip': throughput(roundtrip, nbytes, repeat)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f'{"frame":>6} {"codec":>12} {"copies":>7} {"encode":>12} '
+          f'{"decode":>12} {"roundtrip":>12}')
+    for size in SIZES_MB:
+        side = int((size * 2 ** 20 / 4) ** .5)
+        frame = np.random.rand(side, side).astype(np.float32)
+        for name in ('pickle', 'pickle5-oob'):
+            result = bench(get_codec(name), frame, args.repeat)
+            print(f'{size:>4}MB {name:>12} {result["copies"]:>7.1f} '
+                  f'{result["encode"]:>7.0f} MB/s {result["decode"]:>7.0f} '
+                  f'MB/s {result["roundtrip"]:>7.0f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Round-trip latency and throughput of redis over TCP and over a Unix
+domain socket. Servers that are not running are started by
+:py:func:`lemon.utils.ensure_redis`, the socket one with ``--unixsocket``::
+
+    python benchmarks/redis_latency.py --requests 10000 --size 1024
+"""
+import argparse
+import statistics
+import time
+from lemon.utils import ensure_redis
+
+TOPIC = '!bench:redis-latency'
+
+
+def measure(url: "str", requests: "int", size: "int"):
+    client = ensure_redis(url=url)
+    subscriber = ensure_redis(url=url).pubsub()
+    subscriber.subscribe(TOPIC)
+    subscriber.get_message(timeout=1)
+    payload = b'\x00' * size
+
+    def percentiles(fn):
+        latencies = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        return (statistics.median(latencies),
+                latencies[int(.99 * len(latencies))])
+
+    def publish_receive():
+        client.publish(TOPIC, payload)
+        while subscriber.get_message(
+                ignore_subscribe_messages=True, timeout=1) is None:
+            pass
+
+    ping = percentiles(client.ping)
+    roundtrip = percentiles(publish_receive)
+
+    start = time.perf_counter()
+    pipeline = client.pipeline(transaction=False)
+    for _ in range(requests):
+        pipeline.set(TOPIC, payload)
+    pipeline.execute()
+    ops = requests / (time.perf_counter() - start)
+
+    subscriber.close()
+    client.delete(TOPIC)
+    return {
+        'ping_p50': f'{1e6 * ping[0]:.0f} us',
+        'ping_p99': f'{1e6 * ping[1]:.0f} us',
+        'pubsub_p50': f'{1e6 * roundtrip[0]:.0f} us',
+        'pubsub_p99': f'{1e6 * roundtrip[1]:.0f} us',
+        'pipelined_set': f'{ops:.0f} ops/s'
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tcp', default='redis://localhost:6379')
+    parser.add_argument('--unix', default='unix:///tmp/lemon-redis.sock')
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--size', type=int, default=1024)
+    args = parser.parse_args()
+
+    for name, url in (('tcp', args.tcp), ('unix', args.unix)):
+        result = measure(url, args.requests, args.size)
+        print(f'{name:>5}: ' + ', '.join(
+            f'{key}={value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
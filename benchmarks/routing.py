@@ -0,0 +1,60 @@
+"""Routing microbenchmark of :py:class:`lemon.dispatch.Router` with many
+glob-style patterns. Compares resolving a channel by matching it against
+every pattern (``uncached``, as ``fnmatch`` would) against the cached
+router (``cached``)::
+
+    python benchmarks/routing.py --patterns 10 100 1000 --channels 1000
+"""
+import argparse
+import random
+import timeit
+from lemon.dispatch import Router
+
+
+def uncached_route(router: "Router", channel: "str") -> "str":
+    if channel in router.routes:
+        return channel
+    for regex, pattern in router.patterns:
+        if regex.fullmatch(channel):
+            return pattern
+
+
+def bench(patterns: "int", channels: "int", messages: "int"):
+    # Half of the subscriptions are patterns, half are topics by name
+    topic_to_fn = {}
+    for i in range(patterns):
+        topic_to_fn[f'/sensor/{i}/*'] = i
+        topic_to_fn[f'/status/{i}'] = i
+    router = Router(topic_to_fn)
+
+    # Channels that match the last patterns are the worst case uncached
+    names = [f'/sensor/{patterns - 1 - i % patterns}/{i}'
+             for i in range(channels)]
+    traffic = random.Random(0).choices(names, k=messages)
+
+    uncached = min(timeit.repeat(
+        lambda: [uncached_route(router, channel) for channel in traffic],
+        number=1, repeat=5))
+    cached = min(timeit.repeat(
+        lambda: [router.route(channel) for channel in traffic],
+        number=1, repeat=5))
+    return uncached / messages, cached / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--patterns', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--channels', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'patterns':>10} {'uncached':>14} {'cached':>14}")
+    for patterns in args.patterns:
+        uncached, cached = bench(patterns, args.channels, args.messages)
+        print(f'{patterns:>10} {1e9 * uncached:>11.0f} ns '
+              f'{1e9 * cached:>11.0f} ns')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Serialize/deserialize microbenchmark of the codecs in
+:py:mod:`lemon.codecs` across payload kinds and sizes::
+
+    python benchmarks/serialization.py --repeat 200
+"""
+import argparse
+import timeit
+from lemon.codecs import CODECS, decode, encode
+
+SIZES = (64, 4096, 262144, 4194304)
+
+
+def payloads(size: "int"):
+    yield 'bytes', b'\x00' * size
+    n = max(1, size // 32)
+    yield 'dict', {f'key{i}': [i, i * .5, 'value'] for i in range(n)}
+    yield 'list', [i * .5 for i in range(max(1, size // 8))]
+
+
+def bench(codec, value, repeat):
+    try:
+        data = encode(value, codec)
+        decode(data)
+    except (TypeError, ValueError):
+        return None
+    dumps = min(timeit.repeat(
+        lambda: encode(value, codec), number=1, repeat=repeat))
+    loads = min(timeit.repeat(
+        lambda: decode(data), number=1, repeat=repeat))
+    return len(data), dumps, loads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--codec', action='append', default=None)
+    args = parser.parse_args()
+
+    codecs = [CODECS[name] for name in (args.codec or CODECS)]
+    print(f'{"payload":>8} {"size":>8} {"codec":>8} {"wire":>9} '
+          f'{"encode":>10} {"decode":>10}')
+    for size in SIZES:
+        for kind, value in payloads(size):
+            for codec in codecs:
+                result = bench(codec, value, args.repeat)
+                if result is None:
+                    print(f'{kind:>8} {size:>8} {codec.name:>8} '
+                          f'{"unsupported":>9}')
+                    continue
+                nbytes, dumps, loads = result
+                print(f'{kind:>8} {size:>8} {codec.name:>8} {nbytes:>9} '
+                      f'{1e6 * dumps:>8.1f}us {1e6 * loads:>8.1f}us')
+
+
+if __name__ == '__main__':
+    main()
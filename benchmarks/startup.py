@@ -0,0 +1,92 @@
+"""Import time of the ``lemon`` CLI and of the node runtime, measured with
+``python -X importtime`` in fresh interpreters. Fails if the median import
+time of a scenario exceeds its budget, or if a scenario loads a module it
+must not need::
+
+    python benchmarks/startup.py --runs 10 --budget cli=150 node=400
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+SCENARIOS = {
+    # What every ``lemon`` command pays before it runs
+    'cli': 'import lemon.actions',
+    # What every node pays before its entrypoint runs
+    'node': 'from lemon import entrypoint, publish, subscribe',
+}
+BUDGETS = {'cli': 150., 'node': 400.}
+FORBIDDEN = {
+    'cli': ('lemon.api', 'redis', 'yaml', 'cerberus', 'prettytable',
+            'psutil'),
+    'node': ('yaml', 'cerberus', 'prettytable', 'psutil'),
+}
+
+
+def importtime(code: "str") -> "tuple[dict[str, int], dict[str, int]]":
+    """Returns the self and cumulative import times in us per module."""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True, text=True, check=True).stderr
+    own, cumulative = {}, {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Top-level imports are not indented
+        if not name.startswith('  '):
+            cumulative[name.strip()] = int(cumulative_us)
+        own[name.strip()] = int(own_us)
+    return own, cumulative
+
+
+def measure(code: "str", runs: "int"):
+    _, interpreter = importtime('pass')
+    totals, own_times = [], {}
+    for _ in range(runs):
+        own, cumulative = importtime(code)
+        totals.append(sum(us for name, us in cumulative.items()
+                          if name not in interpreter))
+        for name, us in own.items():
+            own_times.setdefault(name, []).append(us)
+    slowest = sorted(own_times, key=lambda name: -statistics.median(
+        own_times[name]))
+    return statistics.median(totals) / 1e3, set(own_times), [
+        (name, statistics.median(own_times[name]) / 1e3)
+        for name in slowest[:5]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget', nargs='*', default=[],
+                        help='Budgets in ms, e.g. cli=150')
+    args = parser.parse_args()
+
+    budgets = dict(BUDGETS)
+    for budget in args.budget:
+        scenario, ms = budget.split('=')
+        budgets[scenario] = float(ms)
+
+    failed = False
+    for scenario, code in SCENARIOS.items():
+        total, modules, slowest = measure(code, args.runs)
+        forbidden = sorted(
+            module for module in modules
+            if any(module == name or module.startswith(name + '.')
+                   for name in FORBIDDEN[scenario]))
+        over = total > budgets[scenario]
+        failed = failed or over or bool(forbidden)
+
+        print(f'{scenario:>5}: {total:.1f} ms (budget '
+              f'{budgets[scenario]:.0f} ms){" OVER BUDGET" if over else ""}')
+        print('       slowest: ' + ', '.join(
+            f'{name} {ms:.1f} ms' for name, ms in slowest))
+        if forbidden:
+            print('       loads: ' + ', '.join(forbidden))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""End-to-end throughput of the pub/sub and the stream transport through the
+real :py:func:`lemon.api.publish` and :py:func:`lemon.api.subscribe` code
+paths. Requires a local ``redis-server``::
+
+    python benchmarks/streams_throughput.py --messages 20000 --size 256
+"""
+import argparse
+import asyncio
+import time
+from lemon.api import API, batch, publish, set_transport, subscribe
+from lemon.ctx import AsyncNodeContext
+from lemon.health import HealthService
+
+
+async def measure(transport, messages, size, batched):
+    topic = f'!bench:{transport}'
+    API.ctx = AsyncNodeContext('bench', f'streams-{transport}', 'bench')
+    API.health_service = HealthService()
+    set_transport(transport, topic)
+    if transport == 'stream':
+        await API.ctx.redis_client.delete(f'!stream:{topic}')
+
+    received = 0
+    done = asyncio.Event()
+
+    async def callback(value):
+        nonlocal received
+        received += 1
+        if received == messages:
+            done.set()
+
+    task = asyncio.create_task(subscribe({topic: callback}))
+    await asyncio.sleep(.5)
+
+    payload = b'\x00' * size
+    start = time.perf_counter()
+    if batched:
+        async with batch():
+            for _ in range(messages):
+                await publish(topic, payload)
+    else:
+        for _ in range(messages):
+            await publish(topic, payload)
+    sent = time.perf_counter() - start
+
+    await asyncio.wait_for(done.wait(), timeout=60)
+    elapsed = time.perf_counter() - start
+
+    task.cancel()
+    await asyncio.wait((task,))
+    await API.ctx.redis_client.close()
+    return messages / sent, messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--batched', action='store_true')
+    args = parser.parse_args()
+
+    for transport in ('redis', 'stream'):
+        send_rate, rate = asyncio.run(measure(
+            transport, args.messages, args.size, args.batched))
+        print(f'{transport:>8}: publish {send_rate:>9.0f} msg/s, '
+              f'end-to-end {rate:>9.0f} msg/s, '
+              f'{rate * args.size / 1e6:>7.2f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
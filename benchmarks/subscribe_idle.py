@@ -0,0 +1,88 @@
+"""Idle CPU usage and wake-up latency of :py:func:`lemon.api.subscribe`.
+
+Requires a local ``redis-server``. Compares the former busy-poll receive
+loop (``legacy``) against the blocking receive loop (``blocking``)::
+
+    python benchmarks/subscribe_idle.py --idle 5 --messages 200
+"""
+import argparse
+import asyncio
+import pickle
+import statistics
+import time
+import redis
+from lemon.api import API, subscribe
+from lemon.ctx import AsyncNodeContext
+from lemon.health import HealthService
+
+TOPIC = '!bench:subscribe-idle'
+
+
+async def legacy_subscribe(topic_to_fn):
+    # Receive loop as it was before the blocking receive path
+    pubsub_client = API.ctx.redis_client.pubsub()
+    await pubsub_client.subscribe(*topic_to_fn.keys())
+    while True:
+        await asyncio.sleep(1e-9)
+        message = await pubsub_client.get_message(True)
+        if message:
+            callback = topic_to_fn[message['channel'].decode('utf8')]
+            await callback(pickle.loads(message['data']))
+
+
+async def measure(mode, idle, messages):
+    API.ctx = AsyncNodeContext('bench', 'subscribe-idle', 'bench')
+    API.health_service = HealthService()
+    publisher = redis.Redis(host='localhost', port=6379)
+
+    latencies = []
+    received = asyncio.Event()
+
+    async def callback(sent_at):
+        latencies.append(time.perf_counter() - sent_at)
+        received.set()
+
+    fn = legacy_subscribe if mode == 'legacy' else subscribe
+    task = asyncio.create_task(fn({TOPIC: callback}))
+    await asyncio.sleep(.5)
+
+    cpu, wall = time.process_time(), time.perf_counter()
+    await asyncio.sleep(idle)
+    cpu_share = (time.process_time() - cpu) / (time.perf_counter() - wall)
+
+    for _ in range(messages):
+        received.clear()
+        publisher.publish(TOPIC, pickle.dumps(time.perf_counter()))
+        await asyncio.wait_for(received.wait(), timeout=5)
+        # Let the subscriber fall back into its idle state
+        await asyncio.sleep(.01)
+
+    task.cancel()
+    await asyncio.wait((task,))
+    await API.ctx.redis_client.close()
+
+    latencies.sort()
+    return {
+        'idle_cpu': f'{100 * cpu_share:.1f} %',
+        'latency_p50': f'{1e6 * statistics.median(latencies):.0f} us',
+        'latency_p99': f'{1e6 * latencies[int(.99 * len(latencies))]:.0f} us'
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=['legacy', 'blocking', 'both'],
+                        default='both')
+    parser.add_argument('--idle', type=float, default=5.)
+    parser.add_argument('--messages', type=int, default=200)
+    args = parser.parse_args()
+
+    modes = ['legacy', 'blocking'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        result = asyncio.run(measure(mode, args.idle, args.messages))
+        print(f'{mode:>10}: ' + ', '.join(
+            f'{key}={value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,12 @@
 import click
 from lemon import entrypoint
-from lemon.api import anyone_listening, parameter, publish, subscribe
+from lemon.api import (
+    anyone_listening,
+    parameter,
+    publish,
+    set_codec,
+    subscribe
+)
 from integrator_cpp import collect_events
 import numpy as np
 
@@ -61,6 +67,7 @@ class Integrator:
 @entrypoint
 async def start(camera):
     i = Integrator()
+    set_codec('pickle5-oob', '/dvs/image', '/dvs/time_map')
 
     await subscribe({
         camera: i.receive_events,
@@ -1 +1,25 @@
-from lemon.api import publish, subscribe, entrypoint, parameter  # noqa
+# The API is imported on first use, so that the CLI does not load it
+API = (
+    'batch',
+    'entrypoint',
+    'get_latencies',
+    'offload',
+    'parameter',
+    'publish',
+    'publish_many',
+    'set_codec',
+    'set_overflow',
+    'set_partition_key',
+    'set_tracing',
+    'set_transport',
+    'subscribe'
+)
+
+__all__ = list(API)
+
+
+def __getattr__(name):
+    if name in API:
+        from lemon import api
+        return getattr(api, name)
+    raise AttributeError(f"module 'lemon' has no attribute '{name}'")
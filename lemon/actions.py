@@ -1,49 +1,109 @@
+import contextlib
+import json
 import os
 import pickle
+import sys
+import time
 import traceback
-import psutil
 import click
-import yaml
-from prettytable import PrettyTable
 from lemon.ctx import NodeContext
-from lemon.build import InvalidLemonfileException, build_mesh
-from lemon.health import get_health, init_health
-from lemon.system import LogFileService, NodePIDNotFound, ProcessService
+from lemon.build import (
+    BuildFailureException,
+    InvalidLemonfileException,
+    build_mesh,
+    lemonfile_redis_url
+)
+from lemon.graph import start_stages, topics
+from lemon.health import (
+    DEFAULT_WINDOW,
+    WINDOWS,
+    HealthReader,
+    get_health,
+    get_replicas_health,
+    init_health
+)
+from lemon.system import (
+    STOP_TIMEOUT,
+    LogFileService,
+    NodePIDNotFound,
+    ProcessService
+)
 from lemon.utils import (
+    REDIS_URL,
+    REDIS_URL_ENV,
     Severity,
     Entity,
     bold_str,
     ensure_redis,
+    lazy_import,
+    set_redis_url,
     severity_to_message,
     entity_to_message
 )
 
+bench = lazy_import('lemon.bench')
+prettytable = lazy_import('prettytable')
+psutil = lazy_import('psutil')
+yaml = lazy_import('yaml')
+
+# Seconds the nodes of a stage of ``lemon start`` get to be ready, and the
+# interval in which their readiness is checked
+READY_TIMEOUT = 10.0
+READY_INTERVAL = 5e-2
+# Refresh interval of ``lemon show --watch``, and the ANSI sequence that
+# moves the cursor home and clears the terminal before a refresh
+WATCH_INTERVAL = 1.0
+CLEAR_SCREEN = '\033[H\033[J'
+
 
 @click.group()
-def cli():
-    pass
+@click.option('--redis', 'redis_url', default=None,
+              help='URL of the redis server, e.g. unix:///tmp/redis.sock '
+              f'(default: ${REDIS_URL_ENV}, the Lemonfile or {REDIS_URL})')
+def cli(redis_url):
+    if redis_url:
+        set_redis_url(redis_url)
 
 
-@cli.command()
-def build():
-    """Build nodes and meshes defined in the local Lemonfile 🍋"""
-    redis_client = ensure_redis()
+def use_mesh_redis(mesh: "str"):
+    """Uses the redis server given for ``mesh`` in the local Lemonfile,
+    unless a server was set via ``--redis`` or ``LEMON_REDIS_URL``.
+    """
+    if REDIS_URL_ENV not in os.environ:
+        url = lemonfile_redis_url(mesh)
+        if url:
+            set_redis_url(url)
+
 
+@cli.command()
+@click.option('-f', '--force', is_flag=True,
+              help='Rebuild all nodes, even if they are unchanged')
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1),
+              help='Number of nodes to build concurrently')
+def build(force, jobs):
+    """Build nodes and meshes defined in the local Lemonfile 🍋. Nodes whose
+    sources did not change since their last build are skipped."""
     entity_to_message(
         Entity.Lemonfile, '🍋', 'Building locally')
 
+    explicit_url = os.environ.get(REDIS_URL_ENV)
     try:
         with open('Lemonfile.yml') as file:
             meshes = yaml.safe_load(file)
 
         for mesh in meshes:
-            build_mesh(redis_client, mesh)
+            if not explicit_url and isinstance(mesh, dict):
+                set_redis_url(mesh.get('redis') or REDIS_URL)
+            build_mesh(ensure_redis(), mesh, force, jobs)
     except FileNotFoundError:
         severity_to_message(Severity.Error, "No Lemonfile detected")
 
     except InvalidLemonfileException:
         severity_to_message(Severity.Error, "Invalid Lemonfile")
 
+    except BuildFailureException:
+        severity_to_message(Severity.Error, "Build failed")
+
     except Exception:
         traceback.print_exc()
         severity_to_message(Severity.Error, "Build failed")
@@ -63,61 +123,139 @@ def safe_load_mesh(redis_client, mesh):
 @click.argument('mesh')
 @click.option('-s', '--select', default=None, multiple=True)
 @click.option('-x', '--exclude', default=[], multiple=True)
-def start(mesh, select, exclude):
-    """Start all nodes of mesh MESH"""
+@click.option('-t', '--timeout', default=READY_TIMEOUT, type=float,
+              show_default=True,
+              help='Seconds to wait for the nodes of a stage to be ready '
+              '(0 to not wait)')
+def start(mesh, select, exclude, timeout):
+    """Start all nodes of mesh MESH. Nodes start in stages derived from
+    their in and out topics: a node starts once the nodes consuming its
+    out topics self-registered and subscribed."""
+    use_mesh_redis(mesh)
     redis_client = ensure_redis()
     nodes = safe_load_mesh(redis_client, mesh)
 
     entity_to_message(
         Entity.Mesh, mesh, "Starting nodes")
 
-    for node in nodes:
-        if select and node['name'] not in select:
-            continue
-        if node['name'] in exclude:
-            continue
+    # Spreads equal messages over the replicas, see set_partition_key
+    sequence_args = []
+    if any('replicas' in node for node in nodes):
+        sequence_args = ['--sequence']
 
-        severity_to_message(
-            Severity.Information, f"Starting node {bold_str(node['name'])}")
+    nodes = [node for node in nodes
+             if (not select or node['name'] in select)
+             and node['name'] not in exclude]
 
-        additional_args = []
-        if 'with' in node:
-            if not isinstance(node['with'], list):
-                additional_args = [node['with']]
+    running = [ctx for node in nodes
+               for ctx in NodeContext.replicas(mesh, node)
+               if ProcessService.is_running(ctx)]
+    if running:
+        severity_to_message(
+            Severity.Information, "Stopping nodes that are still active")
+        stop_nodes(running)
+
+    for stage in start_stages(nodes):
+        started = []
+        for node in stage:
+            additional_args = []
+            if 'with' in node:
+                if not isinstance(node['with'], list):
+                    additional_args = [node['with']]
+                else:
+                    additional_args = node['with']
+
+            subscribes = bool(topics(node, 'in'))
+            replicas = NodeContext.replicas(mesh, node)
+            for i, ctx in enumerate(replicas):
+                replica_args = []
+                if 'replicas' in node:
+                    replica_args = [
+                        '--replica', str(i), '--replicas', str(len(replicas))]
+                process = start_node(
+                    ctx, additional_args + replica_args + sequence_args)
+                started.append((ctx, process, subscribes))
+
+        if timeout > 0:
+            wait_ready(started, timeout)
+
+
+def start_node(ctx, additional_args):
+    severity_to_message(
+        Severity.Information, f"Starting node {bold_str(ctx.name)}")
+
+    # Counters and rates of a previous run start over
+    init_health(ctx)
+    process = ProcessService.start(ctx, additional_args)
+
+    severity_to_message(Severity.Success, (
+        f"{bold_str(ctx.name)} started with PID {process.pid}")
+    )
+    return process
+
+
+def wait_ready(started, timeout=READY_TIMEOUT):
+    """Waits up to ``timeout`` seconds until all ``started`` nodes
+    self-registered and, if they subscribe, subscribed to their topics.
+    """
+    deadline = time.monotonic() + timeout
+    pending = list(started)
+    while pending:
+        for ctx, process, subscribes in list(pending):
+            if ProcessService.is_ready(ctx, subscribes):
+                severity_to_message(
+                    Severity.Success, f"{bold_str(ctx.name)} is ready")
+            elif process.poll() is not None:
+                severity_to_message(Severity.Error, (
+                    f"{bold_str(ctx.name)} exited with code "
+                    f"{process.returncode} before it was ready"))
             else:
-                additional_args = node['with']
+                continue
+            pending.remove((ctx, process, subscribes))
 
-        ctx = NodeContext.from_descriptor(mesh, node)
+        if pending and time.monotonic() > deadline:
+            for ctx, _, _ in pending:
+                severity_to_message(Severity.Warning, (
+                    f"{bold_str(ctx.name)} is not ready after {timeout:g} s"
+                    ", continuing"))
+            return
+        if pending:
+            time.sleep(READY_INTERVAL)
 
-        if ProcessService.is_running(ctx):
-            severity_to_message(
-                Severity.Information, "Node still active")
-
-            stop_node(mesh, node)
 
-        process = ProcessService.start(ctx, additional_args)
+def stop_node(ctx, timeout=STOP_TIMEOUT):
+    stop_nodes([ctx], timeout)
 
-        severity_to_message(Severity.Success, (
-            f"{bold_str(node['name'])} started with PID {process.pid}")
-        )
 
+def stop_nodes(ctxs, timeout=STOP_TIMEOUT):
+    """Interrupts all nodes at once and waits for them to exit, such that
+    stopping takes as long as the slowest node rather than all of them.
+    """
+    stopping = []
+    for ctx in ctxs:
+        process = interrupt_node(ctx)
+        if process is not None:
+            stopping.append((ctx, process))
 
-def stop_node(mesh, node):
-    severity_to_message(
-        Severity.Information, f"Stopping node {bold_str(node['name'])}")
-
-    ctx = NodeContext.from_descriptor(mesh, node)
+    ProcessService.wait([process for _, process in stopping], timeout)
 
-    try:
-        ProcessService.stop(ctx)
+    for ctx, _ in stopping:
         init_health(ctx)
 
         severity_to_message(Severity.Success,
-                            f"{bold_str(node['name'])} stopped")
+                            f"{bold_str(ctx.name)} stopped")
+
+
+def interrupt_node(ctx):
+    severity_to_message(
+        Severity.Information, f"Stopping node {bold_str(ctx.name)}")
+
+    try:
+        return ProcessService.interrupt(ctx)
 
     except NodePIDNotFound:
         severity_to_message(Severity.Error,
-                            bold_str(node['name']) +
+                            bold_str(ctx.name) +
                             " did not self-register")
 
         severity_to_message(
@@ -126,48 +264,169 @@ def stop_node(mesh, node):
 
     except psutil.NoSuchProcess:
         severity_to_message(Severity.Warning,
-                            f"{bold_str(node['name'])} already stopped")
+                            f"{bold_str(ctx.name)} already stopped")
 
 
 @cli.command()
 @click.option('-s', '--select', default=None, multiple=True)
 @click.option('-x', '--exclude', default=[], multiple=True)
+@click.option('-t', '--timeout', default=STOP_TIMEOUT, type=float,
+              show_default=True,
+              help='Seconds a node gets to exit before it is terminated, '
+              'and again before it is killed')
 @click.argument('mesh')
-def stop(mesh: "str", select, exclude):
+def stop(mesh: "str", select, exclude, timeout):
     """Stop all nodes of mesh MESH"""
+    use_mesh_redis(mesh)
     redis_client = ensure_redis()
     nodes = safe_load_mesh(redis_client, mesh)
 
     entity_to_message(
         Entity.Mesh, mesh, "Stopping nodes")
 
+    ctxs = []
     for node in nodes:
         if select and node['name'] not in select:
             continue
         if node['name'] in exclude:
             continue
 
-        stop_node(mesh, node)
+        ctxs += NodeContext.replicas(mesh, node)
+
+    stop_nodes(ctxs, timeout)
 
 
 @cli.command()
 @click.argument('mesh')
-def show(mesh):
-    """Show health of mesh MESH"""
+@click.option('-w', '--window', default=str(DEFAULT_WINDOW),
+              type=click.Choice([str(window) for window in WINDOWS]),
+              help='Window in seconds over which throughput is averaged')
+@click.option('--watch', is_flag=True,
+              help='Refresh the health in place until interrupted')
+@click.option('-i', '--interval', default=WATCH_INTERVAL, type=float,
+              show_default=True, help='Seconds between refreshes of --watch')
+def show(mesh, window, watch, interval):
+    """Show health of mesh MESH. Replicated nodes are shown as a whole,
+    followed by their replicas."""
+    use_mesh_redis(mesh)
     redis_client = ensure_redis()
 
-    entity_to_message(
-        Entity.Mesh, mesh, 'Showing health')
-
-    pretty_table = PrettyTable()
-    pretty_table.field_names = map(
-        bold_str, ['Instance', 'Node', 'Activity', 'Lifetime', 'Throughput'])
+    nodes = [(node, NodeContext.replicas(mesh, node))
+             for node in safe_load_mesh(redis_client, mesh)]
+    reader = HealthReader(
+        redis_client, [ctx for _, replicas in nodes for ctx in replicas])
+
+    def health_table():
+        healths = iter(reader.read())
+        pretty_table = prettytable.PrettyTable()
+        pretty_table.field_names = map(bold_str, [
+            'Instance', 'Node', 'Activity', 'Lifetime', 'Throughput'])
+
+        for node, replicas in nodes:
+            replica_healths = [next(healths) for _ in replicas]
+            if 'replicas' in node:
+                pretty_table.add_row(get_replicas_health(
+                    node['name'], replicas, int(window), replica_healths))
+            for ctx, health in zip(replicas, replica_healths):
+                pretty_table.add_row(get_health(ctx, int(window), health))
+        return pretty_table
+
+    if not watch:
+        entity_to_message(
+            Entity.Mesh, mesh, 'Showing health')
+        print(health_table())
+        return
 
-    for node in safe_load_mesh(redis_client, mesh):
-        ctx = NodeContext.from_descriptor(mesh, node)
-        pretty_table.add_row(get_health(ctx))
-
-    print(pretty_table)
+    try:
+        while True:
+            table = health_table()
+            print(CLEAR_SCREEN, end='')
+            entity_to_message(
+                Entity.Mesh, mesh, f'Showing health every {interval:g} s')
+            print(table, flush=True)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command(name='bench')
+@click.option('-p', '--payload', 'payloads', multiple=True,
+              help='Payloads to sweep: bytes, dict or numpy (default: all)')
+@click.option('-s', '--size', 'sizes', multiple=True, type=int,
+              help='Payload sizes in bytes (default: 64, 4096, 65536)')
+@click.option('-t', '--topics', 'topic_counts', multiple=True, type=int,
+              help='Numbers of topics to publish to (default: 1, 8)')
+@click.option('-f', '--fanout', 'fanouts', multiple=True, type=int,
+              help='Numbers of subscribers (default: 1, 4)')
+@click.option('-c', '--codec', 'codecs', multiple=True,
+              help='Codecs to sweep (default: pickle)')
+@click.option('-n', '--messages', default=10000, type=int,
+              show_default=True, help='Messages to publish per scenario')
+@click.option('-r', '--rate', default=0., type=float,
+              help='Messages per second to publish at (default: as fast '
+              'as possible)')
+@click.option('-o', '--output', default='-', type=click.Path(),
+              help='File to write the JSON results to (default: stdout)')
+@click.option('-b', '--baseline', default=None, type=click.Path(exists=True),
+              help='JSON results to compare against, fails on regressions')
+@click.option('--tolerance', default=.1, type=float, show_default=True,
+              help='Fraction a metric may be worse than in --baseline')
+def bench_command(payloads, sizes, topic_counts, fanouts, codecs, messages,
+                  rate, output, baseline, tolerance):
+    """Benchmark publish and subscribe 🍋. Sweeps payloads, sizes, topic
+    counts, subscriber fan-out and codecs, running a publisher and the
+    subscribers as nodes against the local redis server, and reports msg/s,
+    MB/s and latency percentiles as JSON."""
+    # Keep stdout for the results if they are written there
+    progress = sys.stderr if output == '-' else sys.stdout
+    with contextlib.redirect_stdout(progress):
+        try:
+            report = run_bench(
+                bench.scenarios(
+                    payloads, sizes, topic_counts, fanouts, codecs),
+                messages, rate)
+        except bench.BenchFailureException as e:
+            severity_to_message(Severity.Error, f'Benchmark failed: {e}')
+            sys.exit(1)
+
+    if output == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    with contextlib.redirect_stdout(progress):
+        if output != '-':
+            severity_to_message(
+                Severity.Success, f'Results written to {bold_str(output)}')
+        if baseline:
+            with open(baseline) as file:
+                regressions = bench.compare(
+                    report['results'], json.load(file)['results'], tolerance)
+            for regression in regressions:
+                severity_to_message(
+                    Severity.Error, f'Regression: {regression}')
+            if regressions:
+                sys.exit(1)
+
+
+def run_bench(scenarios, messages, rate) -> "dict":
+    report = bench.environment(messages, rate)
+    report['results'] = []
+    for i, scenario in enumerate(scenarios):
+        severity_to_message(Severity.Information, (
+            f'[{i + 1}/{len(scenarios)}] ' + ', '.join(
+                f'{field} {bold_str(value)}'
+                for field, value in vars(scenario).items())))
+        result = bench.run_scenario(scenario, messages, rate)
+        report['results'].append(result)
+
+        transport = result['latency_us']['transport']
+        severity_to_message(Severity.Success, (
+            f"{result['msg_per_s']:g} msg/s, {result['mb_per_s']:g} MB/s, "
+            f"transport p50/p99 {transport['p50']}/{transport['p99']} us"
+            + (f", {result['lost']} lost" if result['lost'] else '')))
+    return report
 
 
 @cli.command()
@@ -244,12 +503,13 @@ PYBIND11_MODULE({package_name}_cpp, m)
 @click.argument('mesh')
 @click.argument('node')
 def log(mesh: "str", node: "str") -> None:
-    """Show logs for NODE in MESH"""
+    """Show logs for NODE in MESH (or one of its replicas)"""
+    use_mesh_redis(mesh)
     redis_client = ensure_redis()
     nodes = safe_load_mesh(redis_client, mesh)
 
     for node_ in nodes:
-        if node_['name'] == node:
-            ctx = NodeContext.from_descriptor(mesh, node_)
-            with LogFileService.open(ctx, 'r') as file:
-                print(''.join(file.readlines()))
+        for ctx in NodeContext.replicas(mesh, node_):
+            if node in (node_['name'], ctx.name):
+                with LogFileService.open(ctx, 'r') as file:
+                    print(''.join(file.readlines()))
@@ -1,17 +1,47 @@
 import asyncio
+import contextvars
 import pickle
 import sys
 import click
+from lemon.codecs import (
+    CODECS,
+    DEFAULT_CODEC,
+    Codec,
+    encode,
+    get_codec
+)
 from lemon.ctx import AsyncNodeContext
-from lemon.health import HealthService, NodeActivity
+from lemon.dispatch import (
+    DISPATCH_CONCURRENCY,
+    EXECUTORS,
+    MAX_QUEUED,
+    QUEUE_DEPTH,
+    Dispatcher,
+    Executors,
+    Offload,
+    Overflow,
+    Partition,
+    is_pattern
+)
+from lemon.health import (
+    HEALTH_INTERVAL,
+    HealthService,
+    NodeActivity,
+    health_id
+)
+from lemon.shm import SHM_ID, SHM_SIZE, MessageLost, SharedMemoryTransport
 from lemon.utils import (
     Entity,
     Severity,
     bold_str,
+    check_redis,
+    set_redis_url,
     severity_to_message,
     entity_to_message,
 )
-from lemon.system import ProcessService
+from lemon.streams import FIELD, STREAM_MAXLEN, StreamReceiver, stream_key
+from lemon.system import ProcessService, pid_id
+from lemon.tracing import add_sequence, add_trace, publisher_id
 import redis
 from redis.asyncio.client import PubSub
 
@@ -19,6 +49,22 @@ from redis.asyncio.client import PubSub
 class API:
     ctx: "AsyncNodeContext"
     health_service: "HealthService"
+    codec: "Codec" = DEFAULT_CODEC
+    topic_codecs: "dict[str, Codec]" = {}
+    shm: "SharedMemoryTransport" = SharedMemoryTransport()
+    transports: "dict[str, str]" = {}
+    stream_maxlens: "dict[str, int]" = {}
+    # Batch of the current task, see ``batch``
+    batch: "contextvars.ContextVar[Batch]" = contextvars.ContextVar(
+        'batch', default=None)
+    executors: "Executors" = Executors()
+    overflows: "dict[str, Overflow]" = {}
+    partition: "Partition" = None
+    partition_keys: "dict[str,]" = {}
+    # Id of the node in the trace headers of its messages, if tracing
+    publisher: "int" = None
+    # Number in the sequence header of the last message, if numbered
+    sequence: "int" = None
 
 
 def get_ctx() -> "AsyncNodeContext":
@@ -96,36 +142,110 @@ def entrypoint(fn):
     The ``click`` API allows an arbitrary composition of such
     options and additional CLI arguments.
 
+    The health of the node is reported to Lemon in the background every
+    ``--health-interval`` seconds (default: 1), rather than on every
+    message. ``--codec`` sets the default serialization of the node, see
+    :py:func:`lemon.api.set_codec`, and ``--shm-size`` the size in MB of
+    the shared memory used by :py:func:`lemon.api.set_transport`.
+    ``--threads``, ``--processes`` and ``--queue-depth`` configure
+    :py:func:`lemon.api.offload`. ``--replica`` and ``--replicas`` are set
+    by ``lemon start`` for nodes with ``replicas`` in the Lemonfile, see
+    :py:func:`lemon.api.set_partition_key`. ``--redis`` sets the URL of
+    the redis server, e.g., ``unix:///tmp/redis.sock``. It defaults to the
+    server of ``lemon start`` (``LEMON_REDIS_URL``). ``--trace`` turns on
+    :py:func:`lemon.api.set_tracing`. ``--sequence`` numbers the messages
+    of the node, which ``lemon start`` sets for meshes with replicated
+    nodes, see :py:func:`lemon.api.set_partition_key`.
+
     :param fn: Function to declare as the entrypoint.
     """
 
     @click.command()
     @click.argument('mesh')
     @click.option('-n', '--name', default=None)
-    def _entrypoint(mesh, name, *args, **kwargs):
+    @click.option('--health-interval', default=HEALTH_INTERVAL, type=float)
+    @click.option('--codec', default=DEFAULT_CODEC.name,
+                  type=click.Choice(list(CODECS)))
+    @click.option('--shm-size', default=SHM_SIZE // 2 ** 20, type=int)
+    @click.option('--threads', default=None, type=int)
+    @click.option('--processes', default=None, type=int)
+    @click.option('--queue-depth', default=QUEUE_DEPTH, type=int)
+    @click.option('--replica', default=0, type=int)
+    @click.option('--replicas', default=None, type=int)
+    @click.option('--redis', 'redis_url', default=None)
+    @click.option('--trace', is_flag=True)
+    @click.option('--sequence', is_flag=True)
+    def _entrypoint(mesh, name, health_interval, codec, shm_size, threads,
+                    processes, queue_depth, replica, replicas, redis_url,
+                    trace, sequence, *args, **kwargs):
         node = sys.argv[0].split('/')[-1]
         name = node if not name else name
+        if redis_url:
+            set_redis_url(redis_url)
         API.ctx = AsyncNodeContext(mesh, name, node)
-        API.health_service = HealthService()
+        # Also for a single replica, whose name has a suffix nevertheless
+        if replicas is not None:
+            API.partition = Partition(
+                name.removesuffix(f'-{replica}'), replica, replicas,
+                API.partition_keys)
+        API.health_service = HealthService(health_interval)
+        API.shm = SharedMemoryTransport(shm_size * 2 ** 20)
+        API.executors = Executors(threads, processes, queue_depth)
+        set_codec(codec)
+        set_tracing(trace)
+        API.sequence = 0 if sequence else None
+
+        async def main():
+            API.health_service.start(API.ctx)
+            await fn(*args, **kwargs)
 
         async def cleanup():
             print()
+            API.health_service.stop()
+            API.executors.shutdown()
+            API.shm.close()
             await API.health_service.update(API.ctx, NodeActivity.SHUTDOWN)
-            await API.ctx.redis_client.close()
+            await API.ctx.redis_client.close(close_connection_pool=True)
 
-        run_node(fn(*args, **kwargs), cleanup())
+        run_node(main(), cleanup())
     return _entrypoint
 
 
-async def update_subscribe(pubsub_client: "PubSub", topic_to_fn):
-    message = await pubsub_client.get_message(True)
-    if message:
-        callback = topic_to_fn[message['channel'].decode('utf8')]
-        await callback(pickle.loads(message['data']))
-        await API.health_service.update(API.ctx, NodeActivity.ACTIVE)
+SUBSCRIBE_TIMEOUT = 1.0
+RECONNECT_DELAY = .01
+RECONNECT_MAX_DELAY = 10.0
+TRANSPORTS = ('redis', 'shm', 'stream')
 
 
-async def subscribe(topic_to_fn: "dict[str,]"):
+async def update_subscribe(pubsub_client: "PubSub", dispatcher: "Dispatcher",
+                           timeout: "float" = SUBSCRIBE_TIMEOUT):
+    message = await pubsub_client.get_message(
+        ignore_subscribe_messages=True, timeout=timeout)
+    if message:
+        topic = message['channel'].decode('utf8')
+        data = message['data']
+        # A channel that matches several subscriptions is received once
+        # per subscription, but only handled for the one it is routed to
+        route = dispatcher.router.route(topic)
+        subscription = message.get('pattern') or message['channel']
+        if route is None or route != subscription.decode('utf8'):
+            return
+        partition = dispatcher.partition
+        if partition is not None and not partition.owns(route, data):
+            if partition.lost(route, data):
+                API.health_service.dropped(topic)
+            return
+        if data[0] == SHM_ID:
+            try:
+                data = API.shm.unwrap(data)
+            except MessageLost:
+                API.health_service.dropped(topic)
+                return
+        await dispatcher.dispatch(topic, data)
+
+
+async def subscribe(topic_to_fn: "dict[str,]",
+                    concurrency: "int" = DISPATCH_CONCURRENCY):
     """*Subscribe* function to register a set of topic-to-callback pairs
     for subscription. It is important to subscribe to every topic at once
     via this function, so that the asynchronous processing can kick in.
@@ -142,37 +262,214 @@ async def subscribe(topic_to_fn: "dict[str,]"):
 
     listens to the *image* topic and calls ``image_hook`` on new messages.
 
+    Topics may also be glob-style patterns as in redis' ``PSUBSCRIBE``:
+    ``*`` matches any characters (including ``/``), ``?`` a single character
+    and ``[...]`` a set of characters, e.g.:
+
+    .. highlight:: python
+    .. code-block:: python
+
+        await subscribe({'/camera/*': image_hook})
+
+    Every matching topic is still handled in order on its own. A topic is
+    handled by only one callback: a topic given by name takes precedence
+    over patterns, and otherwise the first matching pattern (in the order of
+    ``topic_to_fn``) is used. :py:func:`lemon.api.set_overflow` and
+    :py:func:`lemon.api.set_partition_key` accept patterns as well, while
+    the ``stream`` transport only supports topics given by name.
+
+    Callbacks of different topics run concurrently, so a slow callback on
+    one topic does not hold up the others (e.g., parameter updates).
+    Messages of the same topic are still processed one at a time and in
+    order. Messages that wait for their callback are shown as *queued* in
+    ``lemon show``.
+
     It might happen that your node is processing incoming events too slowly.
     In this case the subscription will successively drop events until
-    it can keep up with the event stream.
+    it can keep up with the event stream: by default, at most 1000 messages
+    wait per topic and the oldest ones are dropped beyond that. See
+    :py:func:`lemon.api.set_overflow` for other policies. Dropped messages
+    are counted in ``lemon show``.
+
+    If the node has ``replicas`` in the Lemonfile, each message is
+    processed by only one of its replicas, see
+    :py:func:`lemon.api.set_partition_key`.
+
+    Once the node is subscribed to all topics, it reports so to Lemon,
+    such that ``lemon start`` starts the nodes that publish to the ``in``
+    topics of the node only afterwards.
 
     :param topic_to_fn: Mapping of topics to callback.
+    :param concurrency: Maximum number of callbacks running at the same
+        time.
     """
-    pubsub_client = API.ctx.redis_client.pubsub()
-    await pubsub_client.subscribe(*topic_to_fn.keys())
+    dispatcher = Dispatcher(topic_to_fn, API.health_service, concurrency,
+                            API.overflows, API.partition)
+    API.health_service.watch_queues(dispatcher.depths)
+
+    stream_topics = [topic for topic in topic_to_fn
+                     if API.transports.get(topic) == 'stream']
+    pubsub_topics = [topic for topic in topic_to_fn
+                     if topic not in stream_topics]
+    # Replicas share a consumer group, which hands every entry to one of
+    # them, unless they partition the topic by key
+    shared_topics = []
+    if API.partition is not None:
+        shared_topics = [topic for topic in stream_topics
+                         if topic not in API.partition_keys]
+        stream_topics = [topic for topic in stream_topics
+                         if topic not in shared_topics]
 
-    count = 0
-    nth_message = 1
+    loop = asyncio.get_event_loop()
+    receivers, subscribed = [], []
+    if pubsub_topics:
+        subscribed.append(asyncio.Event())
+        receivers.append(loop.create_task(
+            receive_pubsub(pubsub_topics, dispatcher, subscribed[-1])))
+    if stream_topics:
+        subscribed.append(asyncio.Event())
+        receivers.append(loop.create_task(
+            receive_streams(stream_topics, dispatcher,
+                            subscribed=subscribed[-1])))
+    if shared_topics:
+        group = f'{API.ctx.mesh}:{API.partition.name}'
+        subscribed.append(asyncio.Event())
+        receivers.append(loop.create_task(
+            receive_streams(shared_topics, dispatcher, group,
+                            subscribed[-1])))
+    receivers.append(loop.create_task(announce_subscribed(subscribed)))
+    if API.partition is not None and (pubsub_topics or stream_topics):
+        receivers.append(loop.create_task(
+            watch_replicas(API.partition, API.health_service.interval)))
 
     await API.health_service.update(API.ctx, NodeActivity.ACTIVE)
+    try:
+        done, _ = await asyncio.wait(
+            receivers, return_when=asyncio.FIRST_EXCEPTION)
+        for receiver in done:
+            receiver.result()
+    finally:
+        for receiver in receivers:
+            receiver.cancel()
+        dispatcher.close()
+
+
+async def announce_subscribed(subscribed: "list[asyncio.Event]"):
+    """Lets ``lemon start`` know that the node is subscribed to all of its
+    topics once every receiver in ``subscribed`` is.
+    """
+    for event in subscribed:
+        await event.wait()
+    await ProcessService.mark_subscribed(API.ctx)
+
+
+async def watch_replicas(partition: "Partition", interval: "float"):
+    """Updates which replicas of ``partition`` are ``live`` every
+    ``interval`` seconds, i.e., were started and did not exit, such that
+    messages assigned to the others are counted as dropped.
+    """
+    ctxs = [AsyncNodeContext(API.ctx.mesh, f'{partition.name}-{i}',
+                             API.ctx.node)
+            for i in range(partition.count)]
+    while True:
+        pipeline = API.ctx.redis_client.pipeline(transaction=False)
+        for ctx in ctxs:
+            pipeline.hget(health_id(ctx), 'activity')
+            pipeline.get(pid_id(ctx))
+        try:
+            values = await pipeline.execute()
+        except redis.exceptions.ConnectionError:
+            # Reconnected by the receivers
+            values = None
+        if values is not None:
+            partition.live = {
+                i for i, (activity, pid) in enumerate(
+                    zip(values[::2], values[1::2]))
+                if i == partition.index or (
+                    activity != NodeActivity.SHUTDOWN.name.encode('utf8')
+                    and pid is not None
+                    and ProcessService.pid_exists(int(pid)))}
+        await asyncio.sleep(interval)
+
+
+async def reconnect():
+    """Waits until the redis server is reachable again, backing off from
+    ``RECONNECT_DELAY`` to ``RECONNECT_MAX_DELAY`` seconds between checks,
+    and renews the client of the node.
+    """
+    delay = RECONNECT_DELAY
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            await check_redis()
+            break
+        except redis.exceptions.ConnectionError:
+            delay = min(2 * delay, RECONNECT_MAX_DELAY)
+    API.ctx.renew()
+
+
+async def subscribe_pubsub(topics: "list[str]") -> "PubSub":
+    pubsub_client = API.ctx.redis_client.pubsub()
+    patterns = [topic for topic in topics if is_pattern(topic)]
+    names = [topic for topic in topics if not is_pattern(topic)]
+    if names:
+        await pubsub_client.subscribe(*names)
+    if patterns:
+        await pubsub_client.psubscribe(*patterns)
+    return pubsub_client
+
+
+async def receive_pubsub(topics: "list[str]", dispatcher: "Dispatcher",
+                         subscribed: "asyncio.Event" = None):
+    pubsub_client = await subscribe_pubsub(topics)
+    if subscribed is not None:
+        subscribed.set()
+
+    while True:
+        try:
+            # Blocks on the socket for up to ``SUBSCRIBE_TIMEOUT`` seconds,
+            # so an idle subscriber does not consume any CPU.
+            await update_subscribe(
+                pubsub_client, dispatcher, SUBSCRIBE_TIMEOUT)
+        except redis.exceptions.ConnectionError:
+            await reconnect()
+            pubsub_client = await subscribe_pubsub(topics)
+
+        dispatcher.raise_for_error()
+
+        # Let the callbacks run between messages under sustained load.
+        await asyncio.sleep(0)
+
+
+async def receive_streams(topics: "list[str]", dispatcher: "Dispatcher",
+                          group: "str" = None,
+                          subscribed: "asyncio.Event" = None):
+    receiver = StreamReceiver(API.ctx, topics, dispatcher, group)
+    started = False
+
     while True:
-        await asyncio.sleep(1e-9)
         try:
-            await update_subscribe(pubsub_client, topic_to_fn)
+            if not started:
+                await receiver.start()
+                started = True
+                if subscribed is not None:
+                    subscribed.set()
+            await receiver.update(SUBSCRIBE_TIMEOUT)
         except redis.exceptions.ConnectionError:
-            API.ctx.renew()
-            pubsub_client = API.ctx.redis_client.pubsub()
-            await pubsub_client.subscribe(*topic_to_fn.keys())
-            nth_message += 1
+            await reconnect()
+            receiver.ctx = API.ctx
+            started = False
 
-        count += 1
+        dispatcher.raise_for_error()
+        await asyncio.sleep(0)
 
 
 async def publish(topic, value):
     """*Publish* function with a hooked-in redis client. Allows for users
     to call stateless (i.e., no init required), but does not require to set
-    up redis client for a every call. The ``value`` is pickled before
-    transmission and can therefore assume any valid python object.
+    up redis client for a every call. By default, the ``value`` is pickled
+    before transmission and can therefore assume any valid python object.
+    See :py:func:`lemon.api.set_codec` for other serializations.
 
     **Example**
 
@@ -186,11 +483,413 @@ async def publish(topic, value):
             for i in range(10):
                 await publish('number', i)
 
+    Inside of :py:func:`lemon.api.batch`, messages are queued and sent in
+    batches instead.
+
     :param topic: Topic to publish to.
     :param value: Value to publish. Can be any python object.
     """
-    await API.health_service.update(API.ctx, NodeActivity.ACTIVE)
-    await API.ctx.redis_client.publish(topic, pickle.dumps(value))
+    data = prepare_message(topic, value)
+    batch = API.batch.get()
+    if batch is not None:
+        await batch.add(topic, data)
+    else:
+        await send_message(API.ctx.redis_client, topic, data)
+
+
+def prepare_message(topic, value) -> "bytes":
+    data = encode(value, API.topic_codecs.get(topic, API.codec))
+    API.health_service.sent(topic, len(data))
+    if API.sequence is not None:
+        API.sequence = (API.sequence + 1) % 2 ** 32
+        data = add_sequence(data, API.sequence)
+    if API.publisher is not None:
+        data = add_trace(data, API.publisher)
+    if API.transports.get(topic) == 'shm':
+        data = API.shm.wrap(data)
+    return data
+
+
+def send_message(client, topic: "str", data: "bytes"):
+    """Sends ``data`` with ``client``, which may also be a pipeline."""
+    if API.transports.get(topic) == 'stream':
+        return client.xadd(
+            stream_key(topic), {FIELD: data},
+            maxlen=API.stream_maxlens.get(topic, STREAM_MAXLEN))
+    return client.publish(topic, data)
+
+
+async def send_messages(messages: "list[tuple[str, bytes]]"):
+    pipeline = API.ctx.redis_client.pipeline(transaction=False)
+    for topic, data in messages:
+        send_message(pipeline, topic, data)
+    await pipeline.execute()
+
+
+async def publish_many(messages):
+    """Publishes many messages at once, in a single round-trip to redis.
+    Messages are sent in the given order.
+
+    **Example**
+
+    .. highlight:: python
+    .. code-block:: python
+
+        await publish_many([('number', i) for i in range(1000)])
+
+    :param messages: Iterable of ``(topic, value)`` pairs, see
+        :py:func:`lemon.api.publish`.
+    """
+    prepared = [(topic, prepare_message(topic, value))
+                for topic, value in messages]
+    if prepared:
+        await send_messages(prepared)
+
+
+BATCH_SIZE = 100
+BATCH_DELAY = 1e-2
+
+
+class Batch:
+    """Queue of prepared messages that is sent once it holds ``max_size``
+    messages or ``max_delay`` seconds after its first message, whichever
+    happens first. If sending fails after the delay, the error is raised
+    by the next call to :py:meth:`add` or :py:meth:`flush`.
+    """
+
+    def __init__(self, max_size: "int", max_delay: "float"):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.messages = []
+        self.timer = None
+        self.token = None
+        self.error = None
+
+    def raise_error(self):
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    async def add(self, topic: "str", data: "bytes"):
+        self.raise_error()
+        self.messages.append((topic, data))
+        if len(self.messages) >= self.max_size:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().create_task(
+                self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self.timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # Nobody awaits the timer, raised by the next add or flush
+            self.error = e
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        messages, self.messages = self.messages, []
+        if messages:
+            await send_messages(messages)
+        self.raise_error()
+
+    async def __aenter__(self) -> "Batch":
+        self.token = API.batch.set(self)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        API.batch.reset(self.token)
+        await self.flush()
+
+
+def batch(max_size: "int" = BATCH_SIZE,
+          max_delay: "float" = BATCH_DELAY) -> "Batch":
+    """Batches all calls to :py:func:`lemon.api.publish` within its context,
+    so that existing publishing loops can send many messages per round-trip
+    to redis without being restructured. Messages keep their order and are
+    sent at the latest when the context is left. Only the task that
+    entered the context (and tasks it starts within) is batched, so that
+    concurrent publishers, e.g., callbacks of
+    :py:func:`lemon.api.subscribe`, are not held up.
+
+    **Example**
+
+    .. highlight:: python
+    .. code-block:: python
+
+        async with batch(max_size=500, max_delay=.05):
+            for message in replay:
+                await publish('/dvs/events', message)
+
+    :param max_size: Number of queued messages that triggers sending them.
+    :param max_delay: Maximum time in seconds a message is queued.
+    """
+    return Batch(max_size, max_delay)
+
+
+def set_overflow(policy: "str", *topics, max_queued: "int" = MAX_QUEUED):
+    """Sets what :py:func:`lemon.api.subscribe` does with messages of the
+    given ``topics`` that arrive faster than their callback processes them.
+    Must be called before :py:func:`lemon.api.subscribe`.
+
+    **Example**
+
+    .. highlight:: python
+    .. code-block:: python
+
+        set_overflow('latest', '/dvs/image')
+        set_overflow('drop-oldest', '/dvs/events', max_queued=100)
+        set_overflow('block', '/commands')
+
+    * ``latest`` only keeps the newest message that waits, i.e., the
+      callback always receives the most recent state (conflation).
+    * ``drop-oldest`` keeps up to ``max_queued`` messages and drops the
+      oldest ones beyond that. This is the default.
+    * ``block`` keeps up to ``max_queued`` messages and stops receiving
+      messages of all topics of the node until there is space again, such
+      that no message is dropped by the node. Redis buffers the messages in
+      the meantime, and disconnects the node if it falls too far behind.
+
+    :param policy: One of ``latest``, ``drop-oldest`` or ``block``.
+    :param topics: Topics to set the policy for.
+    :param max_queued: Maximum number of waiting messages per topic.
+    """
+    overflow = Overflow(policy, max_queued)
+    for topic in topics:
+        API.overflows[topic] = overflow
+
+
+def offload(fn, executor: "str" = 'thread', publish_to: "str" = None,
+            queue_depth: "int" = None):
+    """Wraps ``fn`` into a callback for :py:func:`lemon.api.subscribe` that
+    runs on a pool of the node rather than on its event loop, so that
+    CPU-bound work (NumPy, pybind11 extensions) does not stall the receipt
+    of messages. If ``publish_to`` is given, everything ``fn`` returns
+    (except ``None``) is published to that topic.
+
+    **Example**
+
+    .. highlight:: python
+    .. code-block:: python
+
+        def normalize(image):
+            ...
+            return normalized
+
+        await subscribe({
+            '/dvs/image': offload(
+                normalize, 'process', publish_to='/dvs/normalized')
+        })
+
+    With ``thread`` or ``process``, up to ``queue_depth`` messages of the
+    topic are processed at the same time; results are nevertheless
+    published in the order the messages arrived. For ``process``, ``fn``
+    and its argument and result must be picklable, i.e., ``fn`` must be
+    defined at module level. The pool sizes are set with ``--threads`` and
+    ``--processes`` on the CLI of the node, e.g. via ``with`` in the
+    Lemonfile.
+
+    :param fn: Function to call with every message. For ``inline``, this
+        can also be a coroutine function.
+    :param executor: One of ``inline``, ``thread`` or ``process``.
+    :param publish_to: Topic to publish the results of ``fn`` to.
+    :param queue_depth: Maximum number of messages processed at the same
+        time. Defaults to ``--queue-depth`` (default: 1).
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f'Unknown executor {executor}')
+
+    return Offload(fn, API.executors.get(executor), publish_to,
+                   queue_depth or API.executors.queue_depth, publish)
+
+
+def set_codec(codec: "str", *topics):
+    """Sets the serialization codec used by :py:func:`lemon.api.publish`,
+    either for the given ``topics`` or, if no topics are given, for the
+    whole node. The codec is recorded in every message, so subscribers
+    decode it automatically.
+
+    **Example**
+
+    .. highlight:: python
+    .. code-block:: python
+
+        set_codec('pickle5')
+        set_codec('raw', '/camera/jpeg')
+
+    pickles all messages with protocol 5, except for those on
+    ``/camera/jpeg``, which are expected to be ``bytes`` already and are
+    passed through as-is.
+
+    Available codecs are ``pickle`` (default), ``pickle5``, ``raw``,
+    ``marshal``, ``json``, ``pickle5-oob`` and ``msgpack`` (if installed).
+    Further codecs can be added with :py:func:`lemon.codecs.register_codec`.
+
+    ``pickle5-oob`` is meant for large NumPy arrays: their data is sent
+    out-of-band, next to the pickle, and the subscriber receives the arrays
+    as read-only views into the received message rather than as copies.
+
+    :param codec: Name of the codec.
+    :param topics: Topics to use the codec for. Defaults to all topics.
+    """
+    resolved = get_codec(codec)
+    if not topics:
+        API.codec = resolved
+    for topic in topics:
+        API.topic_codecs[topic] = resolved
+
+
+def set_tracing(enabled: "bool" = True):
+    """Adds a trace header (the time it was sent and the id of the node) to
+    every message the node publishes from now on, or stops doing so. For
+    traced messages, subscribers record per topic how long the message took
+    from :py:func:`lemon.api.publish` to the subscriber (``transport``), how
+    long it waited for its callback (``queue``) and how long the callback
+    ran (``handler``). Their 50th and 99th percentile and maximum are shown
+    in ``lemon show`` and returned by :py:func:`lemon.api.get_latencies`.
+
+    **Example**
+
+    .. highlight:: python
+    .. code-block:: python
+
+        @entrypoint
+        async def start():
+            set_tracing()
+            ...
+
+    The header adds 13 bytes to every message. Subscribers do not need to
+    be configured and untraced messages are not timed at all, so tracing
+    costs nothing while it is off. Nodes started with ``--trace`` trace from
+    the start. Latencies across nodes are only meaningful on one host (or
+    with synchronized clocks).
+
+    :param enabled: Whether to trace the messages of this node.
+    """
+    API.publisher = None
+    if enabled:
+        API.publisher = publisher_id(API.ctx.mesh, API.ctx.name)
+
+
+def get_latencies() -> "dict[str, dict[str, dict[str, float]]]":
+    """Returns the latencies of the traced messages this node received
+    since it started, see :py:func:`lemon.api.set_tracing`, as
+
+    .. highlight:: python
+    .. code-block:: python
+
+        {'topic': {'transport': {'p50': ..., 'p99': ..., 'max': ...,
+                                 'count': ...}, 'queue': ..., 'handler': ...}}
+
+    with latencies in seconds.
+    """
+    return {
+        topic: {
+            kind: {stat: value if stat == 'count' else value / 1e6
+                   for stat, value in summary.items()}
+            for kind, summary in kinds.items()}
+        for topic, kinds in API.health_service.latencies().items()}
+
+
+def set_transport(transport: "str", *topics,
+                  maxlen: "int" = STREAM_MAXLEN):
+    """Sets how messages on the given ``topics`` are moved between nodes.
+    By default (``redis``), every message passes through the redis server
+    via pub/sub. With ``shm``, messages larger than 64 kB are written into
+    a shared memory ring buffer of the publishing node, and redis only
+    carries a small descriptor of the message. With ``stream``, messages
+    are appended to a redis stream.
+
+    **Example**
+
+    .. highlight:: python
+    .. code-block:: python
+
+        set_transport('shm', '/dvs/image', '/dvs/time_map')
+        set_transport('stream', '/dvs/events', maxlen=100000)
+
+    Shared memory only works if all subscribers of the topics run on the
+    same host as the publisher, which is the case for all nodes started
+    with ``lemon start``. The ring buffer is reused once it is full, so a
+    subscriber that falls behind by more than the size of the ring
+    (``--shm-size``) loses messages rather than reading corrupted data.
+    Lost messages are reported by ``lemon show``.
+
+    Streams keep the latest ``maxlen`` (approximately) messages of a topic
+    in redis. Each subscribing node reads them in a consumer group of its
+    own (shared by the replicas of a node) and acknowledges every message
+    once its callback finished. A node that is restarted therefore
+    continues where it left off, including messages that were sent while it
+    was down and messages it received but did not finish processing. Unless
+    set otherwise with :py:func:`lemon.api.set_overflow`, a node stops
+    reading a stream while its callback is behind (``block``). Messages
+    dropped by another policy are counted as dropped and acknowledged.
+    Publishers *and* subscribers of a topic need to set the ``stream``
+    transport.
+
+    :param transport: One of ``redis``, ``shm`` or ``stream``.
+    :param topics: Topics to use the transport for.
+    :param maxlen: Maximum length of the streams of ``topics``.
+    """
+    if transport not in TRANSPORTS:
+        raise ValueError(f'Unknown transport {transport}')
+
+    for topic in topics:
+        API.transports[topic] = transport
+        if transport == 'stream':
+            API.stream_maxlens[topic] = maxlen
+
+
+def set_partition_key(key, *topics):
+    """Sets how the replicas of a node split the messages of the given
+    ``topics`` among themselves. Must be called before
+    :py:func:`lemon.api.subscribe`.
+
+    **Example**
+
+    .. code-block:: yaml
+
+        - name: tracker
+          from: ./tracker
+          replicas: 4
+
+    .. highlight:: python
+    .. code-block:: python
+
+        set_partition_key(lambda event: event.camera_id, '/dvs/events')
+
+    ``lemon start`` launches the four instances ``tracker-0`` to
+    ``tracker-3``. Each message on the topics the node subscribes to is
+    processed by exactly one of them, while parameters reach all of them.
+    By default, messages are assigned by a hash of their contents, so
+    their order is only kept within a replica. ``lemon start`` has all
+    nodes of a mesh with replicas number their messages (``--sequence``),
+    which is part of the hash, such that equal messages are spread as well.
+    Equal messages of other publishers (e.g., nodes started by hand without
+    ``--sequence``) are all processed by the same replica. With a key
+    function, all messages with the same key are processed by the same
+    replica, in the order they were published.
+
+    All replicas receive (but do not process) all messages via pub/sub, and
+    to assign them by key, each replica also decodes every message. Without
+    a key function, the replicas share a consumer group on topics with the
+    ``stream`` transport instead, so each entry is only read by one replica,
+    see :py:func:`lemon.api.set_transport`. A message that is assigned to a
+    replica that is not running is not processed by any replica. Such
+    messages are counted as dropped (by the first running replica) in
+    ``lemon show``, with a delay of up to the health interval after a
+    replica started or exited.
+
+    :param key: Function that returns the key of a message value. The key
+        must have a stable ``repr``, e.g., a string or an integer.
+    :param topics: Topics to partition by key.
+    """
+    for topic in topics:
+        API.partition_keys[topic] = key
 
 
 async def parameter(name, value, fn, shared=False):
@@ -225,7 +924,8 @@ async def parameter(name, value, fn, shared=False):
     :param shared: Parameters can be shared across a mesh. Set ``shared`` to
         True if you want to use these kinds of global variables.
     """
-    private_id = f'{API.ctx.name}:' if not shared else ''
+    name_ = API.partition.name if API.partition else API.ctx.name
+    private_id = f'{name_}:' if not shared else ''
 
     topic = f'!param:{API.ctx.mesh}:{private_id}{name}'
     await API.ctx.redis_client.set(topic, pickle.dumps(value))
@@ -235,10 +935,16 @@ async def parameter(name, value, fn, shared=False):
 
 async def anyone_listening(*topics) -> "bool":
     """Helper function to determine whether the given topic has at least
-    one subscriber.
+    one subscriber. Redis does not tell which patterns are subscribed to
+    (see :py:func:`lemon.api.subscribe`), so while any pattern is, the
+    topics are assumed to be subscribed to as well.
 
     :param topics: Topics to check. Returns true if any of the topics is
         subscribed to.
     """
-    numsub = await API.ctx.redis_client.pubsub_numsub(*topics)
-    return any([num for _, num in numsub])
+    redis_client = API.ctx.redis_client
+    numsub = await redis_client.pubsub_numsub(*topics)
+    if any([num for _, num in numsub]):
+        return True
+    # ``PUBSUB NUMSUB`` does not count subscribers of patterns
+    return await redis_client.pubsub_numpat() > 0
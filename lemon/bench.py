@@ -0,0 +1,330 @@
+import asyncio
+from dataclasses import asdict, dataclass
+from importlib import metadata
+import importlib.util
+import itertools
+import multiprocessing
+import platform
+import queue
+import time
+from lemon.api import API, publish, set_codec, set_tracing, subscribe
+from lemon.codecs import UnknownCodecException, encode, get_codec
+from lemon.ctx import AsyncNodeContext, NodeContext
+from lemon.health import HealthService
+from lemon.system import ProcessService
+from lemon.tracing import LATENCIES, TRACE_HEADER, LatencyHistogram
+from lemon.utils import ensure_redis, get_redis_url
+
+# Publishers and subscribers of ``lemon bench`` are nodes of this mesh,
+# which should not clash with a Lemonfile
+BENCH_MESH = '!bench'
+BENCH_NODE = 'bench'
+
+# Default sweep of ``lemon bench``
+PAYLOADS = ('bytes', 'dict', 'numpy')
+SIZES = (64, 4096, 65536)
+TOPIC_COUNTS = (1, 8)
+FANOUTS = (1, 4)
+CODECS = ('pickle',)
+MESSAGES = 10000
+
+# Seconds subscribers get to subscribe, wait for the first message and
+# then for each further message before they count the rest as lost
+READY_TIMEOUT = 30.0
+START_TIMEOUT = 30.0
+IDLE_TIMEOUT = 2.0
+POLL_INTERVAL = 1e-2
+
+# Metrics compared against a baseline by ``lemon bench --baseline``, and
+# whether higher values are better
+METRICS = {
+    'msg_per_s': True,
+    'latency_us.transport.p99': False,
+}
+
+
+class BenchFailureException(Exception):
+    pass
+
+
+@dataclass
+class Scenario:
+    payload: "str"
+    size: "int"
+    topics: "int"
+    fanout: "int"
+    codec: "str"
+
+
+def scenarios(payloads=(), sizes=(), topic_counts=(), fanouts=(),
+              codecs=()) -> "list[Scenario]":
+    """Returns every combination of the given sweep values, using the
+    defaults for the ones that are empty. The default payloads only include
+    ``numpy`` if it is installed.
+    """
+    has_numpy = importlib.util.find_spec('numpy') is not None
+    payloads = payloads or tuple(
+        payload for payload in PAYLOADS if has_numpy or payload != 'numpy')
+    codecs = codecs or CODECS
+    for payload in payloads:
+        if payload not in PAYLOADS:
+            raise BenchFailureException(f'Unknown payload {payload}')
+    if 'numpy' in payloads and not has_numpy:
+        raise BenchFailureException('The numpy payload requires numpy')
+    for codec in codecs:
+        try:
+            get_codec(codec)
+        except UnknownCodecException:
+            raise BenchFailureException(f'Unknown codec {codec}')
+    return [Scenario(*values) for values in itertools.product(
+        payloads, sizes or SIZES, topic_counts or TOPIC_COUNTS,
+        fanouts or FANOUTS, codecs)]
+
+
+def make_payload(kind: "str", size: "int"):
+    """Returns a message of roughly ``size`` bytes: bytes, a flat dict of
+    floats or a NumPy array of float64.
+    """
+    if kind == 'bytes':
+        return b'\x00' * size
+    if kind == 'dict':
+        return {f'field{i}': float(i) for i in range(max(1, size // 16))}
+    import numpy
+    return numpy.zeros(max(1, size // 8))
+
+
+def bench_topics(scenario: "Scenario") -> "list[str]":
+    return [f'{BENCH_MESH}:{i}' for i in range(scenario.topics)]
+
+
+def init_node(name: "str", codec: "str"):
+    """Sets up the API of this process as ``entrypoint`` would, without
+    reporting health in the background.
+    """
+    API.ctx = AsyncNodeContext(BENCH_MESH, name, BENCH_NODE)
+    API.health_service = HealthService()
+    set_codec(codec)
+
+
+async def receive(name: "str", scenario: "Scenario", messages: "int"):
+    init_node(name, scenario.codec)
+    await ProcessService.self_register(API.ctx)
+    received, last = 0, None
+
+    async def on_message(value):
+        nonlocal received, last
+        received += 1
+        last = time.time()
+
+    task = asyncio.get_event_loop().create_task(subscribe({
+        topic: on_message for topic in bench_topics(scenario)}))
+    started = time.time()
+    while received < messages:
+        await asyncio.sleep(POLL_INTERVAL)
+        if task.done():
+            task.result()
+        if last is None and time.time() - started > START_TIMEOUT:
+            break
+        if last is not None and time.time() - last > IDLE_TIMEOUT:
+            break
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+    # Latencies of all topics, merged per kind
+    histograms = {kind: LatencyHistogram() for kind in LATENCIES}
+    for (_, kind), histogram in API.health_service.histograms.items():
+        histograms[kind].merge(histogram)
+    await API.ctx.redis_client.close(close_connection_pool=True)
+    return {'received': received, 'last': last, 'latency': histograms}
+
+
+async def send(scenario: "Scenario", messages: "int", rate: "float"):
+    init_node('publisher', scenario.codec)
+    set_tracing()
+    payload = make_payload(scenario.payload, scenario.size)
+    topics = bench_topics(scenario)
+
+    start = time.time()
+    for i in range(messages):
+        if rate:
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await publish(topics[i % len(topics)], payload)
+    end = time.time()
+    await API.ctx.redis_client.close(close_connection_pool=True)
+    return {'start': start, 'end': end}
+
+
+def run_subscriber(name, scenario, messages, results):
+    results.put((name, asyncio.run(receive(name, scenario, messages))))
+
+
+def run_publisher(scenario, messages, rate, results):
+    results.put(('publisher', asyncio.run(send(scenario, messages, rate))))
+
+
+def clear(redis_client):
+    keys = redis_client.keys(f'{BENCH_MESH}:*')
+    if keys:
+        redis_client.delete(*keys)
+
+
+def wait_subscribed(processes: "dict[str, multiprocessing.Process]"):
+    deadline = time.monotonic() + READY_TIMEOUT
+    pending = dict(processes)
+    while pending:
+        for name, process in list(pending.items()):
+            ctx = NodeContext(BENCH_MESH, name, BENCH_NODE)
+            if ProcessService.is_ready(ctx, True):
+                del pending[name]
+            elif not process.is_alive():
+                raise BenchFailureException(
+                    f'{name} exited with code {process.exitcode}')
+        if pending and time.monotonic() > deadline:
+            raise BenchFailureException(
+                f'{", ".join(pending)} not subscribed after '
+                f'{READY_TIMEOUT:g} s')
+        if pending:
+            time.sleep(POLL_INTERVAL)
+
+
+def collect(results, processes: "dict[str, multiprocessing.Process]"):
+    outcome = {}
+    while len(outcome) < len(processes):
+        try:
+            name, result = results.get(timeout=POLL_INTERVAL)
+            outcome[name] = result
+        except queue.Empty:
+            for name, process in processes.items():
+                if name not in outcome and process.exitcode:
+                    raise BenchFailureException(
+                        f'{name} exited with code {process.exitcode}')
+    return outcome
+
+
+def summarize(scenario: "Scenario", messages: "int", outcome: "dict"):
+    publisher = outcome.pop('publisher')
+    subscribers = list(outcome.values())
+    delivered = sum(result['received'] for result in subscribers)
+    last = max((result['last'] for result in subscribers
+                if result['last'] is not None), default=publisher['end'])
+    duration = max(last - publisher['start'], 1e-9)
+    nbytes = TRACE_HEADER.size + len(encode(
+        make_payload(scenario.payload, scenario.size),
+        get_codec(scenario.codec)))
+
+    latency = {}
+    for kind in LATENCIES:
+        histogram = LatencyHistogram()
+        for result in subscribers:
+            histogram.merge(result['latency'][kind])
+        latency[kind] = histogram.summary()
+
+    return {
+        **asdict(scenario),
+        'message_bytes': nbytes,
+        'sent': messages,
+        'delivered': delivered,
+        'lost': messages * scenario.fanout - delivered,
+        'publish_msg_per_s': round(messages / max(
+            publisher['end'] - publisher['start'], 1e-9), 1),
+        'msg_per_s': round(delivered / duration, 1),
+        'mb_per_s': round(delivered * nbytes / duration / 1e6, 3),
+        'latency_us': latency,
+    }
+
+
+def run_scenario(scenario: "Scenario", messages: "int" = MESSAGES,
+                 rate: "float" = 0) -> "dict":
+    """Runs ``scenario.fanout`` subscribers of ``scenario.topics`` topics
+    and, once they subscribed, a publisher that sends ``messages`` round
+    robin to the topics (at most ``rate`` per second, if set), each in a
+    process of its own. Throughput is measured from the first publish to
+    the last message received, and latencies by tracing every message.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    redis_client = ensure_redis()
+    clear(redis_client)
+
+    processes = {}
+    try:
+        for i in range(scenario.fanout):
+            name = f'subscriber-{i}'
+            processes[name] = context.Process(
+                target=run_subscriber,
+                args=(name, scenario, messages, results), daemon=True)
+            processes[name].start()
+        wait_subscribed(dict(processes))
+
+        processes['publisher'] = context.Process(
+            target=run_publisher, args=(scenario, messages, rate, results),
+            daemon=True)
+        processes['publisher'].start()
+        outcome = collect(results, processes)
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.join(IDLE_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        clear(redis_client)
+    return summarize(scenario, messages, outcome)
+
+
+def environment(messages: "int", rate: "float") -> "dict":
+    """Describes the run, such that results of releases can be compared."""
+    if get_redis_url().startswith('memory://'):
+        # The in-process broker can not be shared with the nodes
+        raise BenchFailureException(
+            'lemon bench runs nodes in processes of their own and needs a '
+            'redis server')
+    try:
+        version = metadata.version('lemon')
+    except metadata.PackageNotFoundError:
+        version = None
+    return {
+        'lemon': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'redis': ensure_redis().info('server')['redis_version'],
+        'time': time.time(),
+        'messages': messages,
+        'rate': rate,
+    }
+
+
+def metric(result: "dict", name: "str"):
+    for key in name.split('.'):
+        result = result[key]
+    return result
+
+
+def compare(results: "list[dict]", baseline: "list[dict]",
+            tolerance: "float") -> "list[str]":
+    """Returns the regressions of ``results`` against the results of the
+    same scenarios in ``baseline``, i.e., the metrics that are worse by
+    more than ``tolerance`` (a fraction of the baseline).
+    """
+    fields = list(Scenario.__dataclass_fields__)
+    previous = {tuple(result[field] for field in fields): result
+                for result in baseline}
+    regressions = []
+    for result in results:
+        key = tuple(result[field] for field in fields)
+        if key not in previous:
+            continue
+        for name, higher_is_better in METRICS.items():
+            old, new = metric(previous[key], name), metric(result, name)
+            change = (new - old) / old if old else 0
+            if (-change if higher_is_better else change) > tolerance:
+                scenario = ', '.join(
+                    f'{field}={value}' for field, value in zip(fields, key))
+                regressions.append(
+                    f'{name} {old:g} -> {new:g} ({change:+.0%}) for '
+                    f'{scenario}')
+    return regressions
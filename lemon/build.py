@@ -1,23 +1,35 @@
+import hashlib
 import os
 import pickle
+import shlex
+import subprocess
+import sys
+import threading
+from concurrent import futures
 from lemon.ctx import NodeContext
 from lemon.health import init_health
+from lemon.system import LogFileService
 from lemon.utils import (
     Entity,
     entity_to_message,
     bold_str,
+    lazy_import,
     Severity,
     severity_to_message
 )
-import redis
-from cerberus import Validator
-import yaml
+
+cerberus = lazy_import('cerberus')
+redis = lazy_import('redis')
+yaml = lazy_import('yaml')
 
 SCHEMA = {
     "mesh": {
         "type": "string",
         "required": True
     },
+    "redis": {
+        "type": "string"
+    },
     "nodes": {
         "type": "list",
         "required": True,
@@ -39,10 +51,26 @@ SCHEMA = {
                     "required": True
                 },
                 "in": {
-                    "type": "string"
+                    "type": [
+                        "string",
+                        "list"
+                    ],
+                    "schema": {
+                        "type": "string"
+                    }
                 },
                 "out": {
-                    "type": "string"
+                    "type": [
+                        "string",
+                        "list"
+                    ],
+                    "schema": {
+                        "type": "string"
+                    }
+                },
+                "replicas": {
+                    "type": "integer",
+                    "min": 1
                 },
                 "with": {
                     "type": [
@@ -59,6 +87,16 @@ SCHEMA = {
 }
 
 
+# Directories and files that builds produce rather than consume
+BUILD_DIRS = ('.git', '.eggs', '.tox', '__pycache__', 'build', 'dist')
+BUILD_SUFFIXES = ('.egg-info', '.pyc', '.so', '.pyd', '.o')
+GIT_TIMEOUT = 30
+# Lines of a failed build's log shown in the failure summary
+BUILD_LOG_TAIL = 10
+# pip does not support concurrent installs into the same environment
+INSTALL_LOCK = threading.Lock()
+
+
 class BuildFailureException(Exception):
     pass
 
@@ -67,38 +105,160 @@ class InvalidLemonfileException(Exception):
     pass
 
 
-def display_validation(validator: "Validator"):
+def lemonfile_redis_url(mesh: "str") -> "str":
+    """Returns the URL of the redis server of ``mesh`` in the local
+    Lemonfile, if any.
+    """
+    if not os.path.exists('Lemonfile.yml'):
+        return None
+    with open('Lemonfile.yml') as file:
+        meshes = yaml.safe_load(file)
+    for mesh_ in meshes or []:
+        if isinstance(mesh_, dict) and mesh_.get('mesh') == mesh:
+            return mesh_.get('redis')
+
+
+def display_validation(validator: "cerberus.Validator"):
     print(yaml.dump(validator.errors))
 
 
-def build_node(mesh: "str", node: "dict") -> None:
-    severity_to_message(
-        Severity.Information, f"Builing node {bold_str(node['name'])}")
+def build_id(mesh: "str", node: "dict") -> "str":
+    return f"{mesh}:{node['name']}:build"
 
-    flags = ''
-    if not node['from'].startswith('git+'):
-        flags += ' -e'
 
-    rtcode = os.system(f"python -m pip install{flags} {node['from']}")
-    if rtcode != 0:
-        raise BuildFailureException
+def hash_sources(path: "str") -> "str":
+    """Returns a hash of the names and contents of the source files in
+    ``path``, or None if ``path`` does not exist.
+    """
+    if not os.path.exists(path):
+        return None
 
-    severity_to_message(
-        Severity.Success, f"Built node {bold_str(node['name'])}")
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(
+            dir for dir in dirs
+            if dir not in BUILD_DIRS and not dir.endswith(BUILD_SUFFIXES))
+        for file in sorted(files):
+            if file.endswith(BUILD_SUFFIXES):
+                continue
+            file_path = os.path.join(root, file)
+            digest.update(os.path.relpath(file_path, path).encode('utf8'))
+            with open(file_path, 'rb') as source:
+                digest.update(hashlib.sha256(source.read()).digest())
+    return digest.hexdigest()
+
+
+def git_commit(url: "str") -> "str":
+    """Returns the commit a ``git+`` requirement resolves to, or None if it
+    can not be resolved (e.g., while offline).
+    """
+    url = url[len('git+'):].split('#')[0]
+    scheme, _, rest = url.partition('://')
+    netloc, _, path = rest.partition('/')
+    ref = 'HEAD'
+    if '@' in path:
+        path, ref = path.rsplit('@', 1)
+    if len(ref) == 40 and all(char in '0123456789abcdef' for char in ref):
+        return ref
+
+    try:
+        refs = subprocess.run(
+            ['git', 'ls-remote', f'{scheme}://{netloc}/{path}', ref],
+            capture_output=True, text=True, check=True,
+            timeout=GIT_TIMEOUT).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return refs.split()[0] if refs.strip() else None
+
+
+def log_tail(path: "str", lines: "int" = BUILD_LOG_TAIL) -> "list[str]":
+    try:
+        with open(path) as file:
+            return [line.rstrip() for line in file.readlines()[-lines:]]
+    except OSError:
+        return []
+
+
+def fingerprint(node: "dict") -> "str":
+    """Returns a fingerprint of everything a build of ``node`` depends on:
+    its sources (or the commit of a ``git+`` URL) and the interpreter that
+    installs it. Returns None if the sources can not be fingerprinted.
+    """
+    if node['from'].startswith('git+'):
+        sources = git_commit(node['from'])
+    else:
+        sources = hash_sources(node['from'])
+    if sources is None:
+        return None
+
+    digest = hashlib.sha256()
+    for part in (sys.executable, sys.version, node['from'], sources):
+        digest.update(part.encode('utf8') + b'\0')
+    return digest.hexdigest()
+
+
+def build_node(mesh: "str", node: "dict", redis_client: "redis.Redis",
+               force: "bool" = False) -> None:
+    current = fingerprint(node)
+    previous = redis_client.get(build_id(mesh, node))
+    if (not force and current is not None and previous is not None
+            and previous.decode('utf8') == current):
+        severity_to_message(
+            Severity.Information,
+            f"Node {bold_str(node['name'])} is unchanged, skipping build")
+    else:
+        log = LogFileService.build_path(mesh, node['name'])
+        severity_to_message(
+            Severity.Information,
+            f"Builing node {bold_str(node['name'])}, logging to {log}")
+
+        flags = ''
+        if not node['from'].startswith('git+'):
+            flags += ' -e'
+
+        with INSTALL_LOCK:
+            rtcode = os.system(
+                f"python -m pip install{flags} {node['from']} "
+                f"> {shlex.quote(log)} 2>&1")
+        if rtcode != 0:
+            raise BuildFailureException(node['name'], log)
+
+        if current is not None:
+            redis_client.set(build_id(mesh, node), current)
+
+        severity_to_message(
+            Severity.Success, f"Built node {bold_str(node['name'])}")
 
     if 'node' not in node:
         node['node'] = node['name']
 
-    ctx = NodeContext.from_descriptor(mesh, node)
-    init_health(ctx)
+    for ctx in NodeContext.replicas(mesh, node):
+        init_health(ctx)
 
     severity_to_message(
         Severity.Success,
         f"Registered node {bold_str(node['name'])} with persistency layer")
 
 
-def build_mesh(redis_client: "redis.Redis", mesh: "dict") -> None:
-    validator = Validator(SCHEMA)
+def display_failures(failures: "dict[str, str]"):
+    for name, log in failures.items():
+        severity_to_message(
+            Severity.Error,
+            f"Node {bold_str(name)} failed to build, see {log}")
+        for line in log_tail(log):
+            print(f'    {line}')
+
+
+def build_mesh(redis_client: "redis.Redis", mesh: "dict",
+               force: "bool" = False, jobs: "int" = 1) -> None:
+    """Builds all nodes of ``mesh`` whose fingerprint changed since their
+    last build (or all of them, if ``force`` is set), up to ``jobs`` at a
+    time, and registers the mesh. Fingerprinting and registration of nodes
+    run concurrently; their ``pip install`` steps run one at a time. The mesh
+    is only registered if all of its nodes built; nodes that did keep their
+    fingerprint for the next build.
+    """
+    validator = cerberus.Validator(SCHEMA)
 
     if not validator.validate(mesh):
         display_validation(validator)
@@ -107,8 +267,23 @@ def build_mesh(redis_client: "redis.Redis", mesh: "dict") -> None:
     entity_to_message(
         Entity.Mesh, mesh['mesh'], "Building nodes")
 
-    for node in mesh['nodes']:
-        build_node(mesh['mesh'], node)
+    failures = {}
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        builds = [
+            executor.submit(
+                build_node, mesh['mesh'], node, redis_client, force)
+            for node in mesh['nodes']]
+        # In declaration order, such that the summary is deterministic
+        for build in builds:
+            try:
+                build.result()
+            except BuildFailureException as e:
+                name, log = e.args
+                failures[name] = log
+
+    if failures:
+        display_failures(failures)
+        raise BuildFailureException(mesh['mesh'])
 
     redis_client.set(mesh['mesh'], pickle.dumps(mesh['nodes']))
 
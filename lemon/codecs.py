@@ -0,0 +1,174 @@
+from dataclasses import dataclass
+import json
+import marshal
+import pickle
+import struct
+from typing import Any, Callable
+from lemon.shm import SHM_ID
+from lemon.tracing import SEQUENCE_HEADER, SEQUENCE_ID, TRACE_ID
+
+
+class UnknownCodecException(Exception):
+    pass
+
+
+# Pickle streams (protocol >= 2) start with the PROTO opcode. Pickled
+# payloads are therefore sent without a header and every other codec is
+# identified by a one-byte header below this value.
+PICKLE_PROTO = 0x80
+
+
+@dataclass
+class Codec:
+    """Serialization of messages. ``decode`` receives the payload after the
+    codec header. If ``writes_header`` is set, ``encode`` already returns
+    the complete message including the header, which saves a copy of the
+    payload for large messages.
+    """
+    name: "str"
+    id: "int"
+    encode: "Callable[[Any], bytes]"
+    decode: "Callable[[bytes], Any]"
+    writes_header: "bool" = False
+
+    def __post_init__(self):
+        self.header = bytes([self.id]) if self.id != PICKLE_PROTO else b''
+
+
+CODECS: "dict[str, Codec]" = {}
+CODEC_IDS: "dict[int, Codec]" = {}
+
+
+def _is_pickle(codec: "Codec") -> "bool":
+    # Decoded as pickle and sent as pickle streams, i.e., without a header
+    return (codec.decode is pickle.loads and not codec.writes_header
+            and codec.encode(None)[:1] == bytes([PICKLE_PROTO]))
+
+
+def register_codec(codec: "Codec") -> "Codec":
+    """Registers a :py:class:`Codec` under its name. Every codec besides
+    pickle needs a unique ``id`` from 0 to 127, which is sent as the header
+    of each message so that subscribers can decode it. Only codecs that
+    encode and decode pickle streams may use :py:data:`PICKLE_PROTO`.
+    Raises ``ValueError`` for invalid ids.
+    """
+    if not 0 <= codec.id <= PICKLE_PROTO or (
+            codec.id == PICKLE_PROTO and not _is_pickle(codec)) or (
+            codec.id in (SHM_ID, TRACE_ID, SEQUENCE_ID)) or (
+            codec.id in CODEC_IDS and CODEC_IDS[codec.id].name != codec.name):
+        raise ValueError(f'Invalid codec id {codec.id} for {codec.name}')
+
+    CODECS[codec.name] = codec
+    if codec.id != PICKLE_PROTO:
+        CODEC_IDS[codec.id] = codec
+    return codec
+
+
+def get_codec(name: "str") -> "Codec":
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise UnknownCodecException(name)
+
+
+def encode(value, codec: "Codec") -> "bytes":
+    if codec.writes_header:
+        return codec.encode(value)
+    return codec.header + codec.encode(value)
+
+
+def decode(data: "bytes"):
+    codec_id = data[0]
+    if codec_id == SEQUENCE_ID:
+        data = memoryview(data)[SEQUENCE_HEADER.size:]
+        codec_id = data[0]
+    if codec_id == PICKLE_PROTO:
+        return pickle.loads(data)
+    try:
+        codec = CODEC_IDS[codec_id]
+    except KeyError:
+        raise UnknownCodecException(codec_id)
+    return codec.decode(memoryview(data)[1:])
+
+
+def _json_encode(value) -> "bytes":
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _json_decode(data: "memoryview"):
+    return json.loads(bytes(data))
+
+
+OOB_ID = 5
+OOB_ALIGNMENT = 64
+
+
+def _aligned(offset: "int") -> "int":
+    return -(-offset // OOB_ALIGNMENT) * OOB_ALIGNMENT
+
+
+def _oob_encode(value) -> "memoryview":
+    """Pickles ``value`` with protocol 5 and places the out-of-band buffers
+    (e.g., the data of NumPy arrays) behind the pickle, each aligned to
+    ``OOB_ALIGNMENT`` bytes. The buffers are copied exactly once, into the
+    message itself.
+    """
+    buffers = []
+    data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    raws = [buffer.raw() for buffer in buffers]
+
+    head = struct.pack(f'<BIQ{len(raws)}Q', OOB_ID, len(raws), len(data),
+                       *(raw.nbytes for raw in raws))
+    offsets = []
+    offset = len(head) + len(data)
+    for raw in raws:
+        offset = _aligned(offset)
+        offsets.append(offset)
+        offset += raw.nbytes
+
+    # Assigning through a memoryview avoids temporary copies of the buffers
+    message = memoryview(bytearray(offset))
+    message[:len(head)] = head
+    message[len(head):len(head) + len(data)] = data
+    for raw, offset in zip(raws, offsets):
+        message[offset:offset + raw.nbytes] = raw
+    return message
+
+
+def _oob_decode(data: "memoryview"):
+    """Rebuilds the pickled object with its out-of-band buffers as views
+    into ``data``. NumPy arrays received this way are therefore read-only.
+    """
+    count, length = struct.unpack_from('<IQ', data)
+    sizes = struct.unpack_from(f'<{count}Q', data, 12)
+
+    # ``data`` starts after the one-byte codec header
+    start = 12 + 8 * count
+    offset = start + length + 1
+    buffers = []
+    for size in sizes:
+        offset = _aligned(offset)
+        buffers.append(data[offset - 1:offset - 1 + size])
+        offset += size
+    return pickle.loads(data[start:start + length], buffers=buffers)
+
+
+register_codec(Codec('pickle', PICKLE_PROTO, pickle.dumps, pickle.loads))
+register_codec(Codec(
+    'pickle5', PICKLE_PROTO,
+    lambda value: pickle.dumps(value, protocol=5), pickle.loads))
+register_codec(Codec('raw', 1, bytes, bytes))
+register_codec(Codec('marshal', 2, marshal.dumps, marshal.loads))
+register_codec(Codec('json', 3, _json_encode, _json_decode))
+register_codec(Codec(
+    'pickle5-oob', OOB_ID, _oob_encode, _oob_decode, writes_header=True))
+
+try:
+    import msgpack
+
+    register_codec(Codec(
+        'msgpack', 4, msgpack.packb, msgpack.unpackb))
+except ImportError:
+    pass
+
+DEFAULT_CODEC = CODECS['pickle']
@@ -11,17 +11,26 @@ class NodeContext:
     def from_descriptor(mesh: "str", node: "dict") -> "NodeContext":
         return NodeContext(mesh, node['name'], node['node'])
 
+    def replicas(mesh: "str", node: "dict") -> "list[NodeContext]":
+        """Contexts of all instances of a node descriptor, i.e., one per
+        replica (``name-0`` to ``name-N-1``) if ``replicas`` is set.
+        """
+        if 'replicas' not in node:
+            return [NodeContext.from_descriptor(mesh, node)]
+        return [NodeContext(mesh, f"{node['name']}-{i}", node['node'])
+                for i in range(node['replicas'])]
+
     def __post_init__(self):
         self.renew()
 
-    def renew(self):
-        self.redis_client = ensure_redis()
+    def renew(self, check=False):
+        self.redis_client = ensure_redis(check=check)
 
 
 @dataclass
 class AsyncNodeContext(NodeContext):
-    def renew(self):
-        self.redis_client = ensure_redis(do_async=True)
+    def renew(self, check=False):
+        self.redis_client = ensure_redis(do_async=True, check=check)
 
 
 ctx = None
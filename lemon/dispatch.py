@@ -0,0 +1,445 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from concurrent import futures
+import functools
+import inspect
+import os
+import time
+from typing import Any, Awaitable, Callable
+import zlib
+from lemon.codecs import decode
+from lemon.health import HealthService
+from lemon.tracing import TRACE_ID, strip_trace
+from lemon.utils import compile_pattern, is_pattern, lazy_import
+
+multiprocessing = lazy_import('multiprocessing')
+
+DISPATCH_CONCURRENCY = 16
+EXECUTORS = ('inline', 'thread', 'process')
+QUEUE_DEPTH = 1
+OVERFLOWS = ('latest', 'drop-oldest', 'block')
+MAX_QUEUED = 1000
+PARTITION_SAMPLE = 2 ** 15
+BROADCAST_PREFIX = '!param:'
+ROUTE_CACHE_SIZE = 2 ** 14
+
+
+@dataclass
+class Overflow:
+    """What happens to a message that arrives while ``max_queued``
+    messages of its topic already wait for their callback:
+
+    * ``latest``: only the newest message is kept (conflation), i.e.,
+      ``max_queued`` is 1,
+    * ``drop-oldest``: the oldest waiting message is dropped,
+    * ``block``: no further messages are received until there is space.
+    """
+    policy: "str" = 'drop-oldest'
+    max_queued: "int" = MAX_QUEUED
+
+    def __post_init__(self):
+        if self.policy not in OVERFLOWS:
+            raise ValueError(f'Unknown overflow policy {self.policy}')
+        if self.policy == 'latest':
+            self.max_queued = 1
+        if self.max_queued < 1:
+            raise ValueError('max_queued must be positive')
+
+
+class TopicQueue:
+    """Messages of a single topic that wait for their callback. Messages
+    are handed out in the order they arrived.
+    """
+
+    def __init__(self, overflow: "Overflow" = None):
+        self.overflow = overflow or Overflow()
+        self.messages = deque()
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.closed = False
+
+    def __len__(self):
+        return len(self.messages)
+
+    async def put(self, data: "bytes", ack: "Callable[[], None]" = None,
+                  received: "float" = None) -> "list[tuple]":
+        """Queues ``data`` and returns the messages dropped for it.
+        ``received`` is the time a traced message was received at. Once the
+        queue is closed, it no longer blocks.
+        """
+        dropped = []
+        while len(self.messages) >= self.overflow.max_queued:
+            if self.closed:
+                break
+            if self.overflow.policy == 'block':
+                self.space.clear()
+                await self.space.wait()
+            else:
+                dropped.append(self.messages.popleft())
+        self.messages.append((data, ack, received))
+        self.ready.set()
+        return dropped
+
+    async def get(self) -> "tuple[bytes, Callable[[], None], float]":
+        while not self.messages:
+            self.ready.clear()
+            await self.ready.wait()
+        self.space.set()
+        return self.messages.popleft()
+
+    def close(self):
+        """Releases a blocked :py:meth:`put`, e.g., when nothing will
+        :py:meth:`get` messages anymore.
+        """
+        self.closed = True
+        self.space.set()
+
+
+class Router:
+    """Resolves the subscription (*route*) and callback of a channel among
+    the topics and glob-style patterns of ``topic_to_fn``. A topic takes
+    precedence over patterns, and patterns take precedence in the order
+    they were given. Patterns are compiled once, and resolved channels are
+    cached, so that routing a message is a dictionary lookup no matter how
+    many patterns there are.
+    """
+
+    def __init__(self, topic_to_fn: "dict[str, Callable[[Any], Awaitable]]"):
+        self.topic_to_fn = topic_to_fn
+        self.patterns = [(compile_pattern(topic), topic)
+                         for topic in topic_to_fn if is_pattern(topic)]
+        self.routes = {topic: topic for topic in topic_to_fn
+                       if not is_pattern(topic)}
+        self.cache = dict(self.routes)
+
+    def route(self, channel: "str") -> "str":
+        """Returns the topic or pattern that ``channel`` is routed to, or
+        None if it is not subscribed to.
+        """
+        try:
+            return self.cache[channel]
+        except KeyError:
+            pass
+
+        route = None
+        for regex, pattern in self.patterns:
+            if regex.fullmatch(channel):
+                route = pattern
+                break
+        if len(self.cache) >= ROUTE_CACHE_SIZE:
+            self.cache = dict(self.routes)
+        self.cache[channel] = route
+        return route
+
+    def callback(self, channel: "str") -> "Callable[[Any], Awaitable]":
+        route = self.route(channel)
+        return None if route is None else self.topic_to_fn[route]
+
+
+class Partition:
+    """Share of replica ``index`` out of ``count`` replicas of the node
+    ``name`` in the messages of its topics. Every replica receives every
+    message but only processes those assigned to it. A message is assigned
+    by a hash of its contents (including its sequence header, if any, see
+    :py:data:`lemon.tracing.SEQUENCE_ID`), which all replicas compute alike,
+    or, for topics with a key function in ``keys``, by a hash of the key of
+    its value, such that all messages with the same key go to the same
+    replica. Parameters (``!param:`` topics) are processed by all replicas.
+    Messages assigned to replicas that are not ``live`` are processed by no
+    replica; the first live replica reports them as :py:meth:`lost`.
+    """
+
+    def __init__(self, name: "str", index: "int", count: "int",
+                 keys: "dict[str, Callable[[Any], Any]]" = None):
+        if not 0 <= index < count:
+            raise ValueError(f'Replica {index} out of {count} replicas')
+        self.name = name
+        self.index = index
+        self.count = count
+        self.keys = keys if keys is not None else {}
+        self.live = set(range(count))
+
+    def owner(self, data: "bytes") -> "int":
+        """Index of the replica that ``data`` is assigned to."""
+        if len(data) > 2 * PARTITION_SAMPLE:
+            # Hashing the ends of large messages is enough to spread them
+            checksum = zlib.crc32(data[:PARTITION_SAMPLE], len(data))
+            checksum = zlib.crc32(data[-PARTITION_SAMPLE:], checksum)
+        else:
+            checksum = zlib.crc32(data)
+        return checksum % self.count
+
+    def key(self, topic: "str", value) -> "bytes":
+        return repr(self.keys[topic](value)).encode('utf8')
+
+    def owns(self, topic: "str", data: "bytes") -> "bool":
+        """Whether this replica processes message ``data`` of ``topic``.
+        Always true for topics with a key function, see :py:meth:`owns_value`.
+        """
+        if topic.startswith(BROADCAST_PREFIX) or topic in self.keys:
+            return True
+        return self.owner(data) == self.index
+
+    def owns_value(self, topic: "str", value) -> "bool":
+        """Whether this replica processes the decoded ``value`` of ``topic``.
+        """
+        if topic not in self.keys:
+            return True
+        return self.owner(self.key(topic, value)) == self.index
+
+    def lost(self, topic: "str", data: "bytes" = None,
+             value=None) -> "bool":
+        """Whether a message of ``topic`` that this replica does not own is
+        processed by no replica, since the replica it is assigned to is not
+        live. Only true for the first live replica, such that every lost
+        message is counted once. Messages of topics with a key function
+        are given by their decoded ``value``, others by their ``data``.
+        """
+        if len(self.live) == self.count or self.index != min(self.live):
+            return False
+        if topic in self.keys:
+            data = self.key(topic, value)
+        return self.owner(data) not in self.live
+
+
+class Dispatcher:
+    """Runs the callbacks of different topics concurrently, at most
+    ``concurrency`` at a time, while the callbacks of one topic are run one
+    after another, in the order their messages arrived. Each topic queues
+    messages according to its :py:class:`Overflow`. Values that belong to
+    another replica of the node according to ``partition`` are skipped.
+    Topics of ``topic_to_fn`` may also be glob-style patterns, see
+    :py:class:`Router`; messages are nevertheless queued per topic. Topics
+    of messages with an ``ack`` (stream entries) block by default rather
+    than drop, since redis keeps their entries anyway. For
+    traced messages (see :py:mod:`lemon.tracing`), the transport, queue and
+    handler latencies are recorded with the ``health_service``.
+    """
+
+    def __init__(self, topic_to_fn: "dict[str, Callable[[Any], Awaitable]]",
+                 health_service: "HealthService",
+                 concurrency: "int" = DISPATCH_CONCURRENCY,
+                 overflows: "dict[str, Overflow]" = None,
+                 partition: "Partition" = None):
+        self.topic_to_fn = topic_to_fn
+        self.router = Router(topic_to_fn)
+        self.health_service = health_service
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.overflows = overflows or {}
+        self.partition = partition
+        self.queues = {}
+        self.workers = {}
+        self.error = None
+        self.offloads = [fn for fn in topic_to_fn.values()
+                         if isinstance(fn, Offload)]
+
+    async def dispatch(self, topic: "str", data: "bytes",
+                       ack: "Callable[[], None]" = None):
+        """Queues ``data`` for the callback of ``topic``. ``ack`` is called
+        once the message was processed or dropped.
+        """
+        received = None
+        if data[0] == TRACE_ID:
+            sent, _, data = strip_trace(data)
+            received = time.time()
+            self.health_service.latency(topic, 'transport', received - sent)
+
+        queue = self.queues.get(topic)
+        if queue is None:
+            route = self.router.route(topic)
+            if route is None:
+                return
+            overflow = self.overflows.get(topic, self.overflows.get(route))
+            if overflow is None:
+                overflow = Overflow('block' if ack is not None else
+                                    'drop-oldest')
+            queue = self.queues[topic] = TopicQueue(overflow)
+            self.workers[topic] = asyncio.get_event_loop().create_task(
+                self.work(topic, route, queue))
+        dropped = await queue.put(data, ack, received)
+        # The worker of a blocked queue may have failed meanwhile
+        self.raise_for_error()
+        if dropped:
+            self.health_service.dropped(topic, len(dropped))
+            for _, dropped_ack, _ in dropped:
+                if dropped_ack is not None:
+                    dropped_ack()
+
+    async def work(self, topic: "str", route: "str", queue: "TopicQueue"):
+        callback = self.topic_to_fn[route]
+        while True:
+            data, ack, received = await queue.get()
+            try:
+                value = decode(data)
+                owned = (self.partition is None
+                         or self.partition.owns_value(route, value))
+                handler = callback
+                if owned and ack is not None and isinstance(callback, Offload):
+                    # Acknowledged once the pool finished and the result
+                    # was published, not once the value was submitted
+                    handler = functools.partial(callback, ack=ack)
+                    ack = None
+                if owned:
+                    async with self.semaphore:
+                        if received is None:
+                            await handler(value)
+                        else:
+                            await self.traced(topic, handler, value, received)
+            except Exception as e:
+                self.error = e
+                queue.close()
+                return
+            if ack is not None:
+                ack()
+            if owned:
+                self.health_service.received(topic, len(data))
+            elif self.partition.lost(route, value=value):
+                self.health_service.dropped(topic)
+
+    async def traced(self, topic: "str", callback: "Callable", value,
+                     received: "float"):
+        health_service = self.health_service
+        start = time.time()
+        health_service.latency(topic, 'queue', start - received)
+        await callback(value)
+        health_service.latency(topic, 'handler', time.time() - start)
+
+    def raise_for_error(self):
+        """Raises the error of a failed callback, also of one that failed
+        in the pool of an :py:class:`Offload`.
+        """
+        if self.error is not None:
+            raise self.error
+        for offload in self.offloads:
+            offload.raise_for_error()
+
+    def depths(self) -> "dict[str, int]":
+        depths = {}
+        for topic, queue in self.queues.items():
+            depths[topic] = len(queue)
+            callback = self.router.callback(topic)
+            if isinstance(callback, Offload):
+                depths[topic] += callback.depth()
+        return depths
+
+    def close(self):
+        for worker in self.workers.values():
+            worker.cancel()
+        for offload in self.offloads:
+            offload.close()
+        self.workers = {}
+        self.queues = {}
+
+
+class Executors:
+    """Thread and process pools of a node, created on first use."""
+
+    def __init__(self, threads: "int" = None, processes: "int" = None,
+                 queue_depth: "int" = QUEUE_DEPTH):
+        self.threads = threads or min(32, (os.cpu_count() or 1) + 4)
+        self.processes = processes or os.cpu_count() or 1
+        self.queue_depth = queue_depth
+        self.pools = {}
+
+    def get(self, executor: "str") -> "futures.Executor":
+        if executor not in EXECUTORS:
+            raise ValueError(f'Unknown executor {executor}')
+        if executor == 'inline':
+            return None
+
+        if executor not in self.pools:
+            if executor == 'thread':
+                self.pools[executor] = futures.ThreadPoolExecutor(
+                    self.threads)
+            else:
+                # Forking a process with a running event loop is unsafe
+                self.pools[executor] = futures.ProcessPoolExecutor(
+                    self.processes,
+                    mp_context=multiprocessing.get_context('spawn'))
+        return self.pools[executor]
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.pools = {}
+
+
+class Offload:
+    """Callback that runs ``fn`` on ``pool`` (or inline if ``pool`` is
+    None). Up to ``queue_depth`` calls are in flight at the same time, and
+    their results are passed to ``publish`` under ``publish_to`` in the
+    order the calls were made. The ``ack`` of a call is called after its
+    result was published, and not if ``fn`` failed. Errors of pooled calls
+    are raised by :py:meth:`raise_for_error`, see
+    :py:meth:`Dispatcher.raise_for_error`.
+    """
+
+    def __init__(self, fn: "Callable", pool: "futures.Executor",
+                 publish_to: "str", queue_depth: "int",
+                 publish: "Callable[[str, Any], Awaitable]"):
+        self.fn = fn
+        self.pool = pool
+        self.publish_to = publish_to
+        self.queue_depth = queue_depth
+        self.publish = publish
+        self.pending = deque()
+        self.slots = None
+        self.waiting = 0
+        self.drainer = None
+        self.error = None
+
+    async def __call__(self, value, ack: "Callable[[], None]" = None):
+        if self.pool is None:
+            result = self.fn(value)
+            if inspect.isawaitable(result):
+                result = await result
+            await self.forward(result)
+            if ack is not None:
+                ack()
+            return
+
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.queue_depth)
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        loop = asyncio.get_event_loop()
+        self.pending.append(
+            (loop.run_in_executor(self.pool, self.fn, value), ack))
+        if self.drainer is None or self.drainer.done():
+            self.drainer = loop.create_task(self.drain())
+
+    async def drain(self):
+        while self.pending:
+            future, ack = self.pending[0]
+            try:
+                result = await future
+                await self.forward(result)
+                if ack is not None:
+                    ack()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.pending.popleft()
+                self.slots.release()
+
+    async def forward(self, result):
+        if self.publish_to is not None and result is not None:
+            await self.publish(self.publish_to, result)
+
+    def depth(self) -> "int":
+        return len(self.pending) + self.waiting
+
+    def raise_for_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        if self.drainer is not None:
+            self.drainer.cancel()
+            self.drainer = None
@@ -0,0 +1,62 @@
+from lemon.utils import (
+    Severity,
+    bold_str,
+    compile_pattern,
+    is_pattern,
+    severity_to_message
+)
+
+
+def topics(node: "dict", direction: "str") -> "list[str]":
+    """Topics a node descriptor declares as its ``in`` or ``out``."""
+    declared = node.get(direction, [])
+    if not isinstance(declared, list):
+        declared = [declared]
+    return declared
+
+
+def consumes(node: "dict", topic: "str") -> "bool":
+    """Whether ``node`` subscribes to ``topic``, also via a pattern."""
+    return any(
+        compile_pattern(in_topic).fullmatch(topic) if is_pattern(in_topic)
+        else in_topic == topic
+        for in_topic in topics(node, 'in'))
+
+
+def consumers(nodes: "list[dict]") -> "dict[str, list[str]]":
+    """Maps the name of every node to the names of the (other) nodes that
+    consume one of its ``out`` topics.
+    """
+    return {
+        node['name']: [
+            other['name'] for other in nodes
+            if other['name'] != node['name'] and any(
+                consumes(other, topic) for topic in topics(node, 'out'))]
+        for node in nodes}
+
+
+def start_stages(nodes: "list[dict]") -> "list[list[dict]]":
+    """Groups ``nodes`` into stages that are started one after another,
+    such that every node starts after the nodes that consume its ``out``
+    topics (and would otherwise miss its first messages). Nodes of a stage
+    do not depend on each other and keep the order of the Lemonfile. Nodes
+    on a cycle can not be ordered and are started together last.
+    """
+    waits_for = {name: set(names)
+                 for name, names in consumers(nodes).items()}
+    started, stages = set(), []
+    remaining = list(nodes)
+    while remaining:
+        stage = [node for node in remaining
+                 if waits_for[node['name']] <= started]
+        if not stage:
+            severity_to_message(Severity.Warning, (
+                'Topics of nodes ' + ', '.join(
+                    bold_str(node['name']) for node in remaining)
+                + ' form a cycle, starting them together'))
+            stage = remaining
+        stages.append(stage)
+        started |= {node['name'] for node in stage}
+        remaining = [node for node in remaining
+                     if node['name'] not in started]
+    return stages
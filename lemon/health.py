@@ -1,20 +1,147 @@
+import os
 import time
+from typing import Callable
 from lemon.ctx import NodeContext, AsyncNodeContext
-from lemon.utils import NodeActivity
-from lemon.system import ProcessService
-import pickle
+from lemon.utils import NodeActivity, check_redis, lazy_import
+from lemon.system import ProcessService, pid_id
+from lemon.tracing import LATENCIES, LatencyHistogram
+
+asyncio = lazy_import('asyncio')
+redis = lazy_import('redis')
+
+WINDOWS = (1, 10, 60)
+DEFAULT_WINDOW = 10
+# Rates of a writer that flushed this many seconds before the latest flush
+# of the health are left out, e.g., of a process that was killed
+STALE_WRITER = 5.0
 
 
 def health_id(ctx: "NodeContext"):
     return f'{ctx.mesh}:{ctx.name}:health'
 
 
+# The health of a node is a redis hash with the fields
+#
+#   activity                         e.g. ACTIVE, see NodeActivity
+#   start_time, last_time            unix time in seconds
+#   flushed_at                       unix time of the last flush
+#   version                          number of flushes since the reset
+#   messages:<in|out>:<topic>        messages since start (HINCRBY)
+#   bytes:<in|out>:<topic>           bytes since start (HINCRBY)
+#   dropped:<topic>                  dropped messages since start (HINCRBY)
+#
+# written by the node process, and, per writer (process) ``<pid>``,
+#
+#   flushed_at@<pid>                         unix time of its last flush
+#   queued:<topic>@<pid>                     messages waiting for callbacks
+#   msg_rate:<window>:<in|out>:<topic>@<pid>   messages/s over the window
+#   byte_rate:<window>:<in|out>:<topic>@<pid>  bytes/s over the window
+#   latency:<p50|p99|max>:<kind>:<topic>@<pid> latency in us of traced
+#                                              messages, see lemon.tracing
+#
+# such that it can be read (e.g., with ``redis-cli HGETALL``) and reported
+# into by several processes of a node without read-modify-write. The hash
+# is reset by ``lemon build``, ``lemon start`` and ``lemon stop``.
+def encode_rates(rates: "dict", writer: "str") -> "dict[str, float]":
+    fields = {}
+    for direction in ('in', 'out'):
+        for topic, topic_rates in rates.get(direction, {}).items():
+            for window, (msg_rate, byte_rate) in topic_rates.items():
+                key = f'{window}:{direction}:{topic}@{writer}'
+                fields[f'msg_rate:{key}'] = msg_rate
+                fields[f'byte_rate:{key}'] = byte_rate
+    for topic, depth in rates.get('queued', {}).items():
+        fields[f'queued:{topic}@{writer}'] = depth
+    for topic, kinds in rates.get('latency', {}).items():
+        for kind, stats in kinds.items():
+            for stat, value in zip(('p50', 'p99', 'max'), stats):
+                fields[f'latency:{stat}:{kind}:{topic}@{writer}'] = value
+    return fields
+
+
+def empty_rates() -> "dict":
+    return {'in': {}, 'out': {}, 'dropped': {}, 'queued': {}, 'latency': {}}
+
+
+def decode_health(fields: "dict[bytes, bytes]") -> "tuple":
+    """Returns activity, start time, last time and rates of a health hash.
+    The rates of its writers are summed, see :py:func:`sum_rates`, leaving
+    out writers that are :py:data:`STALE_WRITER`.
+    """
+    fields = {field.decode('utf8'): value.decode('utf8')
+              for field, value in fields.items()}
+    activity = NodeActivity[fields.get('activity', 'SHUTDOWN')]
+    start_time = float(fields['start_time']) \
+        if 'start_time' in fields else None
+    last_time = float(fields['last_time']) if 'last_time' in fields else None
+
+    writers, flushed, dropped = {}, {}, {}
+    for field, value in fields.items():
+        kind, _, rest = field.partition(':')
+        if kind.startswith('flushed_at@'):
+            flushed[kind.partition('@')[2]] = float(value)
+            continue
+        if kind == 'dropped':
+            dropped[rest] = int(value)
+            continue
+        if kind not in ('msg_rate', 'byte_rate', 'queued', 'latency'):
+            continue
+        rest, separator, writer = rest.rpartition('@')
+        if not separator:
+            continue
+        rates = writers.setdefault(writer, empty_rates())
+        if kind in ('msg_rate', 'byte_rate'):
+            window, direction, topic = rest.split(':', 2)
+            topic_rates = rates[direction].setdefault(topic, {})
+            msg_rate, byte_rate = topic_rates.get(int(window), (0., 0.))
+            if kind == 'msg_rate':
+                msg_rate = float(value)
+            else:
+                byte_rate = float(value)
+            topic_rates[int(window)] = (msg_rate, byte_rate)
+        elif kind == 'queued':
+            rates['queued'][rest] = int(value)
+        else:
+            stat, latency, topic = rest.split(':', 2)
+            stats = rates['latency'].setdefault(topic, {}).setdefault(
+                latency, [0, 0, 0])
+            stats[('p50', 'p99', 'max').index(stat)] = int(value)
+
+    latest = max(flushed.values(), default=0.)
+    rates = sum_rates([
+        writer_rates for writer, writer_rates in writers.items()
+        if latest - flushed.get(writer, latest) <= STALE_WRITER])
+    rates['dropped'] = dropped
+    return activity, start_time, last_time, rates
+
+
+# Fields that tell whether a health changed since it was last read, see
+# HealthReader
+VERSION_FIELDS = ('activity', 'start_time', 'version')
+
+
 def get_time_passed(last_time):
     return time.time() - last_time
 
 
-def get_throughput(time_passed):
-    return '{:.2f} msg/s'.format(1 / time_passed)
+def get_throughput(rates: "dict", window: "int" = DEFAULT_WINDOW):
+    lines = []
+    for direction in ('in', 'out'):
+        for topic, topic_rates in sorted(rates.get(direction, {}).items()):
+            msg_rate, byte_rate = topic_rates[window]
+            lines.append('{} {}: {:.2f} msg/s, {:.2f} MB/s'.format(
+                direction, topic, msg_rate, byte_rate / 1e6))
+    for topic, dropped in sorted(rates.get('dropped', {}).items()):
+        lines.append(f'dropped {topic}: {dropped} msg')
+    for topic, depth in sorted(rates.get('queued', {}).items()):
+        if depth:
+            lines.append(f'queued {topic}: {depth} msg')
+    for topic, kinds in sorted(rates.get('latency', {}).items()):
+        lines.append(f'latency {topic}: ' + ', '.join(
+            '{} {}/{}/{} ms'.format(kind, *(
+                f'{value / 1e3:.2f}' for value in kinds[kind]))
+            for kind in LATENCIES if kind in kinds) + ' (p50/p99/max)')
+    return '\n'.join(lines)
 
 
 def get_lifetime(start_time):
@@ -22,36 +149,371 @@ def get_lifetime(start_time):
         time.time() - start_time))
 
 
-def get_health(ctx: "NodeContext"):
-    activity, start_time, last_time = pickle.loads(
-        ctx.redis_client.get(health_id(ctx)))
+def evaluate_health(health: "tuple", pid: "bytes") -> "tuple":
+    """Returns activity, start time and rates of a node given its stored
+    ``health`` and ``pid``, or ``None`` for start time and rates if the
+    node is not running.
+    """
+    activity, start_time, last_time, rates = health
 
-    is_running = ProcessService.is_running(ctx)
+    is_running = pid is not None and ProcessService.pid_exists(int(pid))
 
     if not (is_running and start_time and last_time):
-        lifetime = ''
-        throughput = ''
         if activity != NodeActivity.SHUTDOWN:
             activity = NodeActivity.FAILED
-    else:
-        time_passed = get_time_passed(last_time)
-        throughput = get_throughput(time_passed)
-        lifetime = get_lifetime(start_time)
-        if time_passed > 5:
-            activity = NodeActivity.WAITING
+        return activity, None, None
+
+    if get_time_passed(last_time) > 5:
+        activity = NodeActivity.WAITING
+    return activity, start_time, rates
+
+
+class HealthReader:
+    """Reads the health of many nodes in pipelined round trips, rather than
+    one round trip per node. A health hash is read in full (``HGETALL``)
+    and decoded the first time only. Afterwards, only its
+    :py:data:`VERSION_FIELDS` are read (``HMGET``; every flush increments
+    ``version``), and the hashes that changed are read in full in a second
+    round trip, such that reading repeatedly (as in ``lemon show --watch``)
+    stays cheap for large meshes of mostly idle nodes.
+    """
+
+    def __init__(self, redis_client: "redis.Redis",
+                 ctxs: "list[NodeContext]"):
+        self.redis_client = redis_client
+        self.ctxs = ctxs
+        self.cache = {}
+
+    def read(self) -> "list[tuple]":
+        """Returns the health of every node, see :py:func:`evaluate_health`.
+        """
+        if not self.ctxs:
+            return []
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for ctx in self.ctxs:
+            if ctx.name in self.cache:
+                pipeline.hmget(health_id(ctx), VERSION_FIELDS)
+            else:
+                pipeline.hgetall(health_id(ctx))
+            pipeline.get(pid_id(ctx))
+        values = pipeline.execute(raise_on_error=False)
+
+        fields, changed = {}, []
+        for ctx, value in zip(self.ctxs, values[::2]):
+            if isinstance(value, redis.exceptions.ResponseError):
+                # WRONGTYPE of a health stored by an older version of Lemon,
+                # until the node is built or started again
+                value = {}
+            if isinstance(value, dict):
+                fields[ctx.name] = value
+            elif tuple(value) != self.cache[ctx.name][0]:
+                changed.append(ctx)
+
+        if changed:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for ctx in changed:
+                pipeline.hgetall(health_id(ctx))
+            for ctx, value in zip(
+                    changed, pipeline.execute(raise_on_error=False)):
+                if isinstance(value, redis.exceptions.ResponseError):
+                    value = {}
+                fields[ctx.name] = value
+
+        healths = []
+        for ctx, pid in zip(self.ctxs, values[1::2]):
+            if ctx.name in fields:
+                version = tuple(fields[ctx.name].get(field.encode('utf8'))
+                                for field in VERSION_FIELDS)
+                self.cache[ctx.name] = (
+                    version, decode_health(fields[ctx.name]))
+            healths.append(evaluate_health(self.cache[ctx.name][1], pid))
+        return healths
+
+
+def load_health(ctx: "NodeContext") -> "tuple":
+    return HealthReader(ctx.redis_client, [ctx]).read()[0]
+
+
+def get_health(ctx: "NodeContext", window: "int" = DEFAULT_WINDOW,
+               health: "tuple" = None):
+    if health is None:
+        health = load_health(ctx)
+    activity, start_time, rates = health
+    if start_time is None:
+        return ctx.name, ctx.node, activity, '', ''
+    return (ctx.name, ctx.node, activity, get_lifetime(start_time),
+            get_throughput(rates, window))
+
+
+def sum_rates(all_rates: "list[dict]") -> "dict":
+    """Sums the rates of several replicas (or writers). Latencies can not be
+    summed, the worst of every percentile is taken instead.
+    """
+    total = empty_rates()
+    for rates in all_rates:
+        for direction in ('in', 'out'):
+            for topic, topic_rates in rates.get(direction, {}).items():
+                summed = total[direction].setdefault(topic, {})
+                for window, (msg_rate, byte_rate) in topic_rates.items():
+                    msgs, nbytes = summed.get(window, (0, 0))
+                    summed[window] = (msgs + msg_rate, nbytes + byte_rate)
+        for key in ('dropped', 'queued'):
+            for topic, count in rates.get(key, {}).items():
+                total[key][topic] = total[key].get(topic, 0) + count
+        for topic, kinds in rates.get('latency', {}).items():
+            worst = total['latency'].setdefault(topic, {})
+            for kind, stats in kinds.items():
+                worst[kind] = tuple(map(max, zip(
+                    worst.get(kind, stats), stats)))
+    return total
+
+
+ACTIVITY_PRECEDENCE = (
+    NodeActivity.ACTIVE,
+    NodeActivity.WAITING,
+    NodeActivity.FAILED,
+    NodeActivity.SHUTDOWN
+)
 
-    return ctx.name, ctx.node, activity, lifetime, throughput
+
+def get_replicas_health(name: "str", ctxs: "list[NodeContext]",
+                        window: "int" = DEFAULT_WINDOW,
+                        healths: "list[tuple]" = None):
+    """Health of the replicas ``ctxs`` of node ``name`` as a whole: the most
+    alive activity of any replica, the lifetime of the oldest running
+    replica and the summed throughput of all running replicas.
+    """
+    if healths is None:
+        healths = [load_health(ctx) for ctx in ctxs]
+    activities = [activity for activity, _, _ in healths]
+    activity = min(activities, key=lambda activity: (
+        ACTIVITY_PRECEDENCE.index(activity)
+        if activity in ACTIVITY_PRECEDENCE else len(ACTIVITY_PRECEDENCE)))
+
+    running = [(start_time, rates) for _, start_time, rates in healths
+               if start_time is not None]
+    lines = [f'replicas: {len(running)}/{len(ctxs)} running']
+    lifetime = ''
+    if running:
+        lifetime = get_lifetime(min(start_time for start_time, _ in running))
+        throughput = get_throughput(
+            sum_rates([rates for _, rates in running]), window)
+        if throughput:
+            lines.append(throughput)
+
+    node = ctxs[0].node if ctxs else ''
+    return name, node, activity, lifetime, '\n'.join(lines)
 
 
 def init_health(ctx: "NodeContext"):
-    data = pickle.dumps((NodeActivity.SHUTDOWN, None, None))
-    ctx.redis_client.set(health_id(ctx), data)
+    pipeline = ctx.redis_client.pipeline(transaction=False)
+    pipeline.delete(health_id(ctx))
+    pipeline.hset(health_id(ctx), 'activity', NodeActivity.SHUTDOWN.name)
+    pipeline.execute()
+
+
+class TrafficCounter:
+    """Counts messages and bytes of one topic in one-second buckets, so
+    that rates over any of the :py:data:`WINDOWS` can be read off without
+    keeping per-message timestamps.
+    """
+
+    def __init__(self, start_time: "float"):
+        self.start_time = start_time
+        size = max(WINDOWS) + 1
+        self.seconds = [-1] * size
+        self.messages = [0] * size
+        self.bytes = [0] * size
+
+    def add(self, now: "float", nbytes: "int"):
+        second = int(now)
+        i = second % len(self.seconds)
+        if self.seconds[i] != second:
+            self.seconds[i] = second
+            self.messages[i] = 0
+            self.bytes[i] = 0
+        self.messages[i] += 1
+        self.bytes[i] += nbytes
+
+    def rates(self, now: "float") -> "dict[int, tuple[float, float]]":
+        """Returns ``(msg/s, B/s)`` per window. A window spans the current,
+        partial second and the ``window`` full seconds before it, but not
+        the time before ``start_time``.
+        """
+        second = int(now)
+        rates = {}
+        for window in WINDOWS:
+            messages, nbytes = 0, 0
+            for i, bucket in enumerate(self.seconds):
+                if second - window <= bucket <= second:
+                    messages += self.messages[i]
+                    nbytes += self.bytes[i]
+            span = min(window + now - second, now - self.start_time)
+            span = max(span, 1e-3)
+            rates[window] = (messages / span, nbytes / span)
+        return rates
+
+
+HEALTH_INTERVAL = 1.0
+# Longest pause between attempts to flush while redis is unavailable
+HEALTH_MAX_BACKOFF = 10.0
 
 
 class HealthService:
-    def __init__(self):
+    """Keeps the health of a node in-process and flushes it to redis from
+    a background task every ``interval`` seconds. Recording activity on the
+    hot path (:py:meth:`record`, :py:meth:`received`, :py:meth:`sent`)
+    therefore does not do any I/O. Counters are flushed as increments
+    (``HINCRBY``) and rates under the pid of the process, such that other
+    processes of the node can report into the same health with services of
+    their own. Only the ``primary`` service (the one of the node process)
+    reports the activity and lifetime of the node.
+    While redis is unavailable, the heartbeat backs off and reconnects
+    (checking the server off the event loop), and counters are kept until
+    they could be flushed.
+    """
+
+    def __init__(self, interval: "float" = HEALTH_INTERVAL,
+                 primary: "bool" = True):
         self.start_time = time.time()
+        self.interval = interval
+        self.activity = NodeActivity.ACTIVE
+        self.last_time = self.start_time
+        self.traffic = {'in': {}, 'out': {}}
+        self.counts = {}
+        self.histograms = {}
+        self.queue_depths = dict
+        self.dirty = True
+        self.primary = primary
+        self.writer = str(os.getpid())
+        self.task = None
+
+    def record(self, activity: "NodeActivity"):
+        self.activity = activity
+        self.last_time = time.time()
+        self.dirty = True
+
+    def count(self, direction: "str", topic: "str", nbytes: "int"):
+        self.record(NodeActivity.ACTIVE)
+        counters = self.traffic[direction]
+        if topic not in counters:
+            # Rates cover the lifetime of the node, not of the topic
+            counters[topic] = TrafficCounter(self.start_time)
+        counters[topic].add(self.last_time, nbytes)
+        self.increment(f'messages:{direction}:{topic}')
+        self.increment(f'bytes:{direction}:{topic}', nbytes)
+
+    def increment(self, field: "str", count: "int" = 1):
+        self.counts[field] = self.counts.get(field, 0) + count
+
+    def received(self, topic: "str", nbytes: "int"):
+        self.count('in', topic, nbytes)
+
+    def sent(self, topic: "str", nbytes: "int"):
+        self.count('out', topic, nbytes)
+
+    def dropped(self, topic: "str", count: "int" = 1):
+        self.increment(f'dropped:{topic}', count)
+        self.dirty = True
+
+    def latency(self, topic: "str", kind: "str", seconds: "float"):
+        """Records a latency of a traced message, see
+        :py:data:`lemon.tracing.LATENCIES` for the kinds.
+        """
+        histogram = self.histograms.get((topic, kind))
+        if histogram is None:
+            histogram = self.histograms[topic, kind] = LatencyHistogram()
+        histogram.record(seconds)
+        self.dirty = True
+
+    def latencies(self) -> "dict[str, dict[str, dict[str, int]]]":
+        """Returns count, p50, p99 and max in microseconds per kind of
+        latency per topic.
+        """
+        latencies = {}
+        for (topic, kind), histogram in self.histograms.items():
+            latencies.setdefault(topic, {})[kind] = histogram.summary()
+        return latencies
+
+    def watch_queues(self, depths: "Callable[[], dict[str, int]]"):
+        """Reports the queue depths per topic returned by ``depths`` on
+        every flush.
+        """
+        self.queue_depths = depths
+
+    def rates(self) -> "dict":
+        now = time.time()
+        rates = {
+            direction: {
+                topic: counter.rates(now)
+                for topic, counter in counters.items()
+            }
+            for direction, counters in self.traffic.items()
+        }
+        rates['queued'] = self.queue_depths()
+        rates['latency'] = {
+            topic: {kind: (summary['p50'], summary['p99'], summary['max'])
+                    for kind, summary in kinds.items()}
+            for topic, kinds in self.latencies().items()}
+        return rates
+
+    async def flush(self, ctx: "AsyncNodeContext"):
+        self.dirty = False
+        counts, self.counts = self.counts, {}
+        key = health_id(ctx)
+
+        now = time.time()
+        fields = {
+            'flushed_at': now,
+            f'flushed_at@{self.writer}': now,
+            **encode_rates(self.rates(), self.writer)
+        }
+        if self.primary:
+            fields.update(activity=self.activity.name,
+                          start_time=self.start_time,
+                          last_time=self.last_time)
+
+        pipeline = ctx.redis_client.pipeline(transaction=False)
+        pipeline.hset(key, mapping=fields)
+        for field, count in counts.items():
+            pipeline.hincrby(key, field, count)
+        pipeline.hincrby(key, 'version', 1)
+        try:
+            await pipeline.execute()
+        except redis.exceptions.ConnectionError:
+            # Sent again with the next flush
+            for field, count in counts.items():
+                self.increment(field, count)
+            self.dirty = True
+            raise
 
     async def update(self, ctx: "AsyncNodeContext", activity: "NodeActivity"):
-        data = pickle.dumps((activity, self.start_time, time.time()))
-        await ctx.redis_client.set(health_id(ctx), data)
+        self.record(activity)
+        await self.flush(ctx)
+
+    async def heartbeat(self, ctx: "AsyncNodeContext"):
+        delay = self.interval
+        while True:
+            await asyncio.sleep(delay)
+            # Keep flushing while the windows still decay towards zero
+            recent = time.time() - self.last_time <= max(WINDOWS) + 1
+            if not (self.dirty or recent):
+                continue
+            try:
+                await self.flush(ctx)
+                delay = self.interval
+            except redis.exceptions.ConnectionError:
+                delay = min(2 * delay, HEALTH_MAX_BACKOFF)
+                try:
+                    await check_redis()
+                    ctx.renew()
+                except redis.exceptions.ConnectionError:
+                    pass
+
+    def start(self, ctx: "AsyncNodeContext"):
+        self.task = asyncio.get_event_loop().create_task(self.heartbeat(ctx))
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,150 @@
+import os
+import struct
+import uuid
+from lemon.utils import lazy_import
+
+resource_tracker = lazy_import('multiprocessing.resource_tracker')
+shared_memory = lazy_import('multiprocessing.shared_memory')
+
+SHM_ID = 6
+SHM_SIZE = 64 * 2 ** 20
+SHM_THRESHOLD = 64 * 2 ** 10
+
+# The first bytes of a segment hold the number of bytes reserved by the
+# writer so far and the size of the ring. Positions only ever grow and are
+# used as generations. The size is stored, since the segment may be larger
+# than requested (rounded up to pages, e.g., on macOS).
+RESERVED = struct.Struct('<Q')
+RING_SIZE = struct.Struct('<Q')
+HEADER_SIZE = RESERVED.size + RING_SIZE.size
+DESCRIPTOR = struct.Struct('<BQQ')
+
+
+class MessageLost(Exception):
+    pass
+
+
+def segment_prefix() -> "str":
+    """Prefix of the names of the segments created by this process."""
+    return f'lemon_{os.getpid()}_'
+
+
+class SharedMemoryRing:
+    """Ring buffer in a ``multiprocessing.shared_memory`` segment with a
+    single writer. Every message is identified by its absolute position in
+    the stream of written bytes (its *generation*). The writer announces
+    the bytes it is about to overwrite before writing them, so a reader can
+    tell whether a message was overwritten while it was being read.
+    """
+
+    def __init__(self, name: "str" = None, size: "int" = SHM_SIZE):
+        if name is None:
+            self.segment = shared_memory.SharedMemory(
+                f'{segment_prefix()}{uuid.uuid4().hex[:8]}', create=True,
+                size=HEADER_SIZE + size)
+            RING_SIZE.pack_into(self.segment.buf, RESERVED.size, size)
+            self.owner = True
+        else:
+            self.segment = shared_memory.SharedMemory(name)
+            # Readers must not unlink the segment of the writer on exit,
+            # while the writer's registration in this process is kept
+            if not name.startswith(segment_prefix()):
+                resource_tracker.unregister(
+                    self.segment._name, 'shared_memory')
+            self.owner = False
+
+        self.name = self.segment.name
+        self.buffer = self.segment.buf
+        self.size = RING_SIZE.unpack_from(self.buffer, RESERVED.size)[0]
+
+    def reserved(self) -> "int":
+        return RESERVED.unpack_from(self.buffer)[0]
+
+    def write(self, data: "bytes") -> "tuple[int, int]":
+        length = len(data)
+        if length > self.size:
+            raise ValueError(f'Message of {length} bytes exceeds ring size')
+
+        generation = self.reserved()
+        offset = generation % self.size
+        if offset + length > self.size:
+            # Skip the tail so that every message is contiguous
+            generation += self.size - offset
+            offset = 0
+
+        RESERVED.pack_into(self.buffer, 0, generation + length)
+        start = HEADER_SIZE + offset
+        self.buffer[start:start + length] = data
+        return generation, length
+
+    def read(self, generation: "int", length: "int") -> "bytes":
+        start = HEADER_SIZE + generation % self.size
+        data = bytes(self.buffer[start:start + length])
+        if self.reserved() > generation + self.size:
+            raise MessageLost
+        return data
+
+    def close(self):
+        self.buffer = None
+        self.segment.close()
+        if self.owner:
+            self.segment.unlink()
+
+
+class SharedMemoryTransport:
+    """Moves large payloads through a :py:class:`SharedMemoryRing` owned by
+    this process, while redis only carries a small descriptor: ``SHM_ID``,
+    generation, length and the name of the segment.
+    """
+
+    def __init__(self, size: "int" = SHM_SIZE,
+                 threshold: "int" = SHM_THRESHOLD):
+        self.size = size
+        self.threshold = threshold
+        self.ring = None
+        self.rings = {}
+
+    def wrap(self, data: "bytes") -> "bytes":
+        if len(data) < self.threshold:
+            return data
+        if self.ring is None:
+            self.ring = SharedMemoryRing(size=self.size)
+        generation, length = self.ring.write(data)
+        return DESCRIPTOR.pack(
+            SHM_ID, generation, length) + self.ring.name.encode('utf-8')
+
+    def unwrap(self, message: "bytes") -> "bytes":
+        _, generation, length = DESCRIPTOR.unpack_from(message)
+        name = bytes(message[DESCRIPTOR.size:]).decode('utf-8')
+        if self.ring is not None and name == self.ring.name:
+            # Published by this process
+            return self.ring.read(generation, length)
+        ring = self.rings.get(name)
+        if ring is None:
+            # A publisher only writes to its newest segment, so the ones it
+            # had before are gone
+            self.forget(name.rsplit('_', 1)[0] + '_')
+            try:
+                ring = self.rings[name] = SharedMemoryRing(name)
+            except FileNotFoundError:
+                raise MessageLost
+        try:
+            return ring.read(generation, length)
+        except MessageLost:
+            # The segment is attached again on its next message, unless its
+            # publisher is gone
+            self.forget(name)
+            raise
+
+    def forget(self, prefix: "str"):
+        """Closes the attached segments whose names start with ``prefix``."""
+        for name in [name for name in self.rings if name.startswith(prefix)]:
+            self.rings.pop(name).close()
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
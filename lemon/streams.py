@@ -0,0 +1,129 @@
+import asyncio
+import redis
+from lemon.ctx import AsyncNodeContext
+from lemon.dispatch import Dispatcher
+
+STREAM_MAXLEN = 10000
+STREAM_COUNT = 100
+CLAIM_IDLE = 30.0
+CLAIM_INTERVAL = 10.0
+FIELD = b'd'
+
+
+def stream_key(topic: "str") -> "str":
+    return f'!stream:{topic}'
+
+
+def stream_group(ctx: "AsyncNodeContext") -> "str":
+    return f'{ctx.mesh}:{ctx.name}'
+
+
+class StreamReceiver:
+    """Reads the streams of ``topics`` as consumer ``ctx.name`` of a
+    consumer group and hands their entries to a :py:class:`Dispatcher`.
+    Entries are acknowledged in bulk once they were processed or dropped
+    (and counted as such), so that entries of a crashed or restarted
+    consumer are delivered again: a consumer first re-reads its own pending
+    entries, and periodically claims entries that other consumers of the
+    group left pending for more than ``CLAIM_IDLE`` seconds. Entries that
+    this consumer still queues, processes or acknowledges (*in flight*) are
+    pending as well, and are skipped when they are read again.
+    """
+
+    def __init__(self, ctx: "AsyncNodeContext", topics: "list[str]",
+                 dispatcher: "Dispatcher", group: "str" = None):
+        self.ctx = ctx
+        self.dispatcher = dispatcher
+        self.group = group or stream_group(ctx)
+        self.consumer = ctx.name
+        self.topics = {stream_key(topic): topic for topic in topics}
+        self.acks = {}
+        self.inflight = set()
+        self.last_claim = 0
+
+    def ack(self, key: "str", id: "bytes"):
+        self.acks.setdefault(key, []).append(id)
+
+    async def flush_acks(self):
+        acks, self.acks = self.acks, {}
+        if not acks:
+            return
+        pipeline = self.ctx.redis_client.pipeline(transaction=False)
+        for key, ids in acks.items():
+            pipeline.xack(key, self.group, *ids)
+        try:
+            await pipeline.execute()
+        except redis.exceptions.ConnectionError:
+            # Sent again with the next flush
+            for key, ids in acks.items():
+                self.acks.setdefault(key, []).extend(ids)
+            raise
+        for key, ids in acks.items():
+            self.inflight.difference_update((key, id) for id in ids)
+
+    async def create_groups(self):
+        for key in self.topics:
+            try:
+                await self.ctx.redis_client.xgroup_create(
+                    key, self.group, id='$', mkstream=True)
+            except redis.exceptions.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    async def dispatch(self, key: "str", entries: "list"):
+        topic = self.topics[key]
+        for id, fields in entries:
+            if id is None or (key, id) in self.inflight:
+                continue
+            if not fields:
+                # Entry was trimmed from the stream before it was read
+                self.dispatcher.health_service.dropped(topic)
+                self.ack(key, id)
+                continue
+            self.inflight.add((key, id))
+            await self.dispatcher.dispatch(
+                topic, fields[FIELD],
+                lambda key=key, id=id: self.ack(key, id))
+
+    async def read(self, ids: "dict[str, str]", block: "int" = None
+                   ) -> "dict[str, list]":
+        response = await self.ctx.redis_client.xreadgroup(
+            self.group, self.consumer, ids, count=STREAM_COUNT, block=block)
+        entries = {}
+        for key, key_entries in response or []:
+            key = key.decode('utf8') if isinstance(key, bytes) else key
+            entries[key] = key_entries
+            await self.dispatch(key, key_entries)
+        return entries
+
+    async def recover(self):
+        # Own entries that were delivered before but never acknowledged
+        for key in self.topics:
+            last = '0'
+            while True:
+                entries = (await self.read({key: last})).get(key)
+                if not entries:
+                    break
+                last = entries[-1][0]
+
+    async def claim(self):
+        loop = asyncio.get_event_loop()
+        if loop.time() - self.last_claim < CLAIM_INTERVAL:
+            return
+        self.last_claim = loop.time()
+
+        for key in self.topics:
+            _, entries, *_ = await self.ctx.redis_client.xautoclaim(
+                key, self.group, self.consumer, int(1e3 * CLAIM_IDLE),
+                count=STREAM_COUNT)
+            await self.dispatch(key, entries)
+
+    async def start(self):
+        await self.create_groups()
+        await self.recover()
+
+    async def update(self, timeout: "float"):
+        await self.flush_acks()
+        await self.claim()
+        await self.read({key: '>' for key in self.topics},
+                        block=max(1, int(1e3 * timeout)))
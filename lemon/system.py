@@ -1,30 +1,61 @@
 import io
-import time
+import signal
 from lemon.ctx import AsyncNodeContext, NodeContext
-from lemon.utils import Severity, bold_str, severity_to_message
+from lemon.utils import Severity, bold_str, lazy_import, severity_to_message
 import os
-import psutil
 import subprocess
 import pathlib
 
 
+psutil = lazy_import('psutil')
+
+# Seconds a node gets to exit after SIGINT, and again after SIGTERM
+STOP_TIMEOUT = 5.0
+
+
 class NodePIDNotFound(Exception):
     pass
 
 
 class LogFileService:
-    def open(ctx: "NodeContext", mode: "str") -> "io.TextIOWrctxer":
+    def directory() -> "str":
         logdir = str(pathlib.Path.home()) + '/lemon/logs'
 
         if not os.path.exists(logdir):
             os.makedirs(logdir)
 
-        return open(f'{logdir}/{ctx.name}.txt', mode)
+        return logdir
+
+    def open(ctx: "NodeContext", mode: "str") -> "io.TextIOWrctxer":
+        return open(f'{LogFileService.directory()}/{ctx.name}.txt', mode)
+
+    def build_path(mesh: "str", name: "str") -> "str":
+        return f'{LogFileService.directory()}/{mesh}.{name}.build.txt'
+
+
+def pid_id(ctx: "NodeContext") -> "str":
+    return f"{ctx.mesh}:{ctx.name}:pid"
+
+
+def subscribed_id(ctx: "NodeContext") -> "str":
+    return f"{ctx.mesh}:{ctx.name}:subscribed"
 
 
 class ProcessService:
     async def self_register(ctx: "AsyncNodeContext"):
-        await ctx.redis_client.set(f"{ctx.mesh}:{ctx.name}:pid", os.getpid())
+        await ctx.redis_client.set(pid_id(ctx), os.getpid())
+
+    async def mark_subscribed(ctx: "AsyncNodeContext"):
+        await ctx.redis_client.set(subscribed_id(ctx), os.getpid())
+
+    def is_ready(ctx: "NodeContext", subscribes: "bool") -> "bool":
+        """Whether a node self-registered and, if it ``subscribes``, is
+        subscribed to its topics since it was last started.
+        """
+        keys = [pid_id(ctx)]
+        if subscribes:
+            keys.append(subscribed_id(ctx))
+        return all(ctx.redis_client.mget(keys))
 
     def self_terminate():
         psutil.Process().terminate()
@@ -32,6 +63,9 @@ class ProcessService:
     def start(ctx: "NodeContext",
               additional_args: "list[str]") -> "subprocess.Popen":
 
+        # Readiness refers to the new process only
+        ctx.redis_client.delete(pid_id(ctx), subscribed_id(ctx))
+
         logfile = LogFileService.open(ctx, 'wb')
         return subprocess.Popen([
             ctx.node,
@@ -39,33 +73,61 @@ class ProcessService:
             '-n', ctx.name
         ] + additional_args, stdout=logfile, stderr=logfile)
 
-    def stop(ctx: "NodeContext"):
+    def interrupt(ctx: "NodeContext") -> "psutil.Process":
         pid = ProcessService.get_pid(ctx)
         process = psutil.Process(pid)
-        process.send_signal(2)
-        time.sleep(1)
+        process.send_signal(signal.SIGINT)
+        return process
 
-        ProcessService.force_quit(process)
+    def wait(processes: "list[psutil.Process]",
+             timeout: "float" = STOP_TIMEOUT):
+        """Waits until all ``processes`` exited, force quitting the ones
+        that are still running after ``timeout`` seconds.
+        """
+        _, alive = psutil.wait_procs(processes, timeout=timeout)
+        ProcessService.force_quit(alive, timeout)
+
+    def stop(ctx: "NodeContext", timeout: "float" = STOP_TIMEOUT):
+        ProcessService.wait([ProcessService.interrupt(ctx)], timeout)
 
     def is_running(ctx: "NodeContext"):
         try:
             pid = ProcessService.get_pid(ctx)
-            return psutil.pid_exists(pid)
+            return ProcessService.pid_exists(pid)
         except NodePIDNotFound:
             return False
 
+    def pid_exists(pid: "int") -> "bool":
+        return psutil.pid_exists(pid)
+
     def get_pid(ctx: "NodeContext") -> int:
-        pid = ctx.redis_client.get(f"{ctx.mesh}:{ctx.name}:pid")
+        pid = ctx.redis_client.get(pid_id(ctx))
 
         if not pid:
             raise NodePIDNotFound
 
         return int(pid.decode('utf-8'))
 
-    def force_quit(process: "psutil.Process"):
-        if process.is_running():
+    def force_quit(processes: "list[psutil.Process]",
+                   timeout: "float" = STOP_TIMEOUT):
+        """Terminates ``processes`` and kills the ones that are still
+        running after ``timeout`` seconds.
+        """
+        for process in processes:
             severity_to_message(Severity.Information, (
                 f'Process {bold_str(process.pid)}'
                 + ' has to be interrupted forcefully'
             ))
-            process.terminate()
+            try:
+                process.terminate()
+            except psutil.NoSuchProcess:
+                pass
+
+        _, alive = psutil.wait_procs(processes, timeout=timeout)
+        for process in alive:
+            severity_to_message(Severity.Warning, (
+                f'Process {bold_str(process.pid)} has to be killed'))
+            try:
+                process.kill()
+            except psutil.NoSuchProcess:
+                pass
@@ -0,0 +1,347 @@
+import asyncio
+from collections import deque
+import weakref
+import redis
+from lemon.utils import compile_pattern
+
+# In-process stand-in for the redis server, for tests and benchmarks that
+# should not depend on a running ``redis-server``. It implements the subset
+# of the (sync and asyncio) redis-py API that Lemon uses: strings, hashes,
+# pub/sub (including patterns) and pipelines, but no streams. Clients of
+# ``memory://<name>`` URLs (see ``ensure_redis``) share one broker per name
+# within the process. Messages are delivered synchronously on publish, so
+# everything has to run in one thread (and asyncio clients in one loop).
+MEMORY_SCHEME = 'memory://'
+VERSION = 'lemon.testing'
+# Subscriptions that the unsubscribe messages of pub/sub end
+UNSUBSCRIBE = {'unsubscribe': 'subscribe', 'punsubscribe': 'psubscribe'}
+
+
+def encode(value) -> "bytes":
+    """Encodes keys and values as redis-py does before sending them."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if isinstance(value, str):
+        return value.encode('utf8')
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value).encode('utf8')
+    raise redis.exceptions.DataError(
+        f'Invalid input of type {type(value).__name__}')
+
+
+def matches(pattern: "bytes", name: "bytes") -> "bool":
+    return bool(compile_pattern(pattern.decode('utf8')).fullmatch(
+        name.decode('utf8', 'replace')))
+
+
+class Broker:
+    """State of one in-memory server: the keys and the subscriptions."""
+
+    def __init__(self):
+        self.data: "dict[bytes, bytes | dict[bytes, bytes]]" = {}
+        self.channels: "dict[bytes, weakref.WeakSet]" = {}
+        self.patterns: "dict[bytes, weakref.WeakSet]" = {}
+
+    def subscribers(self, subscriptions: "dict[bytes, weakref.WeakSet]",
+                    name: "bytes") -> "list":
+        return list(subscriptions.get(name, ()))
+
+    def publish(self, channel: "bytes", data: "bytes") -> "int":
+        receivers = 0
+        for pubsub in self.subscribers(self.channels, channel):
+            pubsub.deliver({'type': 'message', 'pattern': None,
+                            'channel': channel, 'data': data})
+            receivers += 1
+        for pattern in list(self.patterns):
+            if not matches(pattern, channel):
+                continue
+            for pubsub in self.subscribers(self.patterns, pattern):
+                pubsub.deliver({'type': 'pmessage', 'pattern': pattern,
+                                'channel': channel, 'data': data})
+                receivers += 1
+        return receivers
+
+
+BROKERS: "dict[str, Broker]" = {}
+
+
+def get_broker(url: "str" = MEMORY_SCHEME) -> "Broker":
+    """Returns the broker of ``url`` (``memory://<name>``)."""
+    broker = BROKERS.get(url)
+    if broker is None:
+        broker = BROKERS[url] = Broker()
+    return broker
+
+
+def reset():
+    """Forgets all brokers, e.g., between tests."""
+    BROKERS.clear()
+
+
+def client(url: "str" = MEMORY_SCHEME, do_async: "bool" = False):
+    """Returns a client of the broker of ``url``, see
+    :py:func:`lemon.utils.ensure_redis`.
+    """
+    broker = get_broker(url)
+    return AsyncRedis(broker) if do_async else Redis(broker)
+
+
+class Redis:
+    """Client with the commands of ``redis.Redis`` that Lemon uses."""
+
+    def __init__(self, broker: "Broker"):
+        self.broker = broker
+
+    def value(self, name, kind: "type"):
+        value = self.broker.data.get(encode(name))
+        if value is not None and not isinstance(value, kind):
+            raise redis.exceptions.ResponseError(
+                'WRONGTYPE Operation against a key holding the wrong kind '
+                'of value')
+        return value
+
+    def ping(self) -> "bool":
+        return True
+
+    def info(self, section: "str" = None) -> "dict":
+        return {'redis_version': VERSION}
+
+    def close(self):
+        pass
+
+    def get(self, name) -> "bytes":
+        return self.value(name, bytes)
+
+    def set(self, name, value) -> "bool":
+        self.broker.data[encode(name)] = encode(value)
+        return True
+
+    def mget(self, keys, *args) -> "list[bytes]":
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        return [self.get(key) for key in keys + list(args)]
+
+    def delete(self, *names) -> "int":
+        return sum(self.broker.data.pop(encode(name), None) is not None
+                   for name in names)
+
+    def exists(self, *names) -> "int":
+        return sum(encode(name) in self.broker.data for name in names)
+
+    def keys(self, pattern='*') -> "list[bytes]":
+        return [key for key in self.broker.data
+                if matches(encode(pattern), key)]
+
+    def hset(self, name, key=None, value=None, mapping=None) -> "int":
+        fields = dict(mapping or {})
+        if key is not None:
+            fields[key] = value
+        if not fields:
+            raise redis.exceptions.DataError("'hset' with no key value pairs")
+        stored = self.value(name, dict)
+        if stored is None:
+            stored = self.broker.data[encode(name)] = {}
+        added = 0
+        for field, field_value in fields.items():
+            field = encode(field)
+            added += field not in stored
+            stored[field] = encode(field_value)
+        return added
+
+    def hget(self, name, key) -> "bytes":
+        return (self.value(name, dict) or {}).get(encode(key))
+
+    def hmget(self, name, keys, *args) -> "list[bytes]":
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        return [self.hget(name, key) for key in keys + list(args)]
+
+    def hgetall(self, name) -> "dict[bytes, bytes]":
+        return dict(self.value(name, dict) or {})
+
+    def hincrby(self, name, key, amount: "int" = 1) -> "int":
+        count = int(self.hget(name, key) or 0) + amount
+        self.hset(name, key, count)
+        return count
+
+    def publish(self, channel, message) -> "int":
+        return self.broker.publish(encode(channel), encode(message))
+
+    def pubsub_channels(self, pattern='*') -> "list[bytes]":
+        return [channel for channel, pubsubs in self.broker.channels.items()
+                if pubsubs and matches(encode(pattern), channel)]
+
+    def pubsub_numsub(self, *args) -> "list[tuple[bytes, int]]":
+        return [(encode(channel), len(self.broker.subscribers(
+            self.broker.channels, encode(channel)))) for channel in args]
+
+    def pubsub_numpat(self) -> "int":
+        return sum(1 for pubsubs in self.broker.patterns.values() if pubsubs)
+
+    def pubsub(self) -> "PubSub":
+        return PubSub(self.broker)
+
+    def pipeline(self, transaction: "bool" = True) -> "Pipeline":
+        return Pipeline(self)
+
+
+class AsyncRedis:
+    """Client with the commands of ``redis.asyncio.Redis`` that Lemon uses,
+    i.e., the commands of :py:class:`Redis` as coroutines.
+    """
+
+    def __init__(self, broker: "Broker"):
+        self.broker = broker
+        self.client = Redis(broker)
+
+    def __getattr__(self, name: "str"):
+        command = getattr(self.client, name)
+
+        async def execute(*args, **kwargs):
+            return command(*args, **kwargs)
+        return execute
+
+    async def close(self, close_connection_pool: "bool" = None):
+        pass
+
+    def pubsub(self) -> "AsyncPubSub":
+        return AsyncPubSub(self.broker)
+
+    def pipeline(self, transaction: "bool" = True) -> "AsyncPipeline":
+        return AsyncPipeline(self.client)
+
+
+class Pipeline:
+    """Queues commands of ``client`` until :py:meth:`execute`. Commands of
+    the broker are atomic anyway, so ``transaction`` makes no difference.
+    """
+
+    def __init__(self, client: "Redis"):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name: "str"):
+        getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self, raise_on_error: "bool" = True) -> "list":
+        commands, self.commands = self.commands, []
+        results = []
+        for name, args, kwargs in commands:
+            try:
+                results.append(getattr(self.client, name)(*args, **kwargs))
+            except redis.exceptions.ResponseError as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
+
+
+class AsyncPipeline(Pipeline):
+    async def execute(self, raise_on_error: "bool" = True) -> "list":
+        return Pipeline.execute(self, raise_on_error)
+
+
+class PubSub:
+    """Subscriptions of one client. Messages are queued on publish and
+    returned by :py:meth:`get_message` as redis-py does.
+    """
+
+    def __init__(self, broker: "Broker"):
+        self.broker = broker
+        self.messages = deque()
+        self.subscribed = {'subscribe': set(), 'psubscribe': set()}
+
+    def deliver(self, message: "dict"):
+        self.messages.append(message)
+
+    def change(self, kind: "str", names):
+        subscription = UNSUBSCRIBE.get(kind, kind)
+        subscriptions = (self.broker.patterns if subscription == 'psubscribe'
+                         else self.broker.channels)
+        own = self.subscribed[subscription]
+        for name in map(encode, names):
+            if kind in UNSUBSCRIBE:
+                own.discard(name)
+                subscriptions.get(name, weakref.WeakSet()).discard(self)
+            else:
+                own.add(name)
+                subscriptions.setdefault(name, weakref.WeakSet()).add(self)
+            self.deliver({
+                'type': kind, 'pattern': None, 'channel': name,
+                'data': sum(map(len, self.subscribed.values()))})
+
+    def subscribe(self, *channels):
+        self.change('subscribe', channels)
+
+    def psubscribe(self, *patterns):
+        self.change('psubscribe', patterns)
+
+    def unsubscribe(self, *channels):
+        self.change('unsubscribe',
+                    channels or list(self.subscribed['subscribe']))
+
+    def punsubscribe(self, *patterns):
+        self.change('punsubscribe',
+                    patterns or list(self.subscribed['psubscribe']))
+
+    def next_message(self, ignore_subscribe_messages: "bool") -> "dict":
+        while self.messages:
+            message = self.messages.popleft()
+            if not ignore_subscribe_messages or message['type'] in (
+                    'message', 'pmessage'):
+                return message
+        return None
+
+    def get_message(self, ignore_subscribe_messages: "bool" = False,
+                    timeout: "float" = 0.0) -> "dict":
+        # Nothing can be published while this thread waits, so it does not
+        # wait for ``timeout``
+        return self.next_message(ignore_subscribe_messages)
+
+    def close(self):
+        self.change('unsubscribe', list(self.subscribed['subscribe']))
+        self.change('punsubscribe', list(self.subscribed['psubscribe']))
+        self.messages.clear()
+
+
+class AsyncPubSub(PubSub):
+    def __init__(self, broker: "Broker"):
+        PubSub.__init__(self, broker)
+        self.received = asyncio.Event()
+
+    def deliver(self, message: "dict"):
+        PubSub.deliver(self, message)
+        self.received.set()
+
+    async def subscribe(self, *channels):
+        PubSub.subscribe(self, *channels)
+
+    async def psubscribe(self, *patterns):
+        PubSub.psubscribe(self, *patterns)
+
+    async def unsubscribe(self, *channels):
+        PubSub.unsubscribe(self, *channels)
+
+    async def punsubscribe(self, *patterns):
+        PubSub.punsubscribe(self, *patterns)
+
+    async def get_message(self, ignore_subscribe_messages: "bool" = False,
+                          timeout: "float" = 0.0) -> "dict":
+        """Waits up to ``timeout`` seconds (forever if None) for a
+        message.
+        """
+        message = self.next_message(ignore_subscribe_messages)
+        if message is None and (timeout is None or timeout > 0):
+            self.received.clear()
+            try:
+                await asyncio.wait_for(self.received.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            message = self.next_message(ignore_subscribe_messages)
+        return message
+
+    async def close(self):
+        PubSub.close(self)
@@ -1,8 +1,34 @@
 from enum import Enum
+import importlib.util
+import os
+import re
 import subprocess
+import sys
 import time
-import redis.asyncio as aioredis
-import redis
+from urllib.parse import urlparse
+
+
+def lazy_import(name: "str"):
+    """Returns the module ``name``, which is only executed once one of its
+    attributes is used. Keeps the start of the CLI and of nodes from
+    loading dependencies they may not need. Raises ``ModuleNotFoundError``
+    right away if ``name`` is not installed.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+redis = lazy_import('redis')
 
 
 class Severity(Enum):
@@ -58,17 +84,117 @@ def bold_str(text):
     return '\033[1m' + str(text) + '\033[0m'
 
 
-def ensure_redis(do_async=False):
-    client = redis.Redis(host='localhost', port=6379)
+REDIS_URL = 'redis://localhost:6379'
+REDIS_URL_ENV = 'LEMON_REDIS_URL'
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+SERVER_TIMEOUT = 5.0
+POLL_INTERVAL = 1e-2
+
+# Connection pools of this process by URL and mode, see ``ensure_redis``
+POOLS = {}
+SERVERS = set()
+
+
+def get_redis_url() -> "str":
+    """Returns the URL of the redis server used by this process. It is set
+    via the ``LEMON_REDIS_URL`` environment variable, which is passed on to
+    the nodes started by ``lemon start``.
+    """
+    return os.environ.get(REDIS_URL_ENV) or REDIS_URL
+
+
+def set_redis_url(url: "str"):
+    os.environ[REDIS_URL_ENV] = url
+
+
+def server_args(url: "str") -> "list[str]":
+    """Returns the command that starts a redis server on ``url``, or None
+    if the server is not local.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'unix':
+        return ['redis-server', '--daemonize', 'yes', '--port', '0',
+                '--unixsocket', parsed.path, '--unixsocketperm', '700']
+    if parsed.hostname not in LOCAL_HOSTS:
+        return None
+    return ['redis-server', '--daemonize', 'yes',
+            '--port', str(parsed.port or 6379)]
+
+
+def ensure_server(url: "str", pool: "redis.ConnectionPool"):
+    """Makes sure a redis server is listening on ``url``. A local server is
+    only spawned if it can not be reached, and then polled until it is
+    ready. Raises ``redis.exceptions.ConnectionError`` if there is no server
+    and none could be spawned.
+    """
+    client = redis.Redis(connection_pool=pool)
     try:
         client.ping()
-    except redis.exceptions.ConnectionError:
-        subprocess.Popen([
-            'redis-server', '--daemonize', 'yes'
-        ])
-    time.sleep(.05)
-    return (
-        aioredis if do_async else redis).Redis(host='localhost', port=6379)
+        return
+    except redis.exceptions.ConnectionError as e:
+        args = server_args(url)
+        if args is None:
+            raise
+        try:
+            subprocess.Popen(args)
+        except OSError:
+            # E.g., no redis-server installed, as for a server in a container
+            raise e
+
+    deadline = time.monotonic() + SERVER_TIMEOUT
+    while True:
+        time.sleep(POLL_INTERVAL)
+        try:
+            client.ping()
+            return
+        except redis.exceptions.ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+
+
+def ensure_redis(do_async=False, url: "str" = None, check=False):
+    """Returns a client of the redis server at ``url``, e.g.,
+    ``redis://localhost:6379`` or ``unix:///tmp/redis.sock`` (defaults to
+    :py:func:`get_redis_url`). Clients share a connection pool per URL
+    (and, for asyncio clients, per event loop) within the process, so
+    creating a client is cheap. The server is checked once per URL, or
+    again if ``check`` is set (e.g., after the connection was lost), and
+    spawned if it is local and not running. ``memory://<name>`` URLs use
+    the in-process broker of :py:mod:`lemon.testing` instead.
+    """
+    url = url or get_redis_url()
+    if url.startswith('memory://'):
+        from lemon import testing
+        return testing.client(url, do_async)
+    pool = POOLS.get((url, False, None))
+    if pool is None:
+        pool = POOLS[url, False, None] = redis.ConnectionPool.from_url(url)
+    if check or url not in SERVERS:
+        ensure_server(url, pool)
+        SERVERS.add(url)
+
+    if not do_async:
+        return redis.Redis(connection_pool=pool)
+
+    import asyncio
+    import redis.asyncio as aioredis
+
+    # Connections of asyncio pools are bound to the loop they were made in
+    loop = asyncio.get_event_loop()
+    pool = POOLS.get((url, True, loop))
+    if pool is None:
+        pool = POOLS[url, True, loop] = aioredis.ConnectionPool.from_url(url)
+    return aioredis.Redis(connection_pool=pool)
+
+
+async def check_redis(url: "str" = None):
+    """Checks the redis server at ``url`` as ``ensure_redis(check=True)``
+    does, but in an executor, since spawning and polling a local server
+    would block the event loop for up to ``SERVER_TIMEOUT`` seconds.
+    """
+    import asyncio
+    await asyncio.get_event_loop().run_in_executor(
+        None, lambda: ensure_redis(url=url, check=True))
 
 
 class NodeActivity(Enum):
@@ -80,3 +206,39 @@ class NodeActivity(Enum):
 
     def __str__(self):
         return self.value
+
+
+def is_pattern(topic: "str") -> "bool":
+    """Whether ``topic`` is a glob-style pattern (``*``, ``?``, ``[...]``)
+    rather than a topic name.
+    """
+    return any(char in topic for char in '*?[')
+
+
+def compile_pattern(pattern: "str") -> "re.Pattern":
+    """Compiles a glob-style pattern with the semantics of redis'
+    ``PSUBSCRIBE``, i.e., ``*`` also matches ``/`` and ``\\`` escapes.
+    """
+    regex, i = [], 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '*':
+            regex.append('.*')
+        elif char == '?':
+            regex.append('.')
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        elif char == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            members = pattern[i + 1:end]
+            negate = members.startswith('^')
+            members = members[1:] if negate else members
+            for special in '\\[^':
+                members = members.replace(special, '\\' + special)
+            regex.append(f"[{'^' if negate else ''}{members}]")
+            i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return re.compile(''.join(regex), re.DOTALL)
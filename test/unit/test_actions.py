@@ -1,9 +1,15 @@
+from unittest.mock import MagicMock
+import json
+import os
 import pickle
+import time
 from lemon.system import NodePIDNotFound
 import psutil
 from pytest_mock.plugin import MockerFixture
 from lemon.actions import (
+    CLEAR_SCREEN,
     build,
+    cli,
     start,
     stop,
     show
@@ -49,7 +55,7 @@ def test_build_with_node(mocker: "MockerFixture"):
     client.set.assert_any_call('mesh1', pickle.dumps([node1]))
 
     init_health.assert_called_once()
-    assert str(ossystem.call_args[0][0]).endswith('pip install -e source1')
+    assert 'pip install -e source1 >' in ossystem.call_args[0][0]
 
 
 def test_build_with_node_name_only(mocker: "MockerFixture"):
@@ -77,6 +83,111 @@ def test_build_with_node_name_only(mocker: "MockerFixture"):
     assert init_health.call_args[0][0].node == 'node1'
 
 
+def test_build_with_replicas(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    init_health = mocker.patch('lemon.build.init_health')
+    runner = CliRunner()
+
+    mocker.patch('lemon.actions.os.system', return_value=0)
+    node1 = {
+        'name': 'node1',
+        'node': 'node1',
+        'from': 'source1',
+        'replicas': 3
+    }
+
+    mocker.patch('lemon.actions.open')
+    mocker.patch('lemon.actions.yaml.safe_load', return_value=[{
+        'mesh': 'mesh1',
+        'nodes': [node1]
+    }])
+
+    runner.invoke(build)
+
+    client.set.assert_any_call('mesh1', pickle.dumps([node1]))
+    assert [call[0][0].name for call in init_health.call_args_list] == [
+        'node1-0', 'node1-1', 'node1-2']
+
+
+def test_build_with_redis_url(mocker: "MockerFixture"):
+    setup_client(mocker)
+    os.environ.pop('LEMON_REDIS_URL', None)
+    ensure_redis = mocker.patch('lemon.actions.ensure_redis')
+    build_mesh = mocker.patch('lemon.actions.build_mesh')
+    runner = CliRunner()
+
+    mocker.patch('lemon.actions.open')
+    mocker.patch('lemon.actions.yaml.safe_load', return_value=[{
+        'mesh': 'mesh1',
+        'redis': 'unix:///tmp/redis.sock',
+        'nodes': []
+    }, {
+        'mesh': 'mesh2',
+        'nodes': []
+    }])
+
+    urls = []
+    ensure_redis.side_effect = lambda: urls.append(
+        os.environ['LEMON_REDIS_URL'])
+    runner.invoke(build)
+
+    assert urls == ['unix:///tmp/redis.sock', 'redis://localhost:6379']
+    assert build_mesh.call_count == 2
+
+
+def test_build_skips_unchanged_node(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    init_health = mocker.patch('lemon.build.init_health')
+    mocker.patch('lemon.build.fingerprint', return_value='abc')
+    client.get.return_value = b'abc'
+    runner = CliRunner()
+
+    ossystem = mocker.patch('lemon.actions.os.system', return_value=0)
+    node1 = {
+        'name': 'node1',
+        'node': 'node1',
+        'from': 'source1'
+    }
+
+    mocker.patch('lemon.actions.open')
+    mocker.patch('lemon.actions.yaml.safe_load', return_value=[{
+        'mesh': 'mesh1',
+        'nodes': [node1]
+    }])
+
+    runner.invoke(build)
+
+    ossystem.assert_not_called()
+    init_health.assert_called_once()
+    client.set.assert_any_call('mesh1', pickle.dumps([node1]))
+
+    runner.invoke(build, ['--force'])
+
+    ossystem.assert_called_once()
+    client.set.assert_any_call('mesh1:node1:build', 'abc')
+
+
+def test_build_stores_fingerprint(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    mocker.patch('lemon.build.init_health')
+    mocker.patch('lemon.build.fingerprint', return_value='def')
+    client.get.return_value = b'abc'
+    runner = CliRunner()
+
+    ossystem = mocker.patch('lemon.actions.os.system', return_value=0)
+    mocker.patch('lemon.actions.open')
+    mocker.patch('lemon.actions.yaml.safe_load', return_value=[{
+        'mesh': 'mesh1',
+        'nodes': [{'name': 'node1', 'from': 'source1'}]
+    }])
+
+    runner.invoke(build)
+
+    ossystem.assert_called_once()
+    client.get.assert_any_call('mesh1:node1:build')
+    client.set.assert_any_call('mesh1:node1:build', 'def')
+
+
 def test_build_with_invalid_yaml(mocker: "MockerFixture"):
     client, _ = setup_client(mocker)
     init_health = mocker.patch('lemon.build.init_health')
@@ -120,6 +231,70 @@ def test_build_with_failure(mocker: "MockerFixture"):
     system_call.assert_called_once()
 
 
+def test_build_in_parallel(mocker: "MockerFixture", tmp_path):
+    client, _ = setup_client(mocker)
+    init_health = mocker.patch('lemon.build.init_health')
+    mocker.patch('lemon.build.LogFileService.build_path',
+                 side_effect=lambda mesh, name: str(
+                     tmp_path / f'{mesh}.{name}.build.txt'))
+    (tmp_path / 'mesh1.node2.build.txt').write_text('error: no setup.py\n')
+    runner = CliRunner()
+
+    system_call = mocker.patch(
+        'lemon.actions.os.system',
+        side_effect=lambda command: 256 if 'source2' in command else 0)
+
+    mocker.patch('lemon.actions.open')
+    mocker.patch('lemon.actions.yaml.safe_load', return_value=[{
+        'mesh': 'mesh1',
+        'nodes': [
+            {'name': 'node1', 'from': 'source1'},
+            {'name': 'node2', 'from': 'source2'},
+            {'name': 'node3', 'from': 'source3'}
+        ]
+    }])
+
+    result = runner.invoke(build, ['-j', '3'])
+
+    assert system_call.call_count == 3
+    assert init_health.call_count == 2
+    assert any('source2 > ' in command and 'mesh1.node2.build.txt' in command
+               for (command,), _ in system_call.call_args_list)
+    assert 'node2' in result.output
+    assert 'error: no setup.py' in result.output
+    assert 'Build failed' in result.output
+    client.set.assert_not_called()
+
+
+def test_build_in_parallel_installs_one_at_a_time(mocker: "MockerFixture"):
+    setup_client(mocker)
+    mocker.patch('lemon.build.init_health')
+    runner = CliRunner()
+
+    running, overlaps = [], []
+
+    def install(command):
+        running.append(command)
+        overlaps.append(len(running) > 1)
+        time.sleep(0.05)
+        running.remove(command)
+        return 0
+
+    system_call = mocker.patch('lemon.actions.os.system', side_effect=install)
+
+    mocker.patch('lemon.actions.open')
+    mocker.patch('lemon.actions.yaml.safe_load', return_value=[{
+        'mesh': 'mesh1',
+        'nodes': [{'name': f'node{i}', 'from': f'source{i}'}
+                  for i in range(3)]
+    }])
+
+    runner.invoke(build, ['-j', '3'])
+
+    assert system_call.call_count == 3
+    assert not any(overlaps)
+
+
 def test_start_node_process_started(mocker: "MockerFixture"):
     client, _ = setup_client(mocker)
     runner = CliRunner()
@@ -140,6 +315,7 @@ def test_start_node_process_started(mocker: "MockerFixture"):
     runner.invoke(start, ['mesh1'])
 
     assert process_start.call_count == 2
+    assert client.pipeline.return_value.delete.call_count == 2
 
 
 def test_start_with_exclusion(mocker: "MockerFixture"):
@@ -223,12 +399,57 @@ def test_start_with_multiple_arguments(mocker: "MockerFixture"):
         '--test argument', '--test2 argument2']
 
 
+def test_start_with_replicas(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    runner = CliRunner()
+
+    process_start = mocker.patch('lemon.actions.ProcessService.start')
+    mocker.patch('lemon.actions.ProcessService.is_running', return_value=False)
+    client.get.return_value = pickle.dumps([{
+        'name': 'node1',
+        'node': 'node1',
+        'with': '--test argument',
+        'replicas': 2
+    }])
+
+    runner.invoke(start, ['mesh1', '-s', 'node1'])
+
+    assert process_start.call_count == 2
+    assert process_start.call_args_list[0][0][0].name == 'node1-0'
+    assert process_start.call_args_list[1][0][0].name == 'node1-1'
+    assert process_start.call_args_list[1][0][1] == [
+        '--test argument', '--replica', '1', '--replicas', '2', '--sequence']
+
+
+def test_start_numbers_messages_of_mesh_with_replicas(
+        mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    runner = CliRunner()
+
+    process_start = mocker.patch('lemon.actions.ProcessService.start')
+    mocker.patch('lemon.actions.ProcessService.is_running', return_value=False)
+    client.get.return_value = pickle.dumps([
+        {'name': 'node1', 'node': 'node1', 'replicas': 2},
+        {'name': 'node2', 'node': 'node2'}
+    ])
+
+    # Also for the publishers that are not replicated themselves
+    runner.invoke(start, ['mesh1', '-t', '0', '-s', 'node2'])
+    assert process_start.call_args[0][1] == ['--sequence']
+
+    client.get.return_value = pickle.dumps([
+        {'name': 'node2', 'node': 'node2'}])
+    runner.invoke(start, ['mesh1', '-t', '0'])
+    assert process_start.call_args[0][1] == []
+
+
 def test_start_running_node_is_stopped_first(mocker: "MockerFixture"):
     client, _ = setup_client(mocker)
     runner = CliRunner()
 
     mocker.patch('lemon.actions.ProcessService.start')
-    process_stop = mocker.patch('lemon.actions.ProcessService.stop')
+    process_stop = mocker.patch('lemon.actions.ProcessService.interrupt')
+    mocker.patch('lemon.actions.ProcessService.wait')
     mocker.patch('lemon.actions.ProcessService.is_running', return_value=True)
 
     client.get.return_value = pickle.dumps([{
@@ -240,12 +461,83 @@ def test_start_running_node_is_stopped_first(mocker: "MockerFixture"):
     process_stop.assert_called_once()
 
 
+def test_start_in_stages(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    runner = CliRunner()
+
+    events = []
+    mocker.patch(
+        'lemon.actions.ProcessService.start',
+        side_effect=lambda ctx, _: events.append(
+            ('start', ctx.name)) or MagicMock())
+    mocker.patch('lemon.actions.ProcessService.is_running', return_value=False)
+
+    def is_ready(ctx, subscribes):
+        events.append(('ready', ctx.name, subscribes))
+        return True
+
+    mocker.patch('lemon.actions.ProcessService.is_ready', side_effect=is_ready)
+    client.get.return_value = pickle.dumps([
+        {'name': 'greeter', 'node': 'greeter', 'out': 'greeting'},
+        {'name': 'receiver', 'node': 'receiver', 'in': 'greeting'}
+    ])
+
+    runner.invoke(start, ['mesh1'])
+
+    assert events == [
+        ('start', 'receiver'), ('ready', 'receiver', True),
+        ('start', 'greeter'), ('ready', 'greeter', False)]
+
+
+def test_start_continues_after_timeout(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    runner = CliRunner()
+
+    process = MagicMock()
+    process.poll.return_value = None
+    process_start = mocker.patch(
+        'lemon.actions.ProcessService.start', return_value=process)
+    mocker.patch('lemon.actions.ProcessService.is_running', return_value=False)
+    mocker.patch('lemon.actions.ProcessService.is_ready', return_value=False)
+    client.get.return_value = pickle.dumps([
+        {'name': 'greeter', 'node': 'greeter', 'out': 'greeting'},
+        {'name': 'receiver', 'node': 'receiver', 'in': 'greeting'}
+    ])
+
+    result = runner.invoke(start, ['mesh1', '-t', '0.1'])
+
+    assert process_start.call_count == 2
+    assert 'receiver' in result.output
+    assert 'not ready after 0.1 s' in result.output
+
+
+def test_start_node_exits_before_ready(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    runner = CliRunner()
+
+    process = MagicMock()
+    process.poll.return_value = 1
+    process.returncode = 1
+    mocker.patch('lemon.actions.ProcessService.start', return_value=process)
+    mocker.patch('lemon.actions.ProcessService.is_running', return_value=False)
+    mocker.patch('lemon.actions.ProcessService.is_ready', return_value=False)
+    client.get.return_value = pickle.dumps([
+        {'name': 'receiver', 'node': 'receiver', 'in': 'greeting'}
+    ])
+
+    result = runner.invoke(start, ['mesh1'])
+
+    assert 'exited with code 1' in result.output
+    assert 'not ready' not in result.output
+
+
 def test_stop_node_shutdown(mocker: "MockerFixture"):
     client, _ = setup_client(mocker)
     init_health = mocker.patch('lemon.actions.init_health')
     runner = CliRunner()
 
-    process_stop = mocker.patch('lemon.actions.ProcessService.stop')
+    process_stop = mocker.patch('lemon.actions.ProcessService.interrupt')
+    mocker.patch('lemon.actions.ProcessService.wait')
     client.get.return_value = pickle.dumps([{
         'name': 'node1',
         'node': 'node1'
@@ -261,7 +553,8 @@ def test_stop_node_not_found(mocker: "MockerFixture"):
     init_health = mocker.patch('lemon.actions.init_health')
     runner = CliRunner()
 
-    process_stop = mocker.patch('lemon.actions.ProcessService.stop')
+    process_stop = mocker.patch('lemon.actions.ProcessService.interrupt')
+    mocker.patch('lemon.actions.ProcessService.wait')
     client.get.return_value = pickle.dumps([{
         'name': 'node1',
         'node': 'node1'
@@ -279,7 +572,8 @@ def test_stop_process_gone(mocker: "MockerFixture"):
     init_health = mocker.patch('lemon.actions.init_health')
     runner = CliRunner()
 
-    process_stop = mocker.patch('lemon.actions.ProcessService.stop')
+    process_stop = mocker.patch('lemon.actions.ProcessService.interrupt')
+    mocker.patch('lemon.actions.ProcessService.wait')
     client.get.return_value = pickle.dumps([
         {
             'name': 'node1',
@@ -303,7 +597,8 @@ def test_stop_with_select(mocker: "MockerFixture"):
     init_health = mocker.patch('lemon.actions.init_health')
     runner = CliRunner()
 
-    process_stop = mocker.patch('lemon.actions.ProcessService.stop')
+    process_stop = mocker.patch('lemon.actions.ProcessService.interrupt')
+    mocker.patch('lemon.actions.ProcessService.wait')
     client.get.return_value = pickle.dumps([
         {
             'name': 'node1',
@@ -328,7 +623,8 @@ def test_stop_with_exclusion(mocker: "MockerFixture"):
     init_health = mocker.patch('lemon.actions.init_health')
     runner = CliRunner()
 
-    process_stop = mocker.patch('lemon.actions.ProcessService.stop')
+    process_stop = mocker.patch('lemon.actions.ProcessService.interrupt')
+    mocker.patch('lemon.actions.ProcessService.wait')
     client.get.return_value = pickle.dumps([
         {
             'name': 'node1',
@@ -348,6 +644,28 @@ def test_stop_with_exclusion(mocker: "MockerFixture"):
     assert process_stop.call_args[0][0].name == 'node2'
 
 
+def test_stop_waits_for_all_nodes_at_once(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    init_health = mocker.patch('lemon.actions.init_health')
+    runner = CliRunner()
+
+    processes = [MagicMock(), MagicMock()]
+    mocker.patch('lemon.actions.ProcessService.interrupt',
+                 side_effect=[processes[0], NodePIDNotFound(), processes[1]])
+    wait = mocker.patch('lemon.actions.ProcessService.wait')
+    client.get.return_value = pickle.dumps([
+        {'name': 'node1', 'node': 'node1'},
+        {'name': 'node2', 'node': 'node2'},
+        {'name': 'node3', 'node': 'node3'}
+    ])
+
+    runner.invoke(stop, ['mesh1', '-t', '2.5'])
+
+    wait.assert_called_once_with(processes, 2.5)
+    assert [call[0][0].name for call in init_health.call_args_list] == [
+        'node1', 'node3']
+
+
 def test_show(mocker: "MockerFixture"):
     client, _ = setup_client(mocker)
     runner = CliRunner()
@@ -363,6 +681,7 @@ def test_show(mocker: "MockerFixture"):
         }
     ])
 
+    client.pipeline.return_value.execute.return_value = [{}, None] * 2
     get_health = mocker.patch('lemon.actions.get_health', return_value=(
         'inst', 'node', 'act', 'lftm', 'through'))
 
@@ -372,3 +691,188 @@ def test_show(mocker: "MockerFixture"):
     assert len(get_health.call_args) == 2
     assert get_health.call_args_list[0][0][0].name == 'node1'
     assert get_health.call_args_list[1][0][0].name == 'node2'
+
+
+def test_stop_with_replicas(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    mocker.patch('lemon.actions.init_health')
+    runner = CliRunner()
+
+    process_stop = mocker.patch('lemon.actions.ProcessService.interrupt')
+    mocker.patch('lemon.actions.ProcessService.wait')
+    client.get.return_value = pickle.dumps([{
+        'name': 'node1',
+        'node': 'node1',
+        'replicas': 2
+    }])
+    runner.invoke(stop, ['mesh1'])
+
+    assert [call[0][0].name for call in process_stop.call_args_list] == [
+        'node1-0', 'node1-1']
+
+
+def test_show_with_replicas(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    runner = CliRunner()
+
+    client.get.return_value = pickle.dumps([
+        {
+            'name': 'node1',
+            'node': 'node1',
+            'replicas': 2
+        }
+    ])
+
+    client.pipeline.return_value.execute.return_value = [{}, None] * 2
+    get_health = mocker.patch('lemon.actions.get_health', return_value=(
+        'inst', 'node', 'act', 'lftm', 'through'))
+    get_replicas_health = mocker.patch(
+        'lemon.actions.get_replicas_health', return_value=(
+            'inst', 'node', 'act', 'lftm', 'through'))
+
+    runner.invoke(show, ['mesh1'])
+
+    assert get_replicas_health.call_args[0][0] == 'node1'
+    assert [ctx.name for ctx in get_replicas_health.call_args[0][1]] == [
+        'node1-0', 'node1-1']
+    assert [call[0][0].name for call in get_health.call_args_list] == [
+        'node1-0', 'node1-1']
+
+
+def test_show_reads_health_at_once(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    runner = CliRunner()
+
+    client.get.return_value = pickle.dumps([
+        {'name': 'node1', 'node': 'node1'},
+        {'name': 'node2', 'node': 'node2', 'replicas': 2}
+    ])
+    client.pipeline.return_value.execute.return_value = [{}, None] * 3
+
+    result = runner.invoke(show, ['mesh1'])
+
+    pipeline = client.pipeline.return_value
+    pipeline.execute.assert_called_once()
+    assert [call[0][0] for call in pipeline.hgetall.call_args_list] == [
+        'mesh1:node1:health', 'mesh1:node2-0:health', 'mesh1:node2-1:health']
+    assert 'replicas: 0/2 running' in result.output
+    assert result.output.count('SHUTDOWN') == 4
+
+
+def test_show_watch(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    runner = CliRunner()
+
+    client.get.return_value = pickle.dumps([
+        {'name': 'node1', 'node': 'node1'}])
+    client.pipeline.return_value.execute.return_value = [{}, None]
+    sleep = mocker.patch(
+        'lemon.actions.time.sleep', side_effect=[None, KeyboardInterrupt])
+
+    result = runner.invoke(show, ['mesh1', '--watch', '-i', '.5'])
+
+    assert result.exit_code == 0
+    sleep.assert_called_with(.5)
+    assert client.pipeline.return_value.execute.call_count == 2
+    # The registered mesh is only read once
+    client.get.assert_called_once()
+    assert result.output.count(CLEAR_SCREEN) == 2
+
+
+def test_show_with_redis_flag(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    runner = CliRunner()
+
+    lemonfile_redis_url = mocker.patch(
+        'lemon.actions.lemonfile_redis_url',
+        return_value='redis://localhost:6380')
+    client.get.return_value = pickle.dumps([])
+
+    runner.invoke(cli, ['--redis', 'unix:///tmp/redis.sock', 'show', 'mesh1'])
+
+    assert os.environ['LEMON_REDIS_URL'] == 'unix:///tmp/redis.sock'
+    lemonfile_redis_url.assert_not_called()
+
+
+def test_show_with_lemonfile_redis(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    os.environ.pop('LEMON_REDIS_URL', None)
+    runner = CliRunner()
+
+    mocker.patch(
+        'lemon.actions.lemonfile_redis_url',
+        return_value='redis://localhost:6380')
+    mocker.patch('lemon.utils.SERVERS', {'redis://localhost:6380'})
+    client.get.return_value = pickle.dumps([])
+
+    runner.invoke(show, ['mesh1'])
+
+    assert os.environ['LEMON_REDIS_URL'] == 'redis://localhost:6380'
+
+
+def test_show_with_window(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    runner = CliRunner()
+
+    client.get.return_value = pickle.dumps([
+        {
+            'name': 'node1',
+            'node': 'node1'
+        }
+    ])
+
+    client.pipeline.return_value.execute.return_value = [{}, None]
+    get_health = mocker.patch('lemon.actions.get_health', return_value=(
+        'inst', 'node', 'act', 'lftm', 'through'))
+
+    runner.invoke(show, ['mesh1', '-w', '60'])
+
+    assert get_health.call_args[0][1] == 60
+
+
+def test_bench(mocker: "MockerFixture"):
+    mocker.patch('lemon.actions.bench.environment',
+                 return_value={'messages': 10})
+    result = {'msg_per_s': 100., 'mb_per_s': 1., 'lost': 0,
+              'latency_us': {'transport': {'p50': 10, 'p99': 20}}}
+    run_scenario = mocker.patch(
+        'lemon.actions.bench.run_scenario', return_value=result)
+    runner = CliRunner()
+
+    output = runner.invoke(cli, [
+        'bench', '-p', 'bytes', '-s', '64', '-s', '1024', '-t', '1',
+        '-f', '1', '-n', '10'])
+
+    assert output.exit_code == 0
+    assert json.loads(output.stdout) == {
+        'messages': 10, 'results': [result, result]}
+    assert 'payload \x1b[1mbytes' in output.stderr
+    assert run_scenario.call_args_list[1][0][0].size == 1024
+
+
+def test_bench_regression(mocker: "MockerFixture", tmp_path):
+    mocker.patch('lemon.actions.bench.environment', return_value={})
+    result = {'payload': 'bytes', 'size': 64, 'topics': 1, 'fanout': 1,
+              'codec': 'pickle', 'msg_per_s': 100., 'mb_per_s': 1.,
+              'lost': 0, 'latency_us': {'transport': {'p50': 10, 'p99': 20}}}
+    mocker.patch('lemon.actions.bench.run_scenario', return_value=result)
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps(
+        {'results': [dict(result, msg_per_s=200.)]}))
+    runner = CliRunner()
+
+    output = runner.invoke(cli, [
+        'bench', '-p', 'bytes', '-s', '64', '-t', '1', '-f', '1',
+        '-o', str(tmp_path / 'results.json'), '-b', str(baseline)])
+
+    assert output.exit_code == 1
+    assert 'msg_per_s 200 -> 100 (-50%)' in output.output
+    assert json.loads((tmp_path / 'results.json').read_text())[
+        'results'] == [result]
+
+
+def test_bench_invalid_payload():
+    output = CliRunner().invoke(cli, ['bench', '-p', 'text'])
+
+    assert output.exit_code == 1
+    assert 'Unknown payload text' in output.output
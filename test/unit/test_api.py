@@ -1,15 +1,38 @@
 import asyncio
+import os
 import pickle
 from unittest.mock import AsyncMock, MagicMock
 from lemon.api import (
+    API,
     anyone_listening,
+    batch,
     entrypoint,
     get_ctx,
+    get_latencies,
+    offload,
     parameter,
+    publish_many,
+    reconnect,
+    set_codec,
+    set_overflow,
+    set_partition_key,
+    set_tracing,
+    set_transport,
     subscribe,
-    publish
+    publish,
+    watch_replicas
 )
+from lemon.codecs import DEFAULT_CODEC, decode, get_codec
+from lemon.dispatch import Partition
+from lemon.shm import MessageLost
 from lemon.ctx import AsyncNodeContext
+from lemon.tracing import (
+    SEQUENCE_HEADER,
+    SEQUENCE_ID,
+    add_sequence,
+    publisher_id,
+    strip_trace
+)
 from lemon.utils import NodeActivity
 import pytest
 from pytest_mock import MockerFixture
@@ -53,6 +76,8 @@ def test_entrypoint_only_mesh_provided(mocker: "MockerFixture"):
         'mesh', 'node-name', 'node-name')
     self_register.assert_called_once_with(ctx)
     fn.assert_called_once_with()
+    health.start.assert_called_once_with(ctx)
+    health.stop.assert_called_once()
     health.update.assert_called_once_with(ctx, NodeActivity.SHUTDOWN)
     ctx.redis_client.close.assert_called_once()
 
@@ -88,6 +113,131 @@ def test_entrypoint_mesh_and_name_provided(mocker: "MockerFixture"):
     ctx.redis_client.close.assert_called_once()
 
 
+def test_entrypoint_health_interval(mocker: "MockerFixture"):
+    mocker.patch(
+        'lemon.api.AsyncNodeContext', return_value=MagicMock())
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    health_init = mocker.patch(
+        'lemon.api.HealthService', return_value=health)
+
+    mocker.patch(
+        'lemon.api.ProcessService.self_register')
+
+    mocker.patch(
+        'lemon.api.sys.argv',
+        ['path/to/node/node-name'])
+
+    wrapped_fn = entrypoint(AsyncMock())
+
+    runner = CliRunner()
+    runner.invoke(wrapped_fn, ['mesh', '--health-interval', '2.5'])
+
+    health_init.assert_called_once_with(2.5)
+
+
+def test_entrypoint_executors(mocker: "MockerFixture"):
+    mocker.patch(
+        'lemon.api.AsyncNodeContext', return_value=MagicMock())
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch(
+        'lemon.api.HealthService', return_value=health)
+
+    executors = mocker.patch('lemon.api.Executors')
+
+    mocker.patch(
+        'lemon.api.ProcessService.self_register')
+
+    mocker.patch(
+        'lemon.api.sys.argv',
+        ['path/to/node/node-name'])
+
+    wrapped_fn = entrypoint(AsyncMock())
+
+    runner = CliRunner()
+    runner.invoke(wrapped_fn, [
+        'mesh', '--threads', '2', '--processes', '3', '--queue-depth', '4'])
+
+    executors.assert_called_once_with(2, 3, 4)
+    executors.return_value.shutdown.assert_called_once()
+
+
+@pytest.mark.parametrize('replica,replicas', [(2, 3), (0, 1)])
+def test_entrypoint_replica(mocker: "MockerFixture", replica, replicas):
+    mocker.patch(
+        'lemon.api.AsyncNodeContext', return_value=MagicMock())
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch(
+        'lemon.api.HealthService', return_value=health)
+
+    mocker.patch(
+        'lemon.api.ProcessService.self_register')
+
+    mocker.patch(
+        'lemon.api.sys.argv',
+        ['path/to/node/node-name'])
+    mocker.patch('lemon.api.API.partition', None)
+    mocker.patch('lemon.api.API.partition_keys', {})
+
+    wrapped_fn = entrypoint(AsyncMock())
+
+    runner = CliRunner()
+    runner.invoke(wrapped_fn, [
+        'mesh', '-n', f'tracker-{replica}', '--replica', str(replica),
+        '--replicas', str(replicas)])
+
+    assert API.partition.name == 'tracker'
+    assert API.partition.index == replica
+    assert API.partition.count == replicas
+
+    set_partition_key(len, 'a')
+    assert API.partition.keys == {'a': len}
+
+
+def test_entrypoint_redis_url(mocker: "MockerFixture"):
+    mocker.patch.dict('os.environ')
+    mocker.patch(
+        'lemon.api.AsyncNodeContext', return_value=MagicMock())
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch(
+        'lemon.api.HealthService', return_value=health)
+
+    mocker.patch(
+        'lemon.api.ProcessService.self_register')
+
+    mocker.patch(
+        'lemon.api.sys.argv',
+        ['path/to/node/node-name'])
+
+    wrapped_fn = entrypoint(AsyncMock())
+
+    runner = CliRunner()
+    runner.invoke(wrapped_fn, ['mesh', '--redis', 'unix:///tmp/redis.sock'])
+
+    assert os.environ['LEMON_REDIS_URL'] == 'unix:///tmp/redis.sock'
+
+
+def test_set_overflow(mocker: "MockerFixture"):
+    mocker.patch('lemon.api.API.overflows', {})
+
+    set_overflow('latest', 'a', 'b')
+
+    assert API.overflows['a'].policy == 'latest'
+    assert API.overflows['b'].max_queued == 1
+
+
+def test_offload_unknown_executor():
+    with pytest.raises(ValueError):
+        offload(print, 'gpu')
+
+
 def test_entrypoint_ctrl_c(mocker: "MockerFixture"):
     ctx = MagicMock()
     mocker.patch(
@@ -127,7 +277,8 @@ async def test_subscribe_to_complete_topic(mocker: "MockerFixture"):
     })
     client.pubsub = MagicMock(return_value=pubsub)
 
-    health = AsyncMock()
+    health = MagicMock()
+    health.update = AsyncMock()
     mocker.patch(
         'lemon.api.API.health_service', health)
 
@@ -142,8 +293,44 @@ async def test_subscribe_to_complete_topic(mocker: "MockerFixture"):
         pass
 
     pubsub.subscribe.assert_called_once_with('my_topic')
+    client.set.assert_called_once_with('mesh:name:subscribed', os.getpid())
     callback.assert_called_with(5562)
-    health.update.assert_called_with(ctx, NodeActivity.ACTIVE)
+    health.update.assert_called_once_with(ctx, NodeActivity.ACTIVE)
+    health.received.assert_called_with('my_topic', len(pickle.dumps(5562)))
+
+
+@pytest.mark.asyncio
+async def test_subscribe_blocks_while_idle(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    async def no_message(ignore_subscribe_messages, timeout):
+        await asyncio.sleep(timeout)
+
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pubsub.get_message = AsyncMock(side_effect=no_message)
+    client.pubsub = MagicMock(return_value=pubsub)
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch(
+        'lemon.api.API.health_service', health)
+    mocker.patch('lemon.api.SUBSCRIBE_TIMEOUT', 5e-2)
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+
+    callback = AsyncMock()
+
+    try:
+        await asyncio.wait_for(subscribe({'my_topic': callback}), timeout=1e-1)
+    except asyncio.TimeoutError:
+        pass
+
+    callback.assert_not_called()
+    assert pubsub.get_message.call_count <= 2
+    pubsub.get_message.assert_called_with(
+        ignore_subscribe_messages=True, timeout=5e-2)
 
 
 @pytest.mark.asyncio
@@ -156,13 +343,15 @@ async def test_subscribe_ConnectionError_downscale(mocker: "MockerFixture"):
         side_effect=redis.exceptions.ConnectionError())
     client.pubsub = MagicMock(return_value=pubsub)
 
-    health = AsyncMock()
+    health = MagicMock()
+    health.update = AsyncMock()
     mocker.patch(
         'lemon.api.API.health_service', health)
 
     ctx = AsyncNodeContext('mesh', 'name', 'node')
     ctx.renew = MagicMock()
     mocker.patch('lemon.api.API.ctx', ctx)
+    check = mocker.patch('lemon.api.check_redis', AsyncMock())
 
     callback = AsyncMock()
 
@@ -171,14 +360,33 @@ async def test_subscribe_ConnectionError_downscale(mocker: "MockerFixture"):
     except asyncio.TimeoutError:
         pass
 
-    ctx.renew.assert_called()
+    check.assert_awaited()
+    ctx.renew.assert_called_with()
+
+
+@pytest.mark.asyncio
+async def test_reconnect_backs_off_while_server_is_down(
+        mocker: "MockerFixture"):
+    ctx = MagicMock()
+    mocker.patch('lemon.api.API.ctx', ctx, create=True)
+    check = mocker.patch('lemon.api.check_redis', AsyncMock(side_effect=[
+        redis.exceptions.ConnectionError()] * 3 + [None]))
+    sleep = mocker.patch('lemon.api.asyncio.sleep', AsyncMock())
+
+    await reconnect()
+
+    assert check.await_count == 4
+    assert [call[0][0] for call in sleep.await_args_list] == [
+        .01, .02, .04, .08]
+    ctx.renew.assert_called_once_with()
 
 
 @pytest.mark.asyncio
 async def test_publish_to_complete_topic(mocker: "MockerFixture"):
     client, _ = setup_client(mocker, do_async=True)
 
-    health = AsyncMock()
+    health = MagicMock()
+    health.update = AsyncMock()
     mocker.patch(
         'lemon.api.API.health_service', health)
 
@@ -189,11 +397,533 @@ async def test_publish_to_complete_topic(mocker: "MockerFixture"):
 
     expected_topic = 'my_topic'
 
-    health.update.assert_called_once_with(ctx, NodeActivity.ACTIVE)
+    health.sent.assert_called_once_with(
+        'my_topic', len(pickle.dumps([[.5]])))
+    health.update.assert_not_called()
     client.publish.assert_called_once_with(
         expected_topic, pickle.dumps([[.5]]))
 
 
+@pytest.mark.asyncio
+async def test_publish_traced(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+    mocker.patch('lemon.api.API.health_service', MagicMock())
+    mocker.patch('lemon.api.API.publisher', None)
+    mocker.patch('lemon.api.API.ctx', AsyncNodeContext('mesh', 'name', 'node'))
+
+    set_tracing()
+    await publish('my_topic', 1)
+
+    topic, data = client.publish.call_args[0]
+    sent, publisher, payload = strip_trace(data)
+    assert publisher == publisher_id('mesh', 'name')
+    assert bytes(payload) == pickle.dumps(1)
+
+    set_tracing(False)
+    await publish('my_topic', 1)
+
+    client.publish.assert_called_with('my_topic', pickle.dumps(1))
+
+
+@pytest.mark.asyncio
+async def test_publish_numbered(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+    mocker.patch('lemon.api.API.health_service', MagicMock())
+    mocker.patch('lemon.api.API.publisher', None)
+    mocker.patch('lemon.api.API.sequence', 0)
+    mocker.patch('lemon.api.API.ctx', AsyncNodeContext('mesh', 'name', 'node'))
+
+    await publish('my_topic', 1)
+    await publish('my_topic', 1)
+
+    first, second = [call[0][1] for call in client.publish.call_args_list]
+    assert first != second
+    assert decode(first) == decode(second) == 1
+    assert SEQUENCE_HEADER.unpack_from(second) == (SEQUENCE_ID, 2)
+
+
+def test_get_latencies(mocker: "MockerFixture"):
+    health = MagicMock()
+    health.latencies.return_value = {'a': {'queue': {
+        'p50': 1500, 'p99': 3000, 'max': 4000, 'count': 10}}}
+    mocker.patch('lemon.api.API.health_service', health)
+
+    assert get_latencies() == {'a': {'queue': {
+        'p50': 1.5e-3, 'p99': 3e-3, 'max': 4e-3, 'count': 10}}}
+
+
+@pytest.mark.asyncio
+async def test_publish_with_topic_codec(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    mocker.patch('lemon.api.API.health_service', MagicMock())
+    mocker.patch('lemon.api.API.topic_codecs', {})
+    mocker.patch('lemon.api.API.codec', DEFAULT_CODEC)
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+
+    set_codec('raw', 'raw_topic')
+    await publish('raw_topic', b'bytes')
+    await publish('my_topic', b'bytes')
+
+    assert client.publish.call_args_list[0][0] == ('raw_topic', b'\x01bytes')
+    assert client.publish.call_args_list[1][0] == (
+        'my_topic', pickle.dumps(b'bytes'))
+
+
+def test_set_codec_for_node(mocker: "MockerFixture"):
+    mocker.patch('lemon.api.API.topic_codecs', {})
+    mocker.patch('lemon.api.API.codec', DEFAULT_CODEC)
+
+    set_codec('json')
+
+    assert API.codec == get_codec('json')
+    assert API.topic_codecs == {}
+
+
+@pytest.mark.asyncio
+async def test_subscribe_decodes_codec(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pubsub.get_message = AsyncMock(return_value={
+        'channel': b'my_topic',
+        'data': b'\x03{"a":1}'
+    })
+    client.pubsub = MagicMock(return_value=pubsub)
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch(
+        'lemon.api.API.health_service', health)
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+
+    callback = AsyncMock()
+
+    try:
+        await asyncio.wait_for(subscribe({'my_topic': callback}), timeout=1e-1)
+    except asyncio.TimeoutError:
+        pass
+
+    callback.assert_called_with({'a': 1})
+
+
+@pytest.mark.asyncio
+async def test_publish_with_shm_transport(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    mocker.patch('lemon.api.API.health_service', MagicMock())
+    mocker.patch('lemon.api.API.transports', {})
+    shm = mocker.patch('lemon.api.API.shm')
+    shm.wrap.return_value = b'descriptor'
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+
+    set_transport('shm', 'shm_topic')
+    await publish('shm_topic', 1)
+    await publish('my_topic', 1)
+
+    shm.wrap.assert_called_once_with(pickle.dumps(1))
+    assert client.publish.call_args_list[0][0] == ('shm_topic', b'descriptor')
+    assert client.publish.call_args_list[1][0] == (
+        'my_topic', pickle.dumps(1))
+
+
+@pytest.mark.asyncio
+async def test_publish_with_stream_transport(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    mocker.patch('lemon.api.API.health_service', MagicMock())
+    mocker.patch('lemon.api.API.transports', {})
+    mocker.patch('lemon.api.API.stream_maxlens', {})
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+
+    set_transport('stream', 'stream_topic', maxlen=10)
+    await publish('stream_topic', 1)
+
+    client.xadd.assert_called_once_with(
+        '!stream:stream_topic', {b'd': pickle.dumps(1)}, maxlen=10)
+    client.publish.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_stream_topics(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pubsub.get_message = AsyncMock(return_value=None)
+    client.pubsub = MagicMock(return_value=pubsub)
+
+    receiver = MagicMock()
+    receiver.start = AsyncMock()
+    receiver.update = AsyncMock()
+    receiver_init = mocker.patch(
+        'lemon.api.StreamReceiver', return_value=receiver)
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch('lemon.api.API.health_service', health)
+    mocker.patch('lemon.api.API.transports', {'stream_topic': 'stream'})
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+
+    try:
+        await asyncio.wait_for(subscribe({
+            'stream_topic': AsyncMock(),
+            'my_topic': AsyncMock()
+        }), timeout=1e-1)
+    except asyncio.TimeoutError:
+        pass
+
+    pubsub.subscribe.assert_called_once_with('my_topic')
+    assert receiver_init.call_args[0][1] == ['stream_topic']
+    receiver.start.assert_called_once()
+    receiver.update.assert_called()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_stream_topics_replicas(mocker: "MockerFixture"):
+    setup_client(mocker, do_async=True)
+
+    receiver = MagicMock()
+    receiver.start = AsyncMock()
+    receiver.update = AsyncMock()
+    receiver_init = mocker.patch(
+        'lemon.api.StreamReceiver', return_value=receiver)
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch('lemon.api.API.health_service', health)
+    mocker.patch('lemon.api.API.transports', {
+        'shared_topic': 'stream', 'keyed_topic': 'stream'})
+    keys = {'keyed_topic': len}
+    mocker.patch('lemon.api.API.partition_keys', keys)
+    mocker.patch(
+        'lemon.api.API.partition', Partition('name', 1, 2, keys))
+
+    ctx = AsyncNodeContext('mesh', 'name-1', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+    mocker.patch('lemon.api.watch_replicas', AsyncMock())
+
+    try:
+        await asyncio.wait_for(subscribe({
+            'shared_topic': AsyncMock(),
+            'keyed_topic': AsyncMock()
+        }), timeout=1e-1)
+    except asyncio.TimeoutError:
+        pass
+
+    groups = {tuple(call[0][1]): call[0][3]
+              for call in receiver_init.call_args_list}
+    assert groups == {('keyed_topic',): None, ('shared_topic',): 'mesh:name'}
+
+
+@pytest.mark.asyncio
+async def test_subscribe_skips_messages_of_other_replicas(
+        mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    partition = Partition('name', 0, 2)
+    messages = [pickle.dumps(i) for i in range(20)]
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pending = [{'channel': b'my_topic', 'data': data} for data in messages]
+    pubsub.get_message = AsyncMock(
+        side_effect=lambda **_: pending.pop(0) if pending else None)
+    client.pubsub = MagicMock(return_value=pubsub)
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch('lemon.api.API.health_service', health)
+    mocker.patch('lemon.api.API.partition', partition)
+
+    ctx = AsyncNodeContext('mesh', 'name-0', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+    mocker.patch('lemon.api.watch_replicas', AsyncMock())
+
+    callback = AsyncMock()
+
+    try:
+        await asyncio.wait_for(subscribe({'my_topic': callback}), timeout=1e-1)
+    except asyncio.TimeoutError:
+        pass
+
+    owned = [pickle.loads(data) for data in messages
+             if partition.owns('my_topic', data)]
+    assert 0 < len(owned) < len(messages)
+    assert [call[0][0] for call in callback.call_args_list] == owned
+
+
+@pytest.mark.asyncio
+async def test_subscribe_counts_messages_of_dead_replicas(
+        mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    partition = Partition('name', 0, 3)
+    partition.live = {0, 2}
+    # Equal messages are spread by their sequence header
+    messages = [add_sequence(pickle.dumps(None), i) for i in range(30)]
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pending = [{'channel': b'my_topic', 'data': data} for data in messages]
+    pubsub.get_message = AsyncMock(
+        side_effect=lambda **_: pending.pop(0) if pending else None)
+    client.pubsub = MagicMock(return_value=pubsub)
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch('lemon.api.API.health_service', health)
+    mocker.patch('lemon.api.API.partition', partition)
+    mocker.patch('lemon.api.watch_replicas', AsyncMock())
+
+    ctx = AsyncNodeContext('mesh', 'name-0', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+
+    callback = AsyncMock()
+
+    try:
+        await asyncio.wait_for(subscribe({'my_topic': callback}), timeout=1e-1)
+    except asyncio.TimeoutError:
+        pass
+
+    owners = [partition.owner(data) for data in messages]
+    assert set(owners) == {0, 1, 2}
+    assert callback.call_count == owners.count(0)
+    assert health.dropped.call_count == owners.count(1)
+    health.dropped.assert_called_with('my_topic')
+
+
+@pytest.mark.asyncio
+async def test_watch_replicas(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+    pipeline = MagicMock()
+    pipeline.execute = AsyncMock(return_value=[
+        b'ACTIVE', b'100',
+        # Exited without shutting down
+        b'ACTIVE', b'101',
+        b'SHUTDOWN', None,
+        # Started, but not running yet
+        b'SHUTDOWN', None])
+    client.pipeline = MagicMock(return_value=pipeline)
+    mocker.patch('lemon.api.ProcessService.pid_exists',
+                 side_effect=lambda pid: pid == 100)
+
+    ctx = AsyncNodeContext('mesh', 'name-3', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+    partition = Partition('name', 3, 4)
+
+    try:
+        await asyncio.wait_for(watch_replicas(partition, 1.), timeout=1e-1)
+    except asyncio.TimeoutError:
+        pass
+
+    assert partition.live == {0, 3}
+    pipeline.hget.assert_any_call('mesh:name-2:health', 'activity')
+    pipeline.get.assert_any_call('mesh:name-2:pid')
+
+
+@pytest.mark.asyncio
+async def test_subscribe_pattern(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    pending = [
+        {'pattern': b'/camera/*', 'channel': b'/camera/left',
+         'data': pickle.dumps(1)},
+        # Also received for the topic itself, which takes precedence
+        {'pattern': b'/camera/*', 'channel': b'/camera/right',
+         'data': pickle.dumps(2)},
+        {'pattern': None, 'channel': b'/camera/right',
+         'data': pickle.dumps(2)},
+    ]
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pubsub.psubscribe = AsyncMock()
+    pubsub.get_message = AsyncMock(
+        side_effect=lambda **_: pending.pop(0) if pending else None)
+    client.pubsub = MagicMock(return_value=pubsub)
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch('lemon.api.API.health_service', health)
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+
+    any_camera = AsyncMock()
+    right_camera = AsyncMock()
+
+    try:
+        await asyncio.wait_for(subscribe({
+            '/camera/*': any_camera,
+            '/camera/right': right_camera
+        }), timeout=1e-1)
+    except asyncio.TimeoutError:
+        pass
+
+    pubsub.subscribe.assert_called_once_with('/camera/right')
+    pubsub.psubscribe.assert_called_once_with('/camera/*')
+    any_camera.assert_called_once_with(1)
+    right_camera.assert_called_once_with(2)
+
+
+def test_set_transport_unknown():
+    with pytest.raises(ValueError):
+        set_transport('carrier-pigeon', 'my_topic')
+
+
+@pytest.mark.asyncio
+async def test_subscribe_shm_message_lost(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    pubsub = MagicMock()
+    pubsub.subscribe = AsyncMock()
+    pubsub.get_message = AsyncMock(return_value={
+        'channel': b'my_topic',
+        'data': b'\x06descriptor'
+    })
+    client.pubsub = MagicMock(return_value=pubsub)
+
+    health = MagicMock()
+    health.update = AsyncMock()
+    mocker.patch(
+        'lemon.api.API.health_service', health)
+    shm = mocker.patch('lemon.api.API.shm')
+    shm.unwrap.side_effect = MessageLost()
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+
+    callback = AsyncMock()
+
+    try:
+        await asyncio.wait_for(subscribe({'my_topic': callback}), timeout=1e-1)
+    except asyncio.TimeoutError:
+        pass
+
+    callback.assert_not_called()
+    health.dropped.assert_called_with('my_topic')
+
+
+def setup_pipeline(mocker: "MockerFixture", client: "AsyncMock"):
+    pipeline = MagicMock()
+    pipeline.execute = AsyncMock()
+    client.pipeline = MagicMock(return_value=pipeline)
+
+    mocker.patch('lemon.api.API.health_service', MagicMock())
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+    return pipeline
+
+
+@pytest.mark.asyncio
+async def test_publish_many(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+    pipeline = setup_pipeline(mocker, client)
+
+    await publish_many([('a', 1), ('b', 2)])
+
+    client.pipeline.assert_called_once_with(transaction=False)
+    assert pipeline.publish.call_args_list[0][0] == ('a', pickle.dumps(1))
+    assert pipeline.publish.call_args_list[1][0] == ('b', pickle.dumps(2))
+    pipeline.execute.assert_called_once()
+    client.publish.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_batch_flushes_on_size(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+    pipeline = setup_pipeline(mocker, client)
+
+    async with batch(max_size=2, max_delay=10):
+        for i in range(5):
+            await publish('a', i)
+        assert pipeline.execute.call_count == 2
+
+    assert pipeline.execute.call_count == 3
+    assert pipeline.publish.call_count == 5
+    assert API.batch.get() is None
+    client.publish.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_batch_is_scoped_to_task(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+    pipeline = setup_pipeline(mocker, client)
+    entered, exited = asyncio.Event(), asyncio.Event()
+
+    async def outer():
+        async with batch(max_size=100, max_delay=1):
+            entered.set()
+            await exited.wait()
+
+    async def inner():
+        await entered.wait()
+        # Not batched by the batch of the other task
+        await publish('a', 1)
+        async with batch(max_size=100, max_delay=1):
+            await publish('a', 2)
+        exited.set()
+
+    await asyncio.gather(outer(), inner())
+
+    assert API.batch.get() is None
+    client.publish.assert_called_once_with('a', pickle.dumps(1))
+    pipeline.publish.assert_called_once_with('a', pickle.dumps(2))
+
+
+@pytest.mark.asyncio
+async def test_batch_flushes_on_delay(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+    pipeline = setup_pipeline(mocker, client)
+
+    async with batch(max_size=100, max_delay=1e-2):
+        await publish('a', 1)
+        await publish('a', 2)
+        pipeline.execute.assert_not_called()
+
+        await asyncio.sleep(5e-2)
+        pipeline.execute.assert_called_once()
+
+    pipeline.execute.assert_called_once()
+    assert pipeline.publish.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_batch_raises_error_of_delayed_flush(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+    pipeline = setup_pipeline(mocker, client)
+    pipeline.execute.side_effect = redis.exceptions.ConnectionError
+
+    with pytest.raises(redis.exceptions.ConnectionError):
+        async with batch(max_size=100, max_delay=1e-2):
+            await publish('a', 1)
+            await asyncio.sleep(5e-2)
+
+    pipeline.execute.side_effect = None
+    pipeline.execute.reset_mock()
+    async with batch(max_size=100, max_delay=1e-2) as batch_:
+        await publish('a', 1)
+        pipeline.execute.side_effect = redis.exceptions.ConnectionError
+        await asyncio.sleep(5e-2)
+        pipeline.execute.side_effect = None
+
+        with pytest.raises(redis.exceptions.ConnectionError):
+            await publish('a', 2)
+        # Raised once only
+        await publish('a', 3)
+    assert batch_.error is None
+    assert pipeline.execute.call_count == 2
+
+
 @pytest.mark.asyncio
 async def test_parameter_shared_false(mocker: "MockerFixture"):
     client, _ = setup_client(mocker, do_async=True)
@@ -232,6 +962,20 @@ async def test_parameter_shared_true(mocker: "MockerFixture"):
         expected_topic, pickle.dumps(value))
 
 
+@pytest.mark.asyncio
+async def test_parameter_replica(mocker: "MockerFixture"):
+    setup_client(mocker, do_async=True)
+
+    ctx = AsyncNodeContext('mesh', 'name-1', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+    mocker.patch('lemon.api.API.partition', Partition('name', 1, 2))
+
+    callback = AsyncMock()
+    rt = await parameter('my_param', .5, fn=callback)
+
+    assert rt == {'!param:mesh:name:my_param': callback}
+
+
 @pytest.mark.asyncio
 async def test_parameter_gets_initialized(mocker: "MockerFixture"):
     setup_client(mocker, do_async=True)
@@ -258,6 +1002,20 @@ async def test_anyone_listening(mocker: "MockerFixture"):
     assert await anyone_listening('hello', 'yellow')
 
 
+@pytest.mark.asyncio
+async def test_anyone_listening_pattern(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+    client.pubsub_numsub = AsyncMock(return_value=[(b'/dvs/image', 0)])
+    client.pubsub_numpat = AsyncMock(return_value=1)
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.api.API.ctx', ctx)
+    assert await anyone_listening('/dvs/image')
+
+    client.pubsub_numpat.return_value = 0
+    assert not await anyone_listening('/dvs/image')
+
+
 def test_get_ctx(mocker: "MockerFixture"):
     ctx = MagicMock()
     mocker.patch('lemon.api.API.ctx', ctx)
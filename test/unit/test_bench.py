@@ -0,0 +1,165 @@
+import asyncio
+import pickle
+from unittest.mock import AsyncMock
+from lemon.bench import (
+    BenchFailureException,
+    Scenario,
+    compare,
+    environment,
+    make_payload,
+    receive,
+    scenarios,
+    send,
+    summarize
+)
+from lemon.codecs import encode, get_codec
+from lemon.tracing import (
+    LATENCIES,
+    TRACE_HEADER,
+    LatencyHistogram,
+    strip_trace
+)
+import pytest
+from pytest_mock import MockerFixture
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+def setup_client(mocker: "MockerFixture") -> "AsyncMock":
+    client = AsyncMock()
+    mocker.patch('lemon.ctx.ensure_redis', return_value=client)
+    return client
+
+
+def histograms(*latencies) -> "dict[str, LatencyHistogram]":
+    result = {kind: LatencyHistogram() for kind in LATENCIES}
+    for latency in latencies:
+        result['transport'].record(latency)
+    return result
+
+
+def test_scenarios_default_sweep():
+    assert len(scenarios()) == 3 * 3 * 2 * 2
+    assert scenarios(['bytes'], [64], [1, 8], [4]) == [
+        Scenario('bytes', 64, 1, 4, 'pickle'),
+        Scenario('bytes', 64, 8, 4, 'pickle')]
+
+
+@pytest.mark.parametrize('payloads,codecs', [
+    (['text'], []), (['bytes'], ['unknown'])])
+def test_scenarios_invalid(payloads, codecs):
+    with pytest.raises(BenchFailureException):
+        scenarios(payloads, codecs=codecs)
+
+
+def test_scenarios_without_numpy(mocker: "MockerFixture"):
+    mocker.patch('lemon.bench.importlib.util.find_spec', return_value=None)
+
+    assert {scenario.payload for scenario in scenarios()} == {'bytes', 'dict'}
+    with pytest.raises(BenchFailureException):
+        scenarios(['numpy'])
+
+
+@pytest.mark.parametrize('kind', ['bytes', 'dict', 'numpy'])
+def test_make_payload_size(kind):
+    for size in (1024, 65536):
+        nbytes = len(encode(make_payload(kind, size), get_codec('pickle')))
+        assert size <= nbytes < 1.5 * size + 64
+
+
+@pytest.mark.asyncio
+async def test_send_traces_round_robin(mocker: "MockerFixture"):
+    client = setup_client(mocker)
+
+    result = await send(Scenario('bytes', 8, 2, 1, 'pickle'), 4, 0)
+
+    topics = [call[0][0] for call in client.publish.call_args_list]
+    assert topics == ['!bench:0', '!bench:1'] * 2
+    _, _, payload = strip_trace(client.publish.call_args[0][1])
+    assert pickle.loads(payload) == b'\x00' * 8
+    assert result['start'] <= result['end']
+
+
+@pytest.mark.asyncio
+async def test_receive(mocker: "MockerFixture"):
+    setup_client(mocker)
+
+    async def subscribe(topic_to_fn):
+        from lemon.api import API
+        for topic, fn in topic_to_fn.items():
+            API.health_service.latency(topic, 'transport', 1e-3)
+            await fn(None)
+        await asyncio.Event().wait()
+
+    mocker.patch('lemon.bench.subscribe', subscribe)
+    result = await receive('subscriber-0', Scenario(
+        'bytes', 8, 2, 1, 'pickle'), 2)
+
+    assert result['received'] == 2
+    assert result['latency']['transport'].summary() == {
+        'p50': 1000, 'p99': 1000, 'max': 1000, 'count': 2}
+    assert result['latency']['queue'].count == 0
+
+
+@pytest.mark.asyncio
+async def test_receive_counts_lost(mocker: "MockerFixture"):
+    setup_client(mocker)
+    mocker.patch('lemon.bench.IDLE_TIMEOUT', 0)
+
+    async def subscribe(topic_to_fn):
+        await topic_to_fn['!bench:0'](None)
+        await asyncio.Event().wait()
+
+    mocker.patch('lemon.bench.subscribe', subscribe)
+    result = await receive('subscriber-0', Scenario(
+        'bytes', 8, 1, 1, 'pickle'), 10)
+
+    assert result['received'] == 1
+
+
+def test_summarize():
+    scenario = Scenario('bytes', 100, 1, 2, 'pickle')
+    result = summarize(scenario, 10, {
+        'publisher': {'start': 100., 'end': 100.5},
+        'subscriber-0': {'received': 10, 'last': 101.,
+                         'latency': histograms(1e-3, 2e-3)},
+        'subscriber-1': {'received': 8, 'last': 100.9,
+                         'latency': histograms(3e-3)},
+    })
+
+    nbytes = TRACE_HEADER.size + len(pickle.dumps(b'\x00' * 100))
+    assert result['message_bytes'] == nbytes
+    assert (result['delivered'], result['lost']) == (18, 2)
+    assert result['publish_msg_per_s'] == 20
+    assert result['msg_per_s'] == 18
+    assert result['mb_per_s'] == round(18 * nbytes / 1e6, 3)
+    transport = result['latency_us']['transport']
+    assert transport['p50'] == pytest.approx(2000, rel=1e-2)
+    assert (transport['max'], transport['count']) == (3000, 3)
+    assert result['payload'] == 'bytes' and result['fanout'] == 2
+
+
+def test_compare():
+    def result(size, msg_per_s, p99):
+        return {'payload': 'bytes', 'size': size, 'topics': 1, 'fanout': 1,
+                'codec': 'pickle', 'msg_per_s': msg_per_s,
+                'latency_us': {'transport': {'p99': p99}}}
+
+    baseline = [result(64, 1000, 100), result(1024, 1000, 100)]
+    results = [result(64, 950, 105), result(1024, 800, 200),
+               result(4096, 1, 1000)]
+
+    regressions = compare(results, baseline, .1)
+
+    assert len(regressions) == 2
+    assert regressions[0].startswith('msg_per_s 1000 -> 800 (-20%)')
+    assert 'size=1024' in regressions[0]
+    assert regressions[1].startswith('latency_us.transport.p99 100 -> 200')
+    assert compare(results, baseline, 1.) == []
+
+
+def test_environment_needs_server(mocker: "MockerFixture"):
+    mocker.patch('lemon.bench.get_redis_url', return_value='memory://')
+
+    with pytest.raises(BenchFailureException):
+        environment(10, 0)
@@ -0,0 +1,71 @@
+import subprocess
+from lemon.build import fingerprint, git_commit, hash_sources
+from pytest_mock import MockerFixture
+
+
+def test_hash_sources(tmp_path):
+    (tmp_path / 'node.py').write_text('print(1)')
+    (tmp_path / 'pkg').mkdir()
+    (tmp_path / 'pkg' / 'module.py').write_text('x = 1')
+    before = hash_sources(str(tmp_path))
+
+    assert hash_sources(str(tmp_path)) == before
+
+    (tmp_path / 'pkg' / 'module.py').write_text('x = 2')
+    assert hash_sources(str(tmp_path)) != before
+
+
+def test_hash_sources_ignores_build_artifacts(tmp_path):
+    (tmp_path / 'node.py').write_text('print(1)')
+    before = hash_sources(str(tmp_path))
+
+    (tmp_path / 'node_cpp.cpython-311-x86_64-linux-gnu.so').write_bytes(b'1')
+    (tmp_path / 'node.egg-info').mkdir()
+    (tmp_path / 'node.egg-info' / 'PKG-INFO').write_text('info')
+    (tmp_path / '__pycache__').mkdir()
+    (tmp_path / '__pycache__' / 'node.cpython-311.pyc').write_bytes(b'1')
+
+    assert hash_sources(str(tmp_path)) == before
+
+
+def test_hash_sources_missing():
+    assert hash_sources('does/not/exist') is None
+
+
+def test_git_commit(mocker: "MockerFixture"):
+    run = mocker.patch('lemon.build.subprocess.run')
+    run.return_value.stdout = 'abc123\trefs/heads/main\n'
+
+    assert git_commit(
+        'git+ssh://git@github.com/pupuis/player@main#egg=player') == 'abc123'
+    run.assert_called_once()
+    assert run.call_args[0][0] == [
+        'git', 'ls-remote', 'ssh://git@github.com/pupuis/player', 'main']
+
+
+def test_git_commit_pinned(mocker: "MockerFixture"):
+    run = mocker.patch('lemon.build.subprocess.run')
+    sha = 'a' * 40
+
+    assert git_commit(f'git+https://github.com/pupuis/player@{sha}') == sha
+    run.assert_not_called()
+
+
+def test_git_commit_offline(mocker: "MockerFixture"):
+    mocker.patch('lemon.build.subprocess.run',
+                 side_effect=subprocess.CalledProcessError(128, 'git'))
+
+    assert git_commit('git+https://github.com/pupuis/player') is None
+
+
+def test_fingerprint_depends_on_interpreter(mocker: "MockerFixture", tmp_path):
+    (tmp_path / 'node.py').write_text('print(1)')
+    node = {'name': 'node', 'from': str(tmp_path)}
+    before = fingerprint(node)
+
+    mocker.patch('lemon.build.sys.executable', '/other/python')
+    assert fingerprint(node) != before
+
+
+def test_fingerprint_missing_sources():
+    assert fingerprint({'name': 'node', 'from': 'does/not/exist'}) is None
@@ -0,0 +1,111 @@
+import pickle
+from lemon.codecs import (
+    CODECS,
+    Codec,
+    UnknownCodecException,
+    decode,
+    encode,
+    get_codec,
+    register_codec
+)
+from lemon.tracing import SEQUENCE_ID, TRACE_ID, add_sequence
+import pytest
+
+
+@pytest.mark.parametrize('name', ['pickle', 'pickle5', 'marshal', 'json'])
+def test_roundtrip(name: "str"):
+    value = {'a': [1, 2.5, 'three'], 'b': None}
+    assert decode(encode(value, get_codec(name))) == value
+
+
+def test_roundtrip_raw():
+    data = encode(b'\x80\x01\x02', get_codec('raw'))
+    assert data == b'\x01\x80\x01\x02'
+    assert decode(data) == b'\x80\x01\x02'
+
+
+def test_pickle_is_sent_without_header():
+    assert encode([[.5]], get_codec('pickle')) == pickle.dumps([[.5]])
+
+
+def test_decode_plain_pickle():
+    assert decode(pickle.dumps((1, 'two'), protocol=2)) == (1, 'two')
+
+
+@pytest.mark.parametrize('name,value', [
+    ('pickle', [1]), ('json', [1]), ('raw', b'\x80')])
+def test_decode_numbered(name: "str", value):
+    assert decode(add_sequence(encode(value, get_codec(name)), 3)) == value
+
+
+def test_decode_unknown_codec():
+    with pytest.raises(UnknownCodecException):
+        decode(b'\x7f\x00')
+
+
+def test_get_unknown_codec():
+    with pytest.raises(UnknownCodecException):
+        get_codec('unknown')
+
+
+def test_register_codec():
+    codec = register_codec(Codec(
+        'upper', 100, lambda s: s.upper().encode(), lambda b: bytes(b)))
+
+    try:
+        assert decode(encode('abc', codec)) == b'ABC'
+    finally:
+        del CODECS['upper']
+
+
+def test_register_codec_id_taken():
+    with pytest.raises(ValueError):
+        register_codec(Codec('other-raw', 1, bytes, bytes))
+
+
+@pytest.mark.parametrize('id', [TRACE_ID, SEQUENCE_ID])
+def test_register_codec_id_reserved(id: "int"):
+    with pytest.raises(ValueError):
+        register_codec(Codec('traced', id, bytes, bytes))
+
+
+@pytest.mark.parametrize('id', [-1, 0x81, 0x80])
+def test_register_codec_id_invalid(id: "int"):
+    # Only pickle is sent without a header
+    with pytest.raises(ValueError):
+        register_codec(Codec('invalid', id, bytes, bytes))
+    assert 'invalid' not in CODECS
+
+
+def test_register_pickle_codec():
+    codec = register_codec(Codec(
+        'pickle4', 0x80, lambda value: pickle.dumps(value, protocol=4),
+        pickle.loads))
+
+    try:
+        assert decode(encode([1], codec)) == [1]
+    finally:
+        del CODECS['pickle4']
+
+
+def test_roundtrip_out_of_band():
+    value = {'frame': bytearray(b'\x01' * 1000), 'meta': (1, 'two')}
+    data = encode(value, get_codec('pickle5-oob'))
+
+    assert data[0] == 5
+    assert decode(bytes(data)) == value
+
+
+def test_out_of_band_numpy_views():
+    np = pytest.importorskip('numpy')
+
+    image = np.arange(12.).reshape(3, 4)
+    data = bytes(encode(
+        (image, image[:, ::2], image.T), get_codec('pickle5-oob')))
+    received, strided, transposed = decode(data)
+
+    assert np.array_equal(received, image)
+    assert np.array_equal(strided, image[:, ::2])
+    assert np.array_equal(transposed, image.T)
+    assert not received.flags.writeable
+    assert not received.flags.owndata
@@ -27,3 +27,15 @@ def test_construct_from_descriptor(mocker: "MockerFixture"):
 
     assert hasattr(ctx, 'redis_client')
     assert ctx.redis_client == client
+
+
+def test_replicas(mocker: "MockerFixture"):
+    setup_client(mocker)
+
+    node = {'name': 'a', 'node': 'b', 'from': './c'}
+    assert [ctx.name for ctx in NodeContext.replicas('mesh', node)] == ['a']
+
+    node['replicas'] = 3
+    ctxs = NodeContext.replicas('mesh', node)
+    assert [ctx.name for ctx in ctxs] == ['a-0', 'a-1', 'a-2']
+    assert all(ctx.node == 'b' for ctx in ctxs)
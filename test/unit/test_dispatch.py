@@ -0,0 +1,573 @@
+import asyncio
+import operator
+import pickle
+import threading
+import time
+from unittest.mock import AsyncMock, MagicMock
+from lemon.dispatch import (
+    Dispatcher,
+    Executors,
+    Offload,
+    Overflow,
+    Partition,
+    Router,
+    TopicQueue,
+    compile_pattern,
+    is_pattern
+)
+from lemon.tracing import add_sequence, add_trace
+import pytest
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest.mark.asyncio
+async def test_dispatch_in_order_per_topic():
+    received = []
+
+    async def callback(value):
+        await asyncio.sleep(1e-3 * (5 - value))
+        received.append(value)
+
+    health = MagicMock()
+    dispatcher = Dispatcher({'a': callback}, health)
+    for i in range(5):
+        await dispatcher.dispatch('a', pickle.dumps(i))
+
+    await asyncio.sleep(5e-2)
+    dispatcher.close()
+
+    assert received == [0, 1, 2, 3, 4]
+    assert health.received.call_count == 5
+
+
+@pytest.mark.asyncio
+async def test_dispatch_traced(mocker):
+    received = []
+
+    async def callback(value):
+        received.append(value)
+
+    # Sent, received, handler start and end
+    now = mocker.patch('time.time', side_effect=[
+        10., 10.002, 10.005, 10.015])
+    health = MagicMock()
+    dispatcher = Dispatcher({'a': callback}, health)
+    await dispatcher.dispatch('a', add_trace(pickle.dumps(1), 42))
+
+    await asyncio.sleep(1e-2)
+    dispatcher.close()
+
+    assert received == [1]
+    assert now.call_count == 4
+    latencies = {call[0][1]: call[0][2]
+                 for call in health.latency.call_args_list}
+    assert latencies == pytest.approx(
+        {'transport': 2e-3, 'queue': 3e-3, 'handler': 1e-2})
+    health.received.assert_called_once_with('a', len(pickle.dumps(1)))
+
+
+@pytest.mark.asyncio
+async def test_dispatch_untraced_is_not_timed(mocker):
+    now = mocker.patch('time.time')
+    health = MagicMock()
+    dispatcher = Dispatcher({'a': AsyncMock()}, health)
+    await dispatcher.dispatch('a', pickle.dumps(1))
+
+    await asyncio.sleep(1e-2)
+    dispatcher.close()
+
+    now.assert_not_called()
+    health.latency.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_slow_topic_does_not_block_others():
+    blocked = asyncio.Event()
+    received = []
+
+    async def slow(value):
+        await blocked.wait()
+
+    async def fast(value):
+        received.append(value)
+
+    dispatcher = Dispatcher({'slow': slow, 'fast': fast}, MagicMock())
+    await dispatcher.dispatch('slow', pickle.dumps(0))
+    await dispatcher.dispatch('slow', pickle.dumps(1))
+    await dispatcher.dispatch('fast', pickle.dumps(2))
+
+    await asyncio.sleep(1e-2)
+
+    assert received == [2]
+    assert dispatcher.depths() == {'slow': 1, 'fast': 0}
+
+    blocked.set()
+    await asyncio.sleep(1e-2)
+    dispatcher.close()
+
+    assert dispatcher.depths() == {}
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limit():
+    running = []
+    peak = []
+
+    async def callback(value):
+        running.append(value)
+        peak.append(len(running))
+        await asyncio.sleep(1e-2)
+        running.remove(value)
+
+    topics = {str(i): callback for i in range(4)}
+    dispatcher = Dispatcher(topics, MagicMock(), concurrency=2)
+    for topic in topics:
+        await dispatcher.dispatch(topic, pickle.dumps(topic))
+
+    await asyncio.sleep(5e-2)
+    dispatcher.close()
+
+    assert len(peak) == 4
+    assert max(peak) == 2
+
+
+@pytest.mark.asyncio
+async def test_callback_error_is_raised():
+    async def callback(value):
+        raise KeyError(value)
+
+    dispatcher = Dispatcher({'a': callback}, MagicMock())
+    await dispatcher.dispatch('a', pickle.dumps(0))
+    await asyncio.sleep(1e-2)
+
+    with pytest.raises(KeyError):
+        dispatcher.raise_for_error()
+    dispatcher.close()
+
+
+@pytest.mark.asyncio
+async def test_offload_inline_publishes_result():
+    publish = AsyncMock()
+    callback = Offload(lambda value: value + 1, None, 'out', 1, publish)
+
+    await callback(1)
+
+    publish.assert_called_once_with('out', 2)
+
+
+@pytest.mark.asyncio
+async def test_offload_inline_coroutine_without_result():
+    publish = AsyncMock()
+
+    async def fn(value):
+        return None
+
+    await Offload(fn, None, 'out', 1, publish)(1)
+
+    publish.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_offload_thread_keeps_order():
+    executors = Executors(threads=4)
+    publish = AsyncMock()
+
+    def fn(value):
+        time.sleep(1e-3 * (5 - value))
+        return value
+
+    callback = Offload(fn, executors.get('thread'), 'out', 3, publish)
+    for i in range(5):
+        await callback(i)
+    await callback.drainer
+
+    executors.shutdown()
+    assert [call[0][1] for call in publish.call_args_list] == [0, 1, 2, 3, 4]
+    assert callback.depth() == 0
+
+
+@pytest.mark.asyncio
+async def test_offload_acks_after_publishing():
+    executors = Executors(threads=1)
+    started, finish = threading.Event(), threading.Event()
+    acked = []
+
+    def fn(value):
+        started.set()
+        finish.wait(1.)
+        return value
+
+    async def publish(topic, value):
+        acked.append(('published', value))
+
+    callback = Offload(fn, executors.get('thread'), 'out', 1, publish)
+    dispatcher = Dispatcher({'a': callback}, MagicMock())
+    await dispatcher.dispatch(
+        'a', pickle.dumps(1), lambda: acked.append('acked'))
+    await asyncio.get_event_loop().run_in_executor(None, started.wait, 1.)
+    await asyncio.sleep(1e-2)
+
+    # Submitted to the pool, but not finished yet
+    assert acked == []
+
+    finish.set()
+    await asyncio.sleep(1e-2)
+    await callback.drainer
+    dispatcher.close()
+    executors.shutdown()
+
+    assert acked == [('published', 1), 'acked']
+
+
+@pytest.mark.asyncio
+async def test_offload_process():
+    executors = Executors(processes=1)
+    publish = AsyncMock()
+
+    callback = Offload(operator.neg, executors.get('process'), 'out', 1,
+                       publish)
+    await callback(5)
+    await callback.drainer
+
+    executors.shutdown()
+    publish.assert_called_once_with('out', -5)
+
+
+@pytest.mark.asyncio
+async def test_offload_error_is_raised_by_dispatcher():
+    executors = Executors(threads=1)
+
+    def fn(value):
+        raise KeyError(value)
+
+    callback = Offload(fn, executors.get('thread'), None, 1, AsyncMock())
+    dispatcher = Dispatcher({'a': callback}, MagicMock())
+    await dispatcher.dispatch('a', pickle.dumps(1))
+    await asyncio.sleep(1e-2)
+    await callback.drainer
+
+    # Without waiting for a further message
+    with pytest.raises(KeyError):
+        dispatcher.raise_for_error()
+    dispatcher.raise_for_error()
+    dispatcher.close()
+    executors.shutdown()
+
+
+def test_executors_unknown():
+    with pytest.raises(ValueError):
+        Executors().get('gpu')
+
+
+@pytest.mark.asyncio
+async def test_depths_include_offloaded():
+    executors = Executors(threads=1)
+    callback = Offload(time.sleep, executors.get('thread'), None, 2,
+                       AsyncMock())
+
+    dispatcher = Dispatcher({'a': callback}, MagicMock())
+    for _ in range(3):
+        await dispatcher.dispatch('a', pickle.dumps(5e-2))
+    await asyncio.sleep(1e-2)
+
+    assert dispatcher.depths() == {'a': 3}
+    drainer = callback.drainer
+    dispatcher.close()
+    executors.shutdown()
+
+    assert callback.drainer is None
+    with pytest.raises(asyncio.CancelledError):
+        await drainer
+
+
+@pytest.mark.asyncio
+async def test_overflow_latest():
+    queue = TopicQueue(Overflow('latest', 10))
+
+    assert [len(await queue.put(i)) for i in range(3)] == [0, 1, 1]
+    assert len(queue) == 1
+    assert await queue.get() == (2, None, None)
+
+
+@pytest.mark.asyncio
+async def test_overflow_drop_oldest():
+    queue = TopicQueue(Overflow('drop-oldest', 2))
+
+    assert await queue.put(0) == []
+    await queue.put(1)
+    assert await queue.put(2) == [(0, None, None)]
+    await queue.put(3)
+    assert await queue.get() == (2, None, None)
+    assert await queue.get() == (3, None, None)
+
+
+@pytest.mark.asyncio
+async def test_overflow_block():
+    queue = TopicQueue(Overflow('block', 1))
+    await queue.put(0)
+
+    put = asyncio.ensure_future(queue.put(1))
+    await asyncio.sleep(1e-2)
+    assert not put.done()
+
+    assert await queue.get() == (0, None, None)
+    assert await put == []
+    assert await queue.get() == (1, None, None)
+
+
+@pytest.mark.asyncio
+async def test_overflow_block_callback_error():
+    async def fail(value):
+        await asyncio.sleep(1e-2)
+        raise KeyError(value)
+
+    dispatcher = Dispatcher({'a': fail}, MagicMock(),
+                            overflows={'a': Overflow('block', 1)})
+
+    with pytest.raises(KeyError):
+        for i in range(5):
+            await asyncio.wait_for(
+                dispatcher.dispatch('a', pickle.dumps(i)), 1.)
+    dispatcher.close()
+
+
+def test_overflow_invalid():
+    with pytest.raises(ValueError):
+        Overflow('drop-newest')
+    with pytest.raises(ValueError):
+        Overflow('block', 0)
+
+
+@pytest.mark.asyncio
+async def test_dispatch_counts_dropped():
+    blocked = asyncio.Event()
+
+    async def slow(value):
+        await blocked.wait()
+
+    health = MagicMock()
+    dispatcher = Dispatcher({'a': slow}, health,
+                            overflows={'a': Overflow('drop-oldest', 2)})
+    for i in range(5):
+        await dispatcher.dispatch('a', pickle.dumps(i))
+        await asyncio.sleep(0)
+
+    dispatcher.close()
+    assert sum(call[0][1] for call in health.dropped.call_args_list) == 2
+
+
+@pytest.mark.asyncio
+async def test_dispatch_acks_processed_and_dropped():
+    blocked = asyncio.Event()
+    acked = []
+
+    async def slow(value):
+        await blocked.wait()
+
+    dispatcher = Dispatcher({'a': slow}, MagicMock(),
+                            overflows={'a': Overflow('latest')})
+    for i in range(3):
+        await dispatcher.dispatch(
+            'a', pickle.dumps(i), lambda i=i: acked.append(i))
+        await asyncio.sleep(0)
+
+    assert acked == [1]
+
+    blocked.set()
+    await asyncio.sleep(1e-2)
+    dispatcher.close()
+
+    assert sorted(acked) == [0, 1, 2]
+
+
+@pytest.mark.asyncio
+async def test_dispatch_blocks_acked_by_default():
+    blocked = asyncio.Event()
+
+    async def slow(value):
+        await blocked.wait()
+
+    dispatcher = Dispatcher({'a': slow, 'b': slow}, MagicMock())
+    await dispatcher.dispatch('a', pickle.dumps(0))
+    await dispatcher.dispatch('b', pickle.dumps(0), lambda: None)
+
+    assert dispatcher.queues['a'].overflow.policy == 'drop-oldest'
+    assert dispatcher.queues['b'].overflow.policy == 'block'
+    dispatcher.close()
+
+
+def test_partition_assigns_each_message_to_one_replica():
+    replicas = [Partition('node', i, 3) for i in range(3)]
+    messages = [pickle.dumps(i) for i in range(100)] + [bytes(2 ** 17)]
+
+    for data in messages:
+        owners = [replica.owns('a', data) for replica in replicas]
+        assert owners.count(True) == 1
+    for replica in replicas:
+        assert any(replica.owns('a', data) for data in messages)
+
+
+def test_partition_broadcasts_parameters():
+    replicas = [Partition('node', i, 3) for i in range(3)]
+    assert all(replica.owns('!param:mesh:node:p', b'1')
+               for replica in replicas)
+
+
+def test_partition_by_key():
+    keys = {'a': operator.itemgetter('id')}
+    replicas = [Partition('node', i, 3, keys) for i in range(3)]
+
+    for i in range(20):
+        # Assigned after decoding, by key only
+        assert all(replica.owns('a', pickle.dumps(i)) for replica in replicas)
+        owners = [
+            [replica.owns_value('a', {'id': i, 'x': x}) for x in range(5)]
+            for replica in replicas
+        ]
+        assert [all(owned) for owned in owners].count(True) == 1
+        assert [any(owned) for owned in owners].count(True) == 1
+
+
+def test_partition_spreads_numbered_messages():
+    replicas = [Partition('node', i, 3) for i in range(3)]
+    messages = [add_sequence(pickle.dumps(None), i) for i in range(30)]
+
+    for replica in replicas:
+        assert any(replica.owns('a', data) for data in messages)
+
+
+def test_partition_lost():
+    keys = {'b': len}
+    replicas = [Partition('node', i, 3, keys) for i in range(3)]
+    messages = [pickle.dumps(i) for i in range(30)]
+    assert not any(replica.lost('a', data)
+                   for replica in replicas for data in messages)
+
+    for replica in replicas:
+        replica.live = {1, 2}
+    lost = [data for data in messages if replicas[1].lost('a', data)]
+    assert lost == [data for data in messages if replicas[0].owns('a', data)]
+    # Counted by the first live replica only
+    assert not any(replicas[2].lost('a', data) for data in messages)
+
+    values = ['x' * i for i in range(30)]
+    lost = [value for value in values if replicas[1].lost('b', value=value)]
+    assert lost == [
+        value for value in values if replicas[0].owns_value('b', value)]
+
+
+def test_partition_invalid():
+    with pytest.raises(ValueError):
+        Partition('node', 3, 3)
+
+
+@pytest.mark.asyncio
+async def test_dispatch_skips_values_of_other_replicas():
+    received = []
+
+    async def callback(value):
+        received.append(value)
+
+    ack = MagicMock()
+    health = MagicMock()
+    partition = Partition('node', 0, 2, {'a': lambda value: value % 5})
+    dispatcher = Dispatcher({'a': callback}, health, partition=partition)
+    for i in range(20):
+        await dispatcher.dispatch('a', pickle.dumps(i), ack)
+
+    await asyncio.sleep(5e-2)
+    dispatcher.close()
+
+    assert received == [
+        i for i in range(20) if partition.owns_value('a', i)]
+    assert ack.call_count == 20
+    assert health.received.call_count == len(received)
+
+
+@pytest.mark.asyncio
+async def test_dispatch_counts_values_of_dead_replicas():
+    health = MagicMock()
+    partition = Partition('node', 0, 2, {'a': lambda value: value % 5})
+    partition.live = {0}
+    dispatcher = Dispatcher({'a': AsyncMock()}, health, partition=partition)
+    for i in range(20):
+        await dispatcher.dispatch('a', pickle.dumps(i))
+
+    await asyncio.sleep(5e-2)
+    dispatcher.close()
+
+    assert health.dropped.call_count == len(
+        [i for i in range(20) if not partition.owns_value('a', i)])
+
+
+def test_is_pattern():
+    assert is_pattern('/camera/*')
+    assert is_pattern('/camera/?')
+    assert is_pattern('/camera/[lr]')
+    assert not is_pattern('/camera/left')
+    assert not is_pattern('!param:mesh:node:ratio')
+
+
+@pytest.mark.parametrize('pattern,channel,matches', [
+    ('/camera/*', '/camera/left/raw', True),
+    ('/camera/*', '/lidar/front', False),
+    ('/camera/?', '/camera/l', True),
+    ('/camera/?', '/camera/left', False),
+    ('/camera/[lr]', '/camera/r', True),
+    ('/camera/[^lr]', '/camera/r', False),
+    ('/camera/[a-c]', '/camera/b', True),
+    ('/camera/\\*', '/camera/*', True),
+    ('/camera/\\*', '/camera/left', False),
+    ('/camera.*', '/camera/left', False),
+])
+def test_compile_pattern(pattern, channel, matches):
+    assert bool(compile_pattern(pattern).fullmatch(channel)) == matches
+
+
+def test_router_precedence():
+    router = Router({
+        '/camera/*': 'any camera',
+        '/camera/left': 'left camera',
+        '/camera/l*': 'l camera',
+    })
+
+    assert router.route('/camera/left') == '/camera/left'
+    assert router.callback('/camera/left') == 'left camera'
+    assert router.route('/camera/lidar') == '/camera/*'
+    assert router.route('/lidar') is None
+    assert router.callback('/lidar') is None
+
+
+def test_router_caches_resolved_channels():
+    router = Router({f'/sensor/{i}/*': i for i in range(100)})
+    router.patterns = [(MagicMock(wraps=regex), pattern)
+                       for regex, pattern in router.patterns]
+
+    assert router.callback('/sensor/99/raw') == 99
+    assert router.callback('/sensor/99/raw') == 99
+    assert all(regex.fullmatch.call_count == 1
+               for regex, _ in router.patterns)
+
+
+@pytest.mark.asyncio
+async def test_dispatch_pattern_per_topic():
+    received = []
+
+    async def callback(value):
+        received.append(value)
+
+    health = MagicMock()
+    dispatcher = Dispatcher({'/camera/*': callback}, health,
+                            overflows={'/camera/*': Overflow('latest')})
+    await dispatcher.dispatch('/camera/left', pickle.dumps(1))
+    await dispatcher.dispatch('/camera/right', pickle.dumps(2))
+    await dispatcher.dispatch('/lidar', pickle.dumps(3))
+
+    assert set(dispatcher.queues) == {'/camera/left', '/camera/right'}
+    assert dispatcher.queues['/camera/left'].overflow.policy == 'latest'
+
+    await asyncio.sleep(1e-2)
+    dispatcher.close()
+
+    assert sorted(received) == [1, 2]
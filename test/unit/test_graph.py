@@ -0,0 +1,53 @@
+from lemon.graph import consumers, start_stages, topics
+
+
+def names(stages):
+    return [[node['name'] for node in stage] for stage in stages]
+
+
+def test_topics():
+    assert topics({'name': 'node'}, 'in') == []
+    assert topics({'name': 'node', 'in': 'a'}, 'in') == ['a']
+    assert topics({'name': 'node', 'out': ['a', 'b']}, 'out') == ['a', 'b']
+
+
+def test_consumers_with_patterns():
+    nodes = [
+        {'name': 'camera', 'out': '/camera/front'},
+        {'name': 'detector', 'in': '/camera/*', 'out': 'detections'},
+        {'name': 'logger', 'in': ['detections', '/camera/front']}
+    ]
+
+    assert consumers(nodes) == {
+        'camera': ['detector', 'logger'],
+        'detector': ['logger'],
+        'logger': []
+    }
+
+
+def test_start_stages_consumers_first():
+    nodes = [
+        {'name': 'greeter', 'out': 'greeting'},
+        {'name': 'translator', 'in': 'greeting', 'out': 'translation'},
+        {'name': 'receiver', 'in': 'translation'},
+        {'name': 'standalone'}
+    ]
+
+    assert names(start_stages(nodes)) == [
+        ['receiver', 'standalone'], ['translator'], ['greeter']]
+
+
+def test_start_stages_without_topics():
+    nodes = [{'name': 'node1'}, {'name': 'node2'}]
+
+    assert names(start_stages(nodes)) == [['node1', 'node2']]
+
+
+def test_start_stages_cycle():
+    nodes = [
+        {'name': 'ping', 'in': 'pong', 'out': 'ping'},
+        {'name': 'pong', 'in': 'ping', 'out': 'pong'},
+        {'name': 'observer', 'in': 'ping'}
+    ]
+
+    assert names(start_stages(nodes)) == [['observer'], ['ping', 'pong']]
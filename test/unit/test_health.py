@@ -1,9 +1,26 @@
-import pickle
+import asyncio
+import itertools
+import os
+from lemon import testing
 from lemon.ctx import AsyncNodeContext, NodeContext
-from lemon.health import HealthService, get_health, init_health
+from lemon.health import (
+    HealthService,
+    encode_rates,
+    TrafficCounter,
+    HealthReader,
+    decode_health,
+    get_health,
+    get_replicas_health,
+    get_throughput,
+    health_id,
+    init_health,
+    sum_rates
+)
+from lemon.system import pid_id
 from lemon.utils import NodeActivity
 import pytest
 from pytest_mock import MockerFixture
+import redis
 from unittest.mock import MagicMock, AsyncMock
 
 
@@ -13,6 +30,26 @@ def setup_client(mocker: "MockerFixture", do_async=False) -> "MagicMock":
         'lemon.ctx.ensure_redis', return_value=client)
 
 
+def setup_pipeline(client: "MagicMock", do_async=False) -> "MagicMock":
+    pipeline = MagicMock()
+    if do_async:
+        pipeline.execute = AsyncMock()
+    client.pipeline = MagicMock(return_value=pipeline)
+    return pipeline
+
+
+def stored(activity, start_time, last_time, rates) -> "dict[bytes, bytes]":
+    """Health hash as returned by ``HGETALL``."""
+    fields = {'activity': activity.name, **encode_rates(rates, '1000')}
+    if start_time is not None:
+        fields.update({'start_time': start_time, 'last_time': last_time,
+                       'flushed_at': last_time, 'flushed_at@1000': last_time})
+    for topic, count in rates.get('dropped', {}).items():
+        fields[f'dropped:{topic}'] = count
+    return {field.encode(): str(value).encode()
+            for field, value in fields.items()}
+
+
 pytest_plugins = ('pytest_asyncio',)
 
 
@@ -22,10 +59,249 @@ async def test_update_active(mocker: "MockerFixture"):
 
     ctx = AsyncNodeContext('mesh', 'name', 'node')
 
+    pipeline = setup_pipeline(client, do_async=True)
+
     srv = HealthService()
+    srv.received('topic', 10)
+    srv.dropped('topic')
     await srv.update(ctx, NodeActivity.ACTIVE)
 
-    assert client.set.call_args[0][0] == ('mesh:name:health')
+    pipeline.delete.assert_not_called()
+    key, = pipeline.hset.call_args[0]
+    mapping = pipeline.hset.call_args[1]['mapping']
+    assert key == 'mesh:name:health'
+    assert mapping['activity'] == 'ACTIVE'
+    assert mapping[f'msg_rate:10:in:topic@{os.getpid()}'] > 0
+    assert sorted(call[0] for call in pipeline.hincrby.call_args_list) == [
+        ('mesh:name:health', 'bytes:in:topic', 10),
+        ('mesh:name:health', 'dropped:topic', 1),
+        ('mesh:name:health', 'messages:in:topic', 1),
+        ('mesh:name:health', 'version', 1)]
+    pipeline.execute.assert_awaited_once()
+
+    # Only increments since the last flush are sent
+    pipeline.reset_mock()
+    srv.received('topic', 5)
+    await srv.update(ctx, NodeActivity.ACTIVE)
+
+    assert sorted(call[0] for call in pipeline.hincrby.call_args_list) == [
+        ('mesh:name:health', 'bytes:in:topic', 5),
+        ('mesh:name:health', 'messages:in:topic', 1),
+        ('mesh:name:health', 'version', 1)]
+
+
+def test_record_does_no_io(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    mocker.patch(
+        'lemon.health.time.time', return_value=22
+    )
+
+    srv = HealthService()
+    srv.dirty = False
+    srv.record(NodeActivity.ACTIVE)
+
+    assert srv.dirty
+    assert srv.last_time == 22
+    client.set.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_flushes_when_dirty(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    pipeline = setup_pipeline(client, do_async=True)
+
+    srv = HealthService(interval=1e-2)
+    srv.start(ctx)
+    await asyncio.sleep(5e-2)
+    srv.stop()
+
+    pipeline.execute.assert_awaited()
+    assert pipeline.hset.call_args[0][0] == ('mesh:name:health')
+    assert not srv.dirty
+    assert srv.task is None
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_survives_connection_error(mocker: "MockerFixture"):
+    client, ensure_redis = setup_client(mocker, do_async=True)
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    pipeline = setup_pipeline(client, do_async=True)
+    pipeline.execute.side_effect = itertools.chain(
+        [redis.exceptions.ConnectionError()], itertools.repeat([]))
+    check = mocker.patch('lemon.health.check_redis', AsyncMock())
+
+    srv = HealthService(interval=1e-2)
+    srv.received('topic', 10)
+    srv.start(ctx)
+    await asyncio.sleep(1e-1)
+
+    assert not srv.task.done()
+    srv.stop()
+    check.assert_awaited_once_with()
+    ensure_redis.assert_called_with(do_async=True, check=False)
+    assert pipeline.execute.await_count >= 2
+    # The counters of the failed flush are sent again, once
+    assert [call[0] for call in pipeline.hincrby.call_args_list][3:6] == [
+        ('mesh:name:health', 'messages:in:topic', 1),
+        ('mesh:name:health', 'bytes:in:topic', 10),
+        ('mesh:name:health', 'version', 1)]
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_survives_failed_reconnect(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    pipeline = setup_pipeline(client, do_async=True)
+    pipeline.execute.side_effect = redis.exceptions.ConnectionError()
+    check = mocker.patch('lemon.health.check_redis', AsyncMock(
+        side_effect=redis.exceptions.ConnectionError()))
+
+    srv = HealthService(interval=1e-2)
+    srv.start(ctx)
+    await asyncio.sleep(5e-2)
+
+    assert not srv.task.done()
+    srv.stop()
+    check.assert_awaited()
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_idle_node_does_not_flush(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+
+    pipeline = setup_pipeline(client, do_async=True)
+
+    srv = HealthService(interval=1e-2)
+    srv.last_time -= 100
+    srv.dirty = False
+    srv.start(ctx)
+    await asyncio.sleep(5e-2)
+    srv.stop()
+
+    pipeline.execute.assert_not_called()
+
+
+def test_traffic_counter_rates():
+    counter = TrafficCounter(start_time=0)
+
+    for t in range(100):
+        counter.add(t + .5, 1000)
+        counter.add(t + .5, 1000)
+
+    rates = counter.rates(100.)
+    assert rates[1] == (2., 2000.)
+    assert rates[10] == (2., 2000.)
+    assert rates[60] == (2., 2000.)
+
+
+def test_traffic_counter_rates_decay():
+    counter = TrafficCounter(start_time=0)
+
+    for t in range(100):
+        counter.add(t + .5, 1000)
+
+    rates = counter.rates(110.)
+    assert rates[1] == (0., 0.)
+    assert rates[10] == (0., 0.)
+    assert rates[60] == (50 / 60, 50e3 / 60)
+
+
+def test_traffic_counter_rates_short_lifetime():
+    counter = TrafficCounter(start_time=0)
+    counter.add(.25, 100)
+    counter.add(.5, 100)
+
+    assert counter.rates(.5)[60] == (4., 400.)
+
+
+def test_single_message_topic(mocker: "MockerFixture"):
+    setup_client(mocker, do_async=True)
+    now = mocker.patch('lemon.health.time.time', return_value=1000.)
+
+    srv = HealthService()
+    now.return_value = 1030.99
+    srv.received('topic', 100)
+    now.return_value = 1031.
+
+    assert srv.rates()['in']['topic'] == {
+        1: pytest.approx((1 / 1., 100 / 1.)),
+        10: pytest.approx((1 / 10., 100 / 10.)),
+        60: pytest.approx((1 / 31., 100 / 31.))}
+
+
+def test_sent_and_received(mocker: "MockerFixture"):
+    setup_client(mocker, do_async=True)
+
+    srv = HealthService()
+    srv.sent('out_topic', 10)
+    srv.received('in_topic', 20)
+
+    rates = srv.rates()
+    assert list(rates['out']) == ['out_topic']
+    assert list(rates['in']) == ['in_topic']
+    assert rates['in']['in_topic'][1][0] > 0
+
+
+def test_dropped(mocker: "MockerFixture"):
+    setup_client(mocker, do_async=True)
+
+    srv = HealthService()
+    srv.dropped('my_topic')
+    srv.dropped('my_topic', 2)
+
+    assert srv.counts == {'dropped:my_topic': 3}
+
+
+def test_get_throughput_dropped():
+    assert get_throughput({'dropped': {'a': 3}}) == 'dropped a: 3 msg'
+
+
+def test_get_throughput_latency():
+    assert get_throughput({'latency': {'a': {
+        'handler': (1500, 3000, 4000),
+        'transport': (120, 800, 1200)
+    }}}) == ('latency a: transport 0.12/0.80/1.20 ms, '
+             'handler 1.50/3.00/4.00 ms (p50/p99/max)')
+
+
+def test_latencies(mocker: "MockerFixture"):
+    setup_client(mocker, do_async=True)
+
+    srv = HealthService()
+    for ms in range(1, 101):
+        srv.latency('a', 'handler', ms / 1e3)
+
+    assert srv.latencies() == {'a': {'handler': {
+        'p50': 50175, 'p99': 99327, 'max': 100000, 'count': 100}}}
+    assert srv.rates()['latency'] == {'a': {
+        'handler': (50175, 99327, 100000)}}
+
+
+def test_sum_rates_latency():
+    assert sum_rates([
+        {'latency': {'a': {'queue': (1, 5, 9)}}},
+        {'latency': {'a': {'queue': (2, 4, 6), 'handler': (1, 1, 1)}}}
+    ])['latency'] == {'a': {'queue': (2, 5, 9), 'handler': (1, 1, 1)}}
+
+
+def test_get_throughput_queued():
+    assert get_throughput({'queued': {'a': 3, 'b': 0}}) == 'queued a: 3 msg'
+
+
+def test_watch_queues(mocker: "MockerFixture"):
+    setup_client(mocker, do_async=True)
+
+    srv = HealthService()
+    srv.watch_queues(lambda: {'a': 3})
+
+    assert srv.rates()['queued'] == {'a': 3}
 
 
 def test_get_health_running(mocker: "MockerFixture"):
@@ -34,7 +310,7 @@ def test_get_health_running(mocker: "MockerFixture"):
     ctx = NodeContext('mesh', 'name', 'node')
 
     mocker.patch(
-        'lemon.health.ProcessService.is_running', return_value=True
+        'lemon.health.ProcessService.pid_exists', return_value=True
     )
 
     mocker.patch(
@@ -44,16 +320,21 @@ def test_get_health_running(mocker: "MockerFixture"):
     data = (
         NodeActivity.ACTIVE,
         1,
-        20
+        20,
+        {
+            'in': {'a': {1: (1., 0.), 10: (2., 3e6), 60: (3., 0.)}},
+            'out': {'b': {1: (1., 0.), 10: (.5, 25e3), 60: (3., 0.)}}
+        }
     )
     expected_data = (
         'name',
         'node',
         NodeActivity.ACTIVE,
         '00:00:21',
-        '0.50 msg/s'
+        'in a: 2.00 msg/s, 3.00 MB/s\nout b: 0.50 msg/s, 0.03 MB/s'
     )
-    client.get.return_value = pickle.dumps(data)
+    setup_pipeline(client).execute.return_value = [
+        stored(*data), b'1000']
     assert get_health(ctx) == expected_data
 
 
@@ -63,7 +344,7 @@ def test_get_health_should_run(mocker: "MockerFixture"):
     ctx = NodeContext('mesh', 'name', 'node')
 
     mocker.patch(
-        'lemon.health.ProcessService.is_running', return_value=False
+        'lemon.health.ProcessService.pid_exists', return_value=False
     )
 
     mocker.patch(
@@ -73,7 +354,8 @@ def test_get_health_should_run(mocker: "MockerFixture"):
     data = (
         NodeActivity.ACTIVE,
         1,
-        20
+        20,
+        {}
     )
     expected_data = (
         'name',
@@ -82,7 +364,8 @@ def test_get_health_should_run(mocker: "MockerFixture"):
         '',
         ''
     )
-    client.get.return_value = pickle.dumps(data)
+    setup_pipeline(client).execute.return_value = [
+        stored(*data), b'1000']
     assert get_health(ctx) == expected_data
 
 
@@ -92,7 +375,7 @@ def test_get_health_isnt_running(mocker: "MockerFixture"):
     ctx = NodeContext('mesh', 'name', 'node')
 
     mocker.patch(
-        'lemon.health.ProcessService.is_running', return_value=False
+        'lemon.health.ProcessService.pid_exists', return_value=False
     )
 
     mocker.patch(
@@ -102,7 +385,8 @@ def test_get_health_isnt_running(mocker: "MockerFixture"):
     data = (
         NodeActivity.SHUTDOWN,
         1,
-        20
+        20,
+        {}
     )
     expected_data = (
         'name',
@@ -111,7 +395,8 @@ def test_get_health_isnt_running(mocker: "MockerFixture"):
         '',
         ''
     )
-    client.get.return_value = pickle.dumps(data)
+    setup_pipeline(client).execute.return_value = [
+        stored(*data), b'1000']
     assert get_health(ctx) == expected_data
 
 
@@ -121,7 +406,7 @@ def test_get_health_waiting(mocker: "MockerFixture"):
     ctx = NodeContext('mesh', 'name', 'node')
 
     mocker.patch(
-        'lemon.health.ProcessService.is_running', return_value=True
+        'lemon.health.ProcessService.pid_exists', return_value=True
     )
 
     mocker.patch(
@@ -131,22 +416,211 @@ def test_get_health_waiting(mocker: "MockerFixture"):
     data = (
         NodeActivity.SHUTDOWN,
         1,
-        20
+        20,
+        {}
     )
     expected_data = (
         'name',
         'node',
         NodeActivity.WAITING,
         '00:00:39',
-        '0.05 msg/s'
+        ''
     )
-    client.get.return_value = pickle.dumps(data)
+    setup_pipeline(client).execute.return_value = [
+        stored(*data), b'1000']
     assert get_health(ctx) == expected_data
 
 
+def test_get_replicas_health(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+
+    ctxs = [NodeContext('mesh', f'name-{i}', 'node') for i in range(3)]
+
+    mocker.patch(
+        'lemon.health.ProcessService.pid_exists',
+        side_effect=[True, True, False]
+    )
+
+    mocker.patch(
+        'lemon.health.time.time', return_value=22
+    )
+
+    healths = [
+        (NodeActivity.WAITING, 5, 20, {
+            'in': {'a': {1: (1., 0.), 10: (2., 1e6), 60: (3., 0.)}},
+            'dropped': {'a': 2}
+        }),
+        (NodeActivity.ACTIVE, 1, 20, {
+            'in': {'a': {1: (1., 0.), 10: (1., 2e6), 60: (3., 0.)}},
+            'dropped': {'a': 1}
+        }),
+        (NodeActivity.ACTIVE, None, None, {})
+    ]
+    setup_pipeline(client).execute.side_effect = [
+        [stored(*health), b'1000'] for health in healths]
+
+    assert get_replicas_health('name', ctxs) == (
+        'name',
+        'node',
+        NodeActivity.ACTIVE,
+        '00:00:21',
+        'replicas: 2/3 running\n'
+        'in a: 3.00 msg/s, 3.00 MB/s\n'
+        'dropped a: 3 msg'
+    )
+
+
+def test_health_reader(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+
+    ctxs = [NodeContext('mesh', f'name{i}', 'node') for i in range(2)]
+    mocker.patch('lemon.health.ProcessService.pid_exists', return_value=True)
+    mocker.patch('lemon.health.time.time', return_value=22)
+    pipeline = setup_pipeline(client)
+
+    rates = {
+        'in': {'a': {1: (1., 10.), 10: (2., 20.), 60: (3., 30.)}},
+        'out': {'b:c': {1: (0., 0.), 10: (.5, 5.), 60: (0., 0.)}},
+        'dropped': {'a': 2},
+        'queued': {'a': 1},
+        'latency': {'a': {'transport': (120, 800, 1200)}}
+    }
+    pipeline.execute.return_value = [
+        stored(NodeActivity.ACTIVE, 1, 20, rates), b'1000', {}, None]
+
+    assert HealthReader(client, ctxs).read() == [
+        (NodeActivity.ACTIVE, 1., rates), (NodeActivity.SHUTDOWN, None, None)]
+    assert [call[0][0] for call in pipeline.hgetall.call_args_list] == [
+        'mesh:name0:health', 'mesh:name1:health']
+    assert [call[0][0] for call in pipeline.get.call_args_list] == [
+        'mesh:name0:pid', 'mesh:name1:pid']
+    pipeline.execute.assert_called_once()
+
+
+def test_health_reader_decodes_changes(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+
+    ctxs = [NodeContext('mesh', f'name{i}', 'node') for i in range(2)]
+    mocker.patch('lemon.health.ProcessService.pid_exists', return_value=True)
+    mocker.patch('lemon.health.time.time', return_value=22)
+    decode = mocker.patch(
+        'lemon.health.decode_health', wraps=decode_health)
+    pipeline = setup_pipeline(client)
+    reader = HealthReader(client, ctxs)
+
+    first = stored(NodeActivity.ACTIVE, 1, 20, {})
+    first[b'version'] = b'1'
+    pipeline.execute.return_value = [first, b'1000', first, b'1001']
+    reader.read()
+    assert decode.call_count == 2
+    assert pipeline.hgetall.call_count == 2
+
+    # Only the versions are read, and the hashes that changed
+    second = {**first, b'version': b'2'}
+    pipeline.reset_mock()
+    pipeline.execute.side_effect = [
+        [[b'ACTIVE', b'1', b'1'], b'1000', [b'ACTIVE', b'1', b'2'], b'1001'],
+        [second]]
+    assert [health[0] for health in reader.read()] == [
+        NodeActivity.ACTIVE, NodeActivity.ACTIVE]
+    assert pipeline.hmget.call_args_list[0][0] == (
+        'mesh:name0:health', ('activity', 'start_time', 'version'))
+    pipeline.hgetall.assert_called_once_with('mesh:name1:health')
+    assert decode.call_count == 3
+    decode.assert_called_with(second)
+
+    # Nothing changed, a single round trip
+    pipeline.reset_mock()
+    pipeline.execute.side_effect = [
+        [[b'ACTIVE', b'1', b'1'], b'1000', [b'ACTIVE', b'1', b'2'], b'1001']]
+    reader.read()
+    pipeline.execute.assert_called_once()
+    pipeline.hgetall.assert_not_called()
+    assert decode.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_health_reader_sees_decaying_rates(mocker: "MockerFixture"):
+    mocker.patch.dict('lemon.testing.BROKERS', clear=True)
+    mocker.patch('lemon.ctx.ensure_redis',
+                 return_value=testing.client('memory://health', True))
+    mocker.patch('lemon.health.ProcessService.pid_exists', return_value=True)
+    now = mocker.patch('lemon.health.time.time', return_value=100.)
+    client = testing.client('memory://health')
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    client.set(pid_id(ctx), 1000)
+    reader = HealthReader(client, [ctx])
+
+    srv = HealthService()
+    for _ in range(50):
+        srv.received('topic', 10)
+    now.return_value = 100.5
+    await srv.flush(ctx)
+    _, _, rates = reader.read()[0]
+    assert rates['in']['topic'][1][0] > 0
+
+    # Heartbeat flushes after the last message only change the rates
+    now.return_value = 103.
+    await srv.flush(ctx)
+    _, _, rates = reader.read()[0]
+    assert srv.last_time == 100.
+    assert rates['in']['topic'][1] == (0., 0.)
+
+
+@pytest.mark.asyncio
+async def test_health_of_several_writers(mocker: "MockerFixture"):
+    mocker.patch.dict('lemon.testing.BROKERS', clear=True)
+    mocker.patch('lemon.ctx.ensure_redis',
+                 return_value=testing.client('memory://health', True))
+    mocker.patch('lemon.health.ProcessService.pid_exists', return_value=True)
+    now = mocker.patch('lemon.health.time.time', return_value=100.)
+    client = testing.client('memory://health')
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    client.set(pid_id(ctx), 1000)
+    reader = HealthReader(client, [ctx])
+
+    node, worker = HealthService(), HealthService(primary=False)
+    worker.writer = 'worker'
+    for srv in (node, worker):
+        srv.received('topic', 10)
+        srv.dropped('topic')
+    now.return_value = 100.5
+    await node.update(ctx, NodeActivity.ACTIVE)
+    await worker.update(ctx, NodeActivity.WAITING)
+
+    activity, _, rates = reader.read()[0]
+    fields = client.hgetall(health_id(ctx))
+    assert activity == NodeActivity.ACTIVE
+    assert fields[b'messages:in:topic'] == b'2'
+    assert rates['dropped'] == {'topic': 2}
+    assert rates['in']['topic'][10][0] == pytest.approx(4.)
+
+    # Rates of a writer that stopped flushing are left out
+    now.return_value = 110.
+    await node.flush(ctx)
+    _, _, rates = reader.read()[0]
+    assert rates['in']['topic'][10][0] == pytest.approx(.1)
+
+
+def test_health_reader_old_health(mocker: "MockerFixture"):
+    mocker.patch.dict('lemon.testing.BROKERS', clear=True)
+    client = testing.client('memory://health')
+    mocker.patch('lemon.ctx.ensure_redis', return_value=client)
+    ctx = NodeContext('mesh', 'name', 'node')
+    client.set(health_id(ctx), b'pickled tuple')
+
+    assert HealthReader(client, [ctx]).read() == [
+        (NodeActivity.SHUTDOWN, None, None)]
+
+
 def test_init_health(mocker: "MockerFixture"):
     client, _ = setup_client(mocker)
 
     ctx = NodeContext('mesh', 'name', 'node')
+    pipeline = setup_pipeline(client)
     init_health(ctx)
-    client.set.assert_called_once()
+
+    pipeline.delete.assert_called_once_with('mesh:name:health')
+    pipeline.hset.assert_called_once_with(
+        'mesh:name:health', 'activity', 'SHUTDOWN')
+    pipeline.execute.assert_called_once()
@@ -0,0 +1,156 @@
+from multiprocessing import shared_memory
+from lemon.shm import (
+    SHM_ID,
+    MessageLost,
+    SharedMemoryRing,
+    SharedMemoryTransport
+)
+import pytest
+from pytest_mock import MockerFixture
+
+
+@pytest.fixture
+def ring():
+    ring = SharedMemoryRing(size=100)
+    yield ring
+    ring.close()
+
+
+def test_write_read(ring: "SharedMemoryRing"):
+    first = ring.write(b'a' * 10)
+    second = ring.write(b'b' * 20)
+
+    assert first == (0, 10)
+    assert second == (10, 20)
+    assert ring.read(*first) == b'a' * 10
+    assert ring.read(*second) == b'b' * 20
+
+
+def test_write_wraps_around(ring: "SharedMemoryRing"):
+    ring.write(b'a' * 60)
+    generation, length = ring.write(b'b' * 60)
+
+    assert generation == 100
+    assert ring.read(generation, length) == b'b' * 60
+
+
+def test_read_overwritten(ring: "SharedMemoryRing"):
+    descriptor = ring.write(b'a' * 60)
+    ring.write(b'b' * 60)
+    ring.write(b'c' * 60)
+
+    with pytest.raises(MessageLost):
+        ring.read(*descriptor)
+
+
+def test_write_too_large(ring: "SharedMemoryRing"):
+    with pytest.raises(ValueError):
+        ring.write(b'a' * 101)
+
+
+def test_reader_attaches_by_name(ring: "SharedMemoryRing"):
+    descriptor = ring.write(b'hello')
+
+    reader = SharedMemoryRing(ring.name)
+    try:
+        assert reader.read(*descriptor) == b'hello'
+    finally:
+        reader.close()
+
+
+def test_reader_uses_size_of_writer(mocker: "MockerFixture"):
+    segment = shared_memory.SharedMemory
+
+    def rounded(name=None, create=False, size=0):
+        # As if the segment was rounded up to a page
+        return segment(name, create, size + 4000 if create else size)
+
+    mocker.patch('lemon.shm.shared_memory.SharedMemory', side_effect=rounded)
+    writer = SharedMemoryRing(size=100)
+    reader = SharedMemoryRing(writer.name)
+    try:
+        writer.write(b'a' * 60)
+        descriptor = writer.write(b'b' * 60)
+
+        assert reader.size == 100
+        assert reader.read(*descriptor) == b'b' * 60
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_transport_small_message_inline():
+    transport = SharedMemoryTransport(threshold=10)
+
+    assert transport.wrap(b'small') == b'small'
+    assert transport.ring is None
+
+
+def test_transport_wrap_unwrap():
+    writer = SharedMemoryTransport(size=1000, threshold=10)
+    reader = SharedMemoryTransport()
+    try:
+        descriptor = writer.wrap(b'x' * 100)
+
+        assert descriptor[0] == SHM_ID
+        assert len(descriptor) < 100
+        assert reader.unwrap(descriptor) == b'x' * 100
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_transport_unwrap_own_segment(mocker: "MockerFixture"):
+    unregister = mocker.patch('lemon.shm.resource_tracker.unregister')
+    transport = SharedMemoryTransport(size=1000, threshold=10)
+    try:
+        assert transport.unwrap(transport.wrap(b'x' * 100)) == b'x' * 100
+        assert transport.rings == {}
+
+        # Also when attached by another transport of this process
+        ring = SharedMemoryRing(transport.ring.name)
+        ring.close()
+        unregister.assert_not_called()
+    finally:
+        transport.close()
+
+
+def test_transport_segment_gone():
+    writer = SharedMemoryTransport(size=1000, threshold=10)
+    descriptor = writer.wrap(b'x' * 100)
+    writer.close()
+
+    with pytest.raises(MessageLost):
+        SharedMemoryTransport().unwrap(descriptor)
+
+
+def test_transport_forgets_overwritten_segment():
+    writer = SharedMemoryTransport(size=100, threshold=10)
+    reader = SharedMemoryTransport()
+    try:
+        descriptor = writer.wrap(b'x' * 60)
+        writer.wrap(b'y' * 60)
+        writer.wrap(b'z' * 60)
+
+        with pytest.raises(MessageLost):
+            reader.unwrap(descriptor)
+        assert reader.rings == {}
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_transport_closes_previous_segment_of_publisher():
+    writer = SharedMemoryTransport(size=1000, threshold=10)
+    reader = SharedMemoryTransport()
+    try:
+        reader.unwrap(writer.wrap(b'x' * 100))
+        previous = reader.rings[writer.ring.name]
+        writer.close()
+
+        assert reader.unwrap(writer.wrap(b'y' * 100)) == b'y' * 100
+        assert list(reader.rings) == [writer.ring.name]
+        assert previous.buffer is None
+    finally:
+        reader.close()
+        writer.close()
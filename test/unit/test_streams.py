@@ -0,0 +1,177 @@
+import asyncio
+import pickle
+from unittest.mock import AsyncMock, MagicMock
+from lemon.ctx import AsyncNodeContext
+from lemon.dispatch import MAX_QUEUED, Dispatcher
+from lemon.streams import STREAM_COUNT, StreamReceiver
+import pytest
+from pytest_mock import MockerFixture
+import redis
+
+
+def setup_client(mocker: "MockerFixture", do_async=False) -> "MagicMock":
+    client = AsyncMock() if do_async else MagicMock()
+    return client, mocker.patch(
+        'lemon.ctx.ensure_redis', return_value=client)
+
+
+def setup_receiver(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker, do_async=True)
+    pipeline = MagicMock()
+    pipeline.execute = AsyncMock()
+    client.pipeline = MagicMock(return_value=pipeline)
+
+    dispatcher = MagicMock()
+    dispatcher.dispatch = AsyncMock()
+
+    ctx = AsyncNodeContext('mesh', 'name', 'node')
+    return client, pipeline, dispatcher, StreamReceiver(
+        ctx, ['a'], dispatcher)
+
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest.mark.asyncio
+async def test_create_groups(mocker: "MockerFixture"):
+    client, _, _, receiver = setup_receiver(mocker)
+    client.xgroup_create.side_effect = redis.exceptions.ResponseError(
+        'BUSYGROUP Consumer Group name already exists')
+
+    await receiver.create_groups()
+
+    client.xgroup_create.assert_called_once_with(
+        '!stream:a', 'mesh:name', id='$', mkstream=True)
+
+
+@pytest.mark.asyncio
+async def test_recover_pending(mocker: "MockerFixture"):
+    client, _, dispatcher, receiver = setup_receiver(mocker)
+    client.xreadgroup.side_effect = [
+        [[b'!stream:a', [(b'1-0', {b'd': pickle.dumps(1)})]]],
+        [[b'!stream:a', []]]
+    ]
+
+    await receiver.recover()
+
+    assert client.xreadgroup.call_args_list[0][0][2] == {'!stream:a': '0'}
+    assert client.xreadgroup.call_args_list[1][0][2] == {'!stream:a': b'1-0'}
+    assert dispatcher.dispatch.call_args[0][:2] == ('a', pickle.dumps(1))
+
+
+@pytest.mark.asyncio
+async def test_update_acks_processed(mocker: "MockerFixture"):
+    client, pipeline, dispatcher, receiver = setup_receiver(mocker)
+    client.xautoclaim.return_value = [b'0-0', []]
+    client.xreadgroup.return_value = [
+        [b'!stream:a', [(b'1-0', {b'd': pickle.dumps(1)})]]]
+
+    await receiver.update(1.)
+
+    ack = dispatcher.dispatch.call_args[0][2]
+    ack()
+    await receiver.update(1.)
+
+    assert client.xreadgroup.call_args[0][2] == {'!stream:a': '>'}
+    assert client.xreadgroup.call_args[1]['block'] == 1000
+    pipeline.xack.assert_called_once_with('!stream:a', 'mesh:name', b'1-0')
+    client.xautoclaim.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_trimmed_entry_is_dropped(mocker: "MockerFixture"):
+    client, pipeline, dispatcher, receiver = setup_receiver(mocker)
+    client.xautoclaim.return_value = [b'0-0', [(b'1-0', {})]]
+    client.xreadgroup.return_value = []
+
+    await receiver.update(1.)
+    await receiver.flush_acks()
+
+    dispatcher.dispatch.assert_not_called()
+    dispatcher.health_service.dropped.assert_called_once_with('a')
+    pipeline.xack.assert_called_once_with('!stream:a', 'mesh:name', b'1-0')
+
+
+@pytest.mark.asyncio
+async def test_inflight_entries_are_not_dispatched_again(
+        mocker: "MockerFixture"):
+    client, pipeline, dispatcher, receiver = setup_receiver(mocker)
+    entries = [(b'1-0', {b'd': pickle.dumps(1)}),
+               (b'2-0', {b'd': pickle.dumps(2)})]
+    client.xreadgroup.side_effect = [[[b'!stream:a', entries]], []]
+    client.xautoclaim.return_value = [b'0-0', entries]
+
+    await receiver.recover()
+    first_ack = dispatcher.dispatch.call_args_list[0][0][2]
+    first_ack()
+    # Claiming its own pending entries, the consumer skips those that are
+    # still queued, processed or not yet acknowledged in redis
+    await receiver.claim()
+    assert dispatcher.dispatch.call_count == 2
+
+    await receiver.flush_acks()
+    receiver.last_claim = 0
+    await receiver.claim()
+
+    assert [call[0][1] for call in dispatcher.dispatch.call_args_list] == [
+        pickle.dumps(1), pickle.dumps(2), pickle.dumps(1)]
+    assert receiver.inflight == {('!stream:a', b'1-0'), ('!stream:a', b'2-0')}
+
+
+@pytest.mark.asyncio
+async def test_flush_acks_keeps_acks_on_connection_error(
+        mocker: "MockerFixture"):
+    _, pipeline, _, receiver = setup_receiver(mocker)
+    pipeline.execute.side_effect = [redis.exceptions.ConnectionError(), []]
+    receiver.ack('!stream:a', b'1-0')
+
+    with pytest.raises(redis.exceptions.ConnectionError):
+        await receiver.flush_acks()
+    await receiver.flush_acks()
+
+    assert pipeline.xack.call_args_list[-1][0] == (
+        '!stream:a', 'mesh:name', b'1-0')
+    assert receiver.acks == {}
+
+
+@pytest.mark.asyncio
+async def test_recover_backlog_blocks_slow_callback(mocker: "MockerFixture"):
+    client, pipeline, _, _ = setup_receiver(mocker)
+    pending = [(f'{i}-0'.encode(), {b'd': pickle.dumps(i)})
+               for i in range(MAX_QUEUED + 500)]
+
+    def xreadgroup(group, consumer, ids, count, block):
+        last = ids['!stream:a']
+        start = 0 if last == '0' else int(last.split(b'-')[0]) + 1
+        return [[b'!stream:a', pending[start:start + count]]]
+
+    client.xreadgroup.side_effect = xreadgroup
+    blocked = asyncio.Event()
+    received = []
+
+    async def slow(value):
+        await blocked.wait()
+        received.append(value)
+
+    health = MagicMock()
+    dispatcher = Dispatcher({'a': slow}, health)
+    receiver = StreamReceiver(
+        AsyncNodeContext('mesh', 'name', 'node'), ['a'], dispatcher)
+    recovering = asyncio.get_event_loop().create_task(receiver.recover())
+    await asyncio.sleep(1e-2)
+
+    # Stops reading the stream instead of dropping its entries
+    assert client.xreadgroup.call_count <= MAX_QUEUED // STREAM_COUNT + 1
+    assert not recovering.done()
+
+    blocked.set()
+    await asyncio.wait_for(recovering, 5.)
+    await asyncio.sleep(1e-2)
+    await receiver.flush_acks()
+    dispatcher.close()
+
+    assert received == list(range(len(pending)))
+    health.dropped.assert_not_called()
+    acked = [id for call in pipeline.xack.call_args_list
+             for id in call[0][2:]]
+    assert acked == [id for id, _ in pending]
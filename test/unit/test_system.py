@@ -1,3 +1,4 @@
+import signal
 from unittest.mock import AsyncMock, MagicMock
 from lemon.ctx import AsyncNodeContext, NodeContext
 from lemon.system import ProcessService
@@ -34,13 +35,19 @@ def test_stop_ctrl_c_works(mocker: "MockerFixture"):
 
     ctx = NodeContext('mesh', 'name', 'node')
 
-    process = mocker.patch(
-        'lemon.system.psutil.Process'
+    process = MagicMock()
+    mocker.patch(
+        'lemon.system.psutil.Process', return_value=process
+    )
+    wait_procs = mocker.patch(
+        'lemon.system.psutil.wait_procs', return_value=([process], [])
     )
-    process.is_running.return_value = False
 
-    ProcessService.stop(ctx)
+    ProcessService.stop(ctx, timeout=3)
+    process.send_signal.assert_called_once_with(signal.SIGINT)
     process.terminate.assert_not_called()
+    process.kill.assert_not_called()
+    assert wait_procs.call_args_list[0][1]['timeout'] == 3
 
 
 def test_stop_ctr_c_doesnt_work(mocker: "MockerFixture"):
@@ -48,17 +55,36 @@ def test_stop_ctr_c_doesnt_work(mocker: "MockerFixture"):
     client.get.return_value = b'1000'
 
     ctx = NodeContext('mesh', 'name', 'node')
+    process = MagicMock()
     mocker.patch(
-        'lemon.system.os.getpid', return_value=1000
+        'lemon.system.psutil.Process', return_value=process
     )
+    mocker.patch(
+        'lemon.system.psutil.wait_procs',
+        side_effect=[([], [process]), ([process], [])]
+    )
+
+    ProcessService.stop(ctx)
+    process.terminate.assert_called_once()
+    process.kill.assert_not_called()
+
+
+def test_stop_sigterm_doesnt_work(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    client.get.return_value = b'1000'
+
+    ctx = NodeContext('mesh', 'name', 'node')
     process = MagicMock()
     mocker.patch(
         'lemon.system.psutil.Process', return_value=process
     )
-    process.is_running.return_value = True
+    mocker.patch(
+        'lemon.system.psutil.wait_procs', return_value=([], [process])
+    )
 
     ProcessService.stop(ctx)
     process.terminate.assert_called_once()
+    process.kill.assert_called_once()
 
 
 def test_is_running_pid_in_redis_but_not_system(mocker: "MockerFixture"):
@@ -105,3 +131,29 @@ def test_is_running_pid_not_in_system(mocker: "MockerFixture"):
 
     assert not ProcessService.is_running(ctx)
     exists.assert_not_called()
+
+
+def test_is_ready(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    ctx = NodeContext('mesh', 'name', 'node')
+
+    client.mget.return_value = [b'1000', None]
+    assert not ProcessService.is_ready(ctx, subscribes=True)
+    client.mget.assert_called_with(['mesh:name:pid', 'mesh:name:subscribed'])
+
+    client.mget.return_value = [b'1000']
+    assert ProcessService.is_ready(ctx, subscribes=False)
+    client.mget.assert_called_with(['mesh:name:pid'])
+
+
+def test_start_resets_readiness(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    ctx = NodeContext('mesh', 'name', 'node')
+    mocker.patch('lemon.system.LogFileService.open')
+    popen = mocker.patch('lemon.system.subprocess.Popen')
+
+    ProcessService.start(ctx, ['--arg'])
+
+    client.delete.assert_called_once_with(
+        'mesh:name:pid', 'mesh:name:subscribed')
+    assert popen.call_args[0][0] == ['node', 'mesh', '-n', 'name', '--arg']
@@ -0,0 +1,168 @@
+import asyncio
+import pickle
+from lemon import testing
+from lemon.api import API, anyone_listening, parameter, publish, subscribe
+from lemon.ctx import AsyncNodeContext, NodeContext
+from lemon.health import HealthService, decode_health, health_id
+from lemon.system import ProcessService
+from lemon.utils import ensure_redis, set_redis_url
+import pytest
+from pytest_mock import MockerFixture
+import redis
+
+pytest_plugins = ('pytest_asyncio',)
+
+
+@pytest.fixture(autouse=True)
+def broker(mocker: "MockerFixture") -> "testing.Broker":
+    mocker.patch.dict('os.environ')
+    mocker.patch.dict('lemon.testing.BROKERS', clear=True)
+    set_redis_url('memory://test')
+    return testing.get_broker('memory://test')
+
+
+def setup_node(mocker: "MockerFixture") -> "AsyncNodeContext":
+    ctx = AsyncNodeContext('mesh', 'node', 'node')
+    mocker.patch.object(API, 'ctx', ctx, create=True)
+    mocker.patch.object(
+        API, 'health_service', HealthService(), create=True)
+    return ctx
+
+
+def test_ensure_redis_memory(broker):
+    client = ensure_redis()
+
+    assert isinstance(client, testing.Redis)
+    assert client.broker is broker
+    assert ensure_redis(url='memory://other').broker is not broker
+
+
+def test_strings_and_hashes():
+    client = ensure_redis()
+
+    assert client.set('key', 1) is True
+    assert client.get('key') == b'1'
+    assert client.mget(['key', 'missing']) == [b'1', None]
+    assert client.hset('hash', mapping={'a': 1.5, 'b': 'x'}) == 2
+    assert client.hincrby('hash', 'c', 3) == 3
+    assert client.hincrby('hash', 'c') == 4
+    assert client.hgetall('hash') == {b'a': b'1.5', b'b': b'x', b'c': b'4'}
+    assert client.hmget('hash', ('a', 'd')) == [b'1.5', None]
+    assert sorted(client.keys('*')) == [b'hash', b'key']
+    assert client.keys('h?sh') == [b'hash']
+    assert client.delete('key', 'missing') == 1
+    with pytest.raises(redis.exceptions.ResponseError):
+        client.get('hash')
+    with pytest.raises(redis.exceptions.DataError):
+        client.set('key', None)
+
+
+def test_pipeline():
+    client = ensure_redis()
+
+    pipeline = client.pipeline(transaction=False)
+    pipeline.set('a', 1).get('a')
+    pipeline.delete('a')
+
+    assert pipeline.execute() == [True, b'1', 1]
+    assert pipeline.execute() == []
+    with pytest.raises(AttributeError):
+        pipeline.xadd
+
+
+def test_pubsub():
+    client = ensure_redis()
+    pubsub = client.pubsub()
+    pubsub.subscribe('a/b')
+    pubsub.psubscribe('a/*')
+
+    assert client.publish('a/b', b'data') == 2
+    assert client.publish('c', b'data') == 0
+    assert pubsub.get_message()['type'] == 'subscribe'
+    assert pubsub.get_message()['type'] == 'psubscribe'
+    assert pubsub.get_message() == {
+        'type': 'message', 'pattern': None, 'channel': b'a/b',
+        'data': b'data'}
+    assert pubsub.get_message(ignore_subscribe_messages=True) == {
+        'type': 'pmessage', 'pattern': b'a/*', 'channel': b'a/b',
+        'data': b'data'}
+    assert pubsub.get_message() is None
+    assert client.pubsub_channels() == [b'a/b']
+    assert client.pubsub_numsub('a/b', 'c') == [(b'a/b', 1), (b'c', 0)]
+    assert client.pubsub_numpat() == 1
+
+    pubsub.close()
+
+    assert client.pubsub_channels() == []
+    assert client.pubsub_numpat() == 0
+    assert client.publish('a/b', b'data') == 0
+
+
+def test_pubsub_garbage_collected():
+    client = ensure_redis()
+    client.pubsub().subscribe('a')
+
+    assert client.pubsub_numsub('a') == [(b'a', 0)]
+
+
+@pytest.mark.asyncio
+async def test_async_pubsub():
+    client = ensure_redis(do_async=True)
+    pubsub = client.pubsub()
+    await pubsub.subscribe('a')
+
+    assert await pubsub.get_message(
+        ignore_subscribe_messages=True, timeout=1e-2) is None
+
+    asyncio.get_event_loop().call_later(
+        1e-2, lambda: ensure_redis().publish('a', b'data'))
+    message = await pubsub.get_message(
+        ignore_subscribe_messages=True, timeout=1.)
+
+    assert message['data'] == b'data'
+    assert await client.pubsub_numsub('a') == [(b'a', 1)]
+
+
+@pytest.mark.asyncio
+async def test_anyone_listening_to_pattern(mocker: "MockerFixture"):
+    ctx = setup_node(mocker)
+    assert not await anyone_listening('/dvs/image', '/dvs/time_map')
+
+    pubsub = ctx.redis_client.pubsub()
+    await pubsub.psubscribe('/dvs/*')
+    assert await anyone_listening('/dvs/image', '/dvs/time_map')
+
+
+@pytest.mark.asyncio
+async def test_node_end_to_end(mocker: "MockerFixture"):
+    ctx = setup_node(mocker)
+    received = []
+
+    async def on_message(value):
+        received.append(value)
+
+    task = asyncio.get_event_loop().create_task(subscribe({
+        'numbers': on_message,
+        **await parameter('ratio', .5, on_message)}))
+    await ProcessService.self_register(ctx)
+    while not ProcessService.is_ready(NodeContext('mesh', 'node', 'node'),
+                                      True):
+        await asyncio.sleep(1e-3)
+
+    assert await anyone_listening('numbers')
+    for i in range(3):
+        await publish('numbers', i)
+    while len(received) < 4:
+        await asyncio.sleep(1e-3)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # Let the receivers of the subscription finish their cancellation
+    await asyncio.sleep(0)
+    await API.health_service.flush(ctx)
+
+    assert received == [.5, 0, 1, 2]
+    assert pickle.loads(
+        ensure_redis().get('!param:mesh:node:ratio')) == .5
+    _, _, _, rates = decode_health(ensure_redis().hgetall(health_id(ctx)))
+    assert rates['in']['numbers'] and rates['out']['numbers']
@@ -0,0 +1,77 @@
+import pickle
+import random
+from lemon.tracing import (
+    TRACE_HEADER,
+    TRACE_ID,
+    LatencyHistogram,
+    add_trace,
+    publisher_id,
+    strip_trace
+)
+from pytest_mock import MockerFixture
+
+
+def test_trace_roundtrip(mocker: "MockerFixture"):
+    mocker.patch('lemon.tracing.time.time', return_value=12.5)
+    data = pickle.dumps([1, 2])
+    publisher = publisher_id('mesh', 'name')
+
+    traced = add_trace(data, publisher)
+
+    assert traced[0] == TRACE_ID
+    assert len(traced) == len(data) + TRACE_HEADER.size
+    sent, traced_publisher, payload = strip_trace(traced)
+    assert (sent, traced_publisher) == (12.5, publisher)
+    assert pickle.loads(payload) == [1, 2]
+
+
+def test_histogram_small_values_are_exact():
+    histogram = LatencyHistogram()
+    for us in range(1, 101):
+        histogram.record(us / 1e6)
+
+    assert histogram.summary() == {
+        'p50': 50, 'p99': 99, 'max': 100, 'count': 100}
+
+
+def test_histogram_relative_error():
+    histogram = LatencyHistogram()
+    values = [random.Random(0).randint(0, 10 ** 7) for _ in range(10000)]
+    for value in values:
+        histogram.record(value / 1e6)
+    values.sort()
+
+    for percentile in (50, 99):
+        exact = values[int(percentile / 100 * len(values)) - 1]
+        assert abs(histogram.percentile(percentile) - exact) <= exact / 32
+    assert histogram.max == values[-1]
+    # Memory grows with the range of values only
+    assert len(histogram.counts) < 1500
+
+
+def test_histogram_buckets_cover_all_values():
+    for value in list(range(1000)) + [2 ** 20 - 1, 2 ** 20, 3600 * 10 ** 6]:
+        index = LatencyHistogram.index(value)
+        highest = LatencyHistogram.highest(index)
+        assert value <= highest
+        assert LatencyHistogram.index(highest) == index
+
+
+def test_histogram_negative_latency():
+    histogram = LatencyHistogram()
+    histogram.record(-1e-3)
+
+    assert histogram.summary()['max'] == 0
+
+
+def test_histogram_merge():
+    first, second = LatencyHistogram(), LatencyHistogram()
+    for us in range(1, 51):
+        first.record(us / 1e6)
+    for us in range(51, 101):
+        second.record(us / 1e6)
+
+    first.merge(second)
+
+    assert first.summary() == {
+        'p50': 50, 'p99': 99, 'max': 100, 'count': 100}
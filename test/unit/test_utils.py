@@ -1,11 +1,27 @@
 from asyncio import Future
 from unittest.mock import MagicMock
-from lemon.utils import ensure_redis
+import os
+import subprocess
+import sys
+import lemon
+from lemon.utils import (
+    check_redis,
+    ensure_redis,
+    get_redis_url,
+    lazy_import,
+    server_args
+)
+import pytest
 from pytest_mock import MockerFixture
 import redis
 
+pytest_plugins = ('pytest_asyncio',)
+
 
 def setup_client(mocker: "MockerFixture") -> "MagicMock":
+    mocker.patch.dict('os.environ')
+    mocker.patch.dict('lemon.utils.POOLS', clear=True)
+    mocker.patch('lemon.utils.SERVERS', set())
     client = MagicMock(return_value=Future())
     return client, mocker.patch(
         'lemon.utils.redis.Redis', return_value=client)
@@ -21,11 +37,161 @@ def test_ensure_redis(mocker: "MockerFixture"):
 
 def test_ensure_redis_server_down(mocker: "MockerFixture"):
     client, init = setup_client(mocker)
-    client.ping.side_effect = redis.exceptions.ConnectionError()
+    client.ping.side_effect = [
+        redis.exceptions.ConnectionError(),
+        redis.exceptions.ConnectionError(),
+        True
+    ]
     popen = mocker.patch(
         'lemon.utils.subprocess.Popen'
     )
+    sleep = mocker.patch('lemon.utils.time.sleep')
     ensure_redis()
 
     init.assert_called()
     popen.assert_called_once()
+    assert client.ping.call_count == 3
+    assert sleep.call_count == 2
+
+
+def test_ensure_redis_server_does_not_start(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    client.ping.side_effect = redis.exceptions.ConnectionError()
+    mocker.patch('lemon.utils.subprocess.Popen')
+    mocker.patch('lemon.utils.time.sleep')
+    mocker.patch('lemon.utils.time.monotonic', side_effect=[0, 1, 10])
+
+    try:
+        ensure_redis()
+        assert False
+    except redis.exceptions.ConnectionError:
+        pass
+
+
+def test_ensure_redis_server_can_not_be_spawned(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    client.ping.side_effect = redis.exceptions.ConnectionError()
+    mocker.patch('lemon.utils.subprocess.Popen',
+                 side_effect=FileNotFoundError('redis-server'))
+
+    with pytest.raises(redis.exceptions.ConnectionError):
+        ensure_redis()
+
+
+def test_ensure_redis_checks_server_once(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    popen = mocker.patch('lemon.utils.subprocess.Popen')
+    sleep = mocker.patch('lemon.utils.time.sleep')
+
+    clients = [ensure_redis() for _ in range(50)]
+
+    client.ping.assert_called_once()
+    popen.assert_not_called()
+    sleep.assert_not_called()
+    assert len(set(id(client.connection_pool) for client in clients)) == 1
+
+    ensure_redis(check=True)
+    assert client.ping.call_count == 2
+
+
+def test_ensure_redis_shares_pool(mocker: "MockerFixture"):
+    mocker.patch.dict('lemon.utils.POOLS', clear=True)
+    mocker.patch('lemon.utils.SERVERS', {
+        'redis://localhost:6379', 'redis://localhost:6380'})
+
+    first, second = ensure_redis(), ensure_redis()
+    assert first.connection_pool is second.connection_pool
+
+    other = ensure_redis(url='redis://localhost:6380')
+    assert other.connection_pool is not first.connection_pool
+
+
+def test_get_redis_url(mocker: "MockerFixture"):
+    mocker.patch.dict('os.environ')
+    os.environ.pop('LEMON_REDIS_URL', None)
+    assert get_redis_url() == 'redis://localhost:6379'
+
+    os.environ['LEMON_REDIS_URL'] = 'unix:///tmp/redis.sock'
+    assert get_redis_url() == 'unix:///tmp/redis.sock'
+
+
+def test_server_args():
+    assert server_args('unix:///tmp/redis.sock') == [
+        'redis-server', '--daemonize', 'yes', '--port', '0',
+        '--unixsocket', '/tmp/redis.sock', '--unixsocketperm', '700']
+    assert server_args('redis://localhost:6380')[-2:] == ['--port', '6380']
+    assert server_args('redis://127.0.0.1')[-2:] == ['--port', '6379']
+    assert server_args('redis://redis.example.com:6379') is None
+
+
+def test_ensure_redis_unix_socket(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    client.ping.side_effect = [redis.exceptions.ConnectionError(), True]
+    popen = mocker.patch('lemon.utils.subprocess.Popen')
+    mocker.patch('lemon.utils.time.sleep')
+    os.environ['LEMON_REDIS_URL'] = 'unix:///tmp/redis.sock'
+
+    ensure_redis()
+
+    assert '/tmp/redis.sock' in popen.call_args[0][0]
+
+
+def test_ensure_redis_remote_server_is_not_spawned(mocker: "MockerFixture"):
+    client, _ = setup_client(mocker)
+    client.ping.side_effect = redis.exceptions.ConnectionError()
+    popen = mocker.patch('lemon.utils.subprocess.Popen')
+
+    try:
+        ensure_redis(url='redis://redis.example.com:6379')
+        assert False
+    except redis.exceptions.ConnectionError:
+        pass
+
+    popen.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_check_redis_in_executor(mocker: "MockerFixture"):
+    ensure = mocker.patch('lemon.utils.ensure_redis')
+
+    await check_redis('unix:///tmp/redis.sock')
+
+    ensure.assert_called_once_with(url='unix:///tmp/redis.sock', check=True)
+
+
+def test_lazy_import(mocker: "MockerFixture"):
+    mocker.patch.dict('sys.modules')
+    sys.modules.pop('colorsys', None)
+
+    colorsys = lazy_import('colorsys')
+    assert lazy_import('colorsys') is colorsys
+    assert colorsys.rgb_to_hsv(1, 0, 0) == (0, 1, 1)
+
+
+def test_lazy_import_missing():
+    with pytest.raises(ModuleNotFoundError):
+        lazy_import('lemon_missing_module')
+
+
+def test_lemon_exports_api_lazily():
+    from lemon.api import publish
+    assert lemon.publish is publish
+
+    try:
+        lemon.unknown
+        assert False
+    except AttributeError:
+        pass
+
+
+def test_cli_does_not_load_unused_dependencies():
+    loaded = subprocess.run([sys.executable, '-c', """
+import importlib.util, sys
+import lemon.actions
+print(' '.join(name for name, module in sys.modules.items()
+               if not isinstance(module, importlib.util._LazyModule)))
+"""], capture_output=True, text=True, check=True).stdout.split()
+
+    for module in ('lemon.api', 'redis', 'yaml', 'cerberus', 'prettytable',
+                   'psutil'):
+        assert module not in loaded
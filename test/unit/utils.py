@@ -4,6 +4,7 @@ from pytest_mock import MockerFixture
 
 
 def setup_client(mocker: "MockerFixture") -> "MagicMock":
+    mocker.patch.dict('os.environ')
     client = MagicMock(return_value=Future())
     return client, mocker.patch(
         'lemon.utils.redis.Redis', return_value=client)